@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Benchmarks of creating, downloading, verifying and acquiring backpacks,
+# run against a local stand-in for Zenodo so that no network is needed.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+'''Each operation is timed in a fresh subprocess, which also reports its
+peak resident set size. The startup operation times importing the package
+and acquiring a backpack without verifying it, as a program using a backpack
+does when it starts, and lists which of HEAVY_MODULES that imported. Results
+are written as JSON, and a previous results file can be given with --compare
+to print the change.
+
+Example use:
+    python benchmark/benchmark.py --output results-0.4.json
+    python benchmark/benchmark.py --output results.json --compare results-0.4.json
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path = [ROOT, os.path.join(ROOT, 'test')] + sys.path
+
+import zenodo_backpack
+from fake_zenodo import FakeZenodoServer
+
+DATA_VERSION = '1.0'
+DOI = '10.5281/zenodo.1'
+
+# Payloads, each a list of (number of files, bytes per file)
+PROFILES = {
+    'many_small': [(20000, 512)],
+    'mixed': [(500, 64 * 1024), (20, 4 * 1024 * 1024)],
+    'few_large': [(2, 256 * 1024 * 1024)],
+}
+OPERATIONS = ('create', 'download', 'verify', 'acquire', 'startup')
+# Modules which are slow to import, and should not be needed to acquire a
+# backpack already on disk
+HEAVY_MODULES = ('requests', 'tqdm', 'tarfile', 'tempfile')
+
+# Run with python -c so that nothing is imported beforehand
+STARTUP_SCRIPT = '''
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import zenodo_backpack
+zenodo_backpack.acquire(path=sys.argv[2])
+seconds = time.perf_counter() - start
+heavy_modules = [m for m in json.loads(sys.argv[3]) if m in sys.modules and m not in before]
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss if sys.platform == 'darwin' else rss * 1024
+except ImportError:
+    rss = None
+print(json.dumps({'seconds': seconds, 'peak_rss_bytes': rss, 'heavy_modules': heavy_modules}))
+'''
+
+
+def generate_payload(directory, profile, scale):
+    '''Write random files for a profile into directory, returning their
+    number and total size.'''
+    count = 0
+    total = 0
+    for group, (number, size) in enumerate(PROFILES[profile]):
+        number = max(1, int(number * scale)) if size < 1024 * 1024 else number
+        size = size if size < 1024 * 1024 else max(1024 * 1024, int(size * scale))
+        for i in range(number):
+            # Spread small files over subdirectories, as real payloads are
+            subdirectory = os.path.join(directory, 'group{}'.format(group), str(i // 1000))
+            os.makedirs(subdirectory, exist_ok=True)
+            with open(os.path.join(subdirectory, 'file{}.bin'.format(i)), 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    block = min(remaining, 16 * 1024 * 1024)
+                    f.write(os.urandom(block))
+                    remaining -= block
+            count += 1
+            total += size
+    return count, total
+
+
+def run_operation(operation, arguments):
+    '''Run one operation in this process, returning the seconds it took.'''
+    start = time.perf_counter()
+    if operation == 'create':
+        zenodo_backpack.ZenodoBackpackCreator().create(
+            arguments['payload'], arguments['archive'], DATA_VERSION, force=True, max_workers=arguments['max_workers'],
+            hash_algorithm=arguments['hash_algorithm'])
+    elif operation == 'download':
+        downloader = zenodo_backpack.ZenodoBackpackDownloader()
+        downloader.doi_resolver_url = arguments['server'] + '/doi/'
+        downloader.records_url = arguments['server'] + '/api/records/'
+        downloader.download_and_extract(arguments['output_directory'], DOI, max_workers=arguments['max_workers'])
+    elif operation == 'verify':
+        zenodo_backpack.ZenodoBackpackDownloader().verify(
+            zenodo_backpack.ZenodoBackpack(arguments['backpack']), max_workers=arguments['max_workers'])
+    elif operation == 'acquire':
+        zenodo_backpack.acquire(path=arguments['backpack'], md5sum=True, version=DATA_VERSION,
+                                max_workers=arguments['max_workers'])
+    else:
+        raise ValueError('Unknown operation {}'.format(operation))
+    return time.perf_counter() - start
+
+
+def peak_rss():
+    '''Peak resident set size of this process in bytes, or None if unknown.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(operation, arguments):
+    '''Run an operation in a subprocess, returning its seconds and peak RSS.'''
+    if operation == 'startup':
+        return measure_startup(arguments['backpack'])
+    result = subprocess.run(
+        [sys.executable, os.path.realpath(__file__), '--run-operation', operation, json.dumps(arguments)],
+        stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def measure_startup(backpack):
+    '''Time importing the package and acquiring backpack in a fresh
+    interpreter, returning the seconds, peak RSS and heavy modules imported.'''
+    result = subprocess.run(
+        [sys.executable, '-c', STARTUP_SCRIPT, ROOT, backpack, json.dumps(HEAVY_MODULES)],
+        stdout=subprocess.PIPE, check=True)
+    return json.loads(result.stdout.decode().strip().splitlines()[-1])
+
+
+def run_benchmarks(profiles, operations, scale=1.0, max_workers=1, latency=0, bandwidth=None, repeats=1, hash_algorithm='md5'):
+    results = []
+    for profile in profiles:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            payload = os.path.join(tmpdir, 'payload')
+            archive = os.path.join(tmpdir, 'bench.zb.tar.gz')
+            logging.info('Generating {} payload'.format(profile))
+            files, size = generate_payload(payload, profile, scale)
+
+            def record(operation, arguments, n_bytes, prepare=None):
+                for _ in range(repeats):
+                    if prepare is not None:
+                        prepare()
+                    measured = measure(operation, arguments)
+                    results.append({
+                        'operation': operation,
+                        'profile': profile,
+                        'files': files,
+                        'bytes': n_bytes,
+                        'seconds': measured['seconds'],
+                        'megabytes_per_second': n_bytes / measured['seconds'] / 1e6 if n_bytes and measured['seconds'] else None,
+                        'peak_rss_bytes': measured['peak_rss_bytes'],
+                    })
+                    if 'heavy_modules' in measured:
+                        results[-1]['heavy_modules'] = measured['heavy_modules']
+                    logging.info('{} {}: {:.3f}s'.format(operation, profile, measured['seconds']))
+
+            # Everything else needs the archive, so it is created whether timed or not
+            arguments = {'payload': payload, 'archive': archive, 'max_workers': max_workers, 'hash_algorithm': hash_algorithm}
+            if 'create' in operations:
+                record('create', arguments, size)
+            else:
+                run_operation('create', arguments)
+
+            output_directory = os.path.join(tmpdir, 'download')
+            with FakeZenodoServer(version=DATA_VERSION, latency=latency, bandwidth=bandwidth) as server:
+                server.add_file(archive)
+                archive_size = os.path.getsize(archive)
+                arguments = {'server': server.url, 'output_directory': output_directory, 'max_workers': max_workers}
+                if 'download' in operations:
+                    # Start afresh each time, rather than finding the last download
+                    record('download', arguments, archive_size,
+                           prepare=lambda: shutil.rmtree(output_directory, ignore_errors=True))
+                else:
+                    run_operation('download', arguments)
+
+            backpack = os.path.join(output_directory, os.listdir(output_directory)[0])
+            arguments = {'backpack': backpack, 'max_workers': max_workers}
+            for operation in ('verify', 'acquire'):
+                if operation in operations:
+                    record(operation, arguments, size)
+            if 'startup' in operations:
+                record('startup', arguments, 0)
+    return results
+
+
+def compare(results, previous):
+    '''Print the change in time and peak RSS of each benchmark from a
+    previous results file.'''
+    def key(r):
+        return r['operation'], r['profile']
+    before = {}
+    for r in previous['results']:
+        before.setdefault(key(r), []).append(r)
+    print('{:<10} {:<12} {:>10} {:>10} {:>8} {:>10}'.format('operation', 'profile', 'before (s)', 'after (s)', 'change', 'RSS change'))
+    seen = set()
+    for r in results:
+        if key(r) in seen or key(r) not in before:
+            continue
+        seen.add(key(r))
+        old = before[key(r)]
+        new = [x for x in results if key(x) == key(r)]
+        old_seconds = min(x['seconds'] for x in old)
+        new_seconds = min(x['seconds'] for x in new)
+        rss_change = ''
+        if old[0]['peak_rss_bytes'] and new[0]['peak_rss_bytes']:
+            rss_change = '{:+.0%}'.format(max(x['peak_rss_bytes'] for x in new) / max(x['peak_rss_bytes'] for x in old) - 1)
+        print('{:<10} {:<12} {:>10.3f} {:>10.3f} {:>+8.0%} {:>10}'.format(
+            r['operation'], r['profile'], old_seconds, new_seconds, new_seconds / old_seconds - 1, rss_change))
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--run-operation':
+        logging.basicConfig(level=logging.ERROR)
+        seconds = run_operation(sys.argv[2], json.loads(sys.argv[3]))
+        print(json.dumps({'seconds': seconds, 'peak_rss_bytes': peak_rss()}))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', '-o', help='Write results as JSON to this file', required=True)
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=sorted(PROFILES),
+                        help='Payloads to benchmark. Default: [all]')
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS),
+                        help='Operations to benchmark. Default: [all]')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply the number of small files and the size of large ones by this. Default: [%(default)s]')
+    parser.add_argument('--max_workers', '--max-workers', type=int, default=1,
+                        help='max_workers passed to each operation. Default: [%(default)s]')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the stand-in server waits before each response. Default: [%(default)s]')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Bytes per second the stand-in server sends each response at. Default: [unlimited]')
+    parser.add_argument('--hash_algorithm', '--hash-algorithm', default='md5',
+                        help='Algorithm of the payload checksums of the backpacks created. Default: [%(default)s]')
+    parser.add_argument('--repeats', type=int, default=1, help='Times to run each benchmark. Default: [%(default)s]')
+    parser.add_argument('--compare', help='Print the change from this earlier results file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+
+    results = run_benchmarks(args.profiles, args.operations, scale=args.scale, max_workers=args.max_workers,
+                             latency=args.latency, bandwidth=args.bandwidth, repeats=args.repeats,
+                             hash_algorithm=args.hash_algorithm)
+    output = {
+        'zenodo_backpack_version': zenodo_backpack.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': {
+            'scale': args.scale,
+            'max_workers': args.max_workers,
+            'latency': args.latency,
+            'bandwidth': args.bandwidth,
+            'repeats': args.repeats,
+            'hash_algorithm': args.hash_algorithm,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
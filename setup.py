@@ -13,6 +13,14 @@ setup(
     license='GPL3+',
     install_requires=('tqdm',
                       'requests'),
+    extras_require={
+        'zstd': ['zstandard'],
+        'isal': ['isal'],
+        'async': ['aiohttp'],
+        'yaml': ['pyyaml'],
+        'blake3': ['blake3'],
+        'xxhash': ['xxhash'],
+    },
     author=['Alex Chklovski','Ben Woodcroft'],
     scripts=['bin/zenodo_backpack'],
     author_email='chklovski@gmail.com',
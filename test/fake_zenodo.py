@@ -0,0 +1,252 @@
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# A local stand-in for Zenodo used by the tests, so that downloads can be
+# exercised without network access.
+#=======================================================================
+
+import hashlib
+import http.server
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+# Bodies are written in pieces of this size, so that bandwidth can be limited
+WRITE_BLOCK_SIZE = 64 * 1024
+
+
+class FakeZenodoServer:
+    '''Serves Zenodo records and their files from memory over HTTP on
+    localhost.
+
+    Use as a context manager, then add_file() each file to serve. These make
+    up record 1, holding the newest version. Older versions can be added as
+    further records with add_record(). The endpoints are:
+
+        /api/records/<id>                   record JSON, with an ETag
+        /api/records/<id>/versions          all records, as Zenodo lists versions
+        /api/records/<id>/files/<name>/content
+                                            file content, honouring Range
+        /doi/<doi>                          redirect to /records/<id>
+
+    The files_metadata() method returns a list in the same form as the
+    'files' entry of a Zenodo record. To download from the server with an
+    unmodified ZenodoBackpackDownloader, point its doi_resolver_url and
+    records_url at the properties of the same names, or use downloader().
+    '''
+
+    def __init__(self, support_range=True, version='0.1', latency=0, bandwidth=None):
+        '''
+        Parameters
+        ----------
+        support_range: bool
+            If False, ignore Range headers as some servers do
+        version: str
+            Version of record 1
+        latency: float
+            Seconds to wait before answering each request
+        bandwidth: None or float
+            Bytes per second at which each response body is sent
+        '''
+        self.files = {}
+        self.version = version
+        self.records = {}
+        # DOIs which resolve to a record other than 1
+        self.dois = {}
+        self.requests = []
+        self.support_range = support_range
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # Number of bytes after which the next responses are cut short, as if
+        # the connection was reset
+        self.interruptions = []
+        # Failures given in place of the next responses: an HTTP status, or
+        # 'reset' to close the connection without responding
+        self.errors = []
+        # Value of the Retry-After header sent with error statuses, if any
+        self.retry_after = None
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests.append((self.path, dict(self.headers)))
+                    error = server.errors.pop(0) if server.errors else None
+                if server.latency:
+                    time.sleep(server.latency)
+                if error == 'reset':
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                elif error is not None:
+                    self.send_response(error)
+                    if server.retry_after is not None:
+                        self.send_header('Retry-After', str(server.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                match = re.fullmatch(r'/api/records/([^/]+)(/versions|/files/([^/]+)/content)?', self.path)
+                if self.path.startswith('/doi/'):
+                    record_id = server.dois.get(self.path[len('/doi/'):], '1')
+                    self.send_response(302)
+                    self.send_header('Location', '/records/{}'.format(record_id))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                elif re.fullmatch(r'/records/[^/]+', self.path):
+                    self._send_body(b'<html>record</html>', 'text/html')
+                elif match is None or match.group(1) not in server.record_ids():
+                    self.send_error(404)
+                elif match.group(2) is None:
+                    self._send_json(server.record_json(match.group(1)))
+                elif match.group(2) == '/versions':
+                    self._send_json(server.versions_json())
+                else:
+                    self._send_file(match.group(1), match.group(3))
+
+            def _send_file(self, record_id, name):
+                files = server.record_files(record_id)
+                if name not in files:
+                    self.send_error(404)
+                    return
+                data = files[name]
+                byte_range = self.headers.get('Range')
+                if byte_range is not None and server.support_range:
+                    start, end = byte_range.split('=')[1].split('-')
+                    start = int(start)
+                    end = int(end) if end else len(data) - 1
+                    if start >= len(data):
+                        self.send_error(416)
+                        return
+                    end = min(end, len(data) - 1)
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+                    data = data[start:end + 1]
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                with server._lock:
+                    interruption = server.interruptions.pop(0) if server.interruptions else None
+                if interruption is not None:
+                    self._write(data[:interruption])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self._write(data)
+
+            def _send_json(self, js):
+                body = json.dumps(js).encode()
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self._send_body(body, 'application/json', etag)
+
+            def _send_body(self, body, content_type, etag=None):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if etag is not None:
+                    self.send_header('ETag', etag)
+                self.end_headers()
+                self._write(body)
+
+            def _write(self, data):
+                view = memoryview(data)
+                for start in range(0, len(view), WRITE_BLOCK_SIZE):
+                    block = view[start:start + WRITE_BLOCK_SIZE]
+                    if server.bandwidth:
+                        time.sleep(len(block) / server.bandwidth)
+                    self.wfile.write(block)
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    @property
+    def records_url(self):
+        return '{}/api/records/'.format(self.url)
+
+    @property
+    def doi_resolver_url(self):
+        return '{}/doi/'.format(self.url)
+
+    def downloader(self, **kwargs):
+        '''Return a ZenodoBackpackDownloader which uses this server in place of
+        doi.org and zenodo.org.'''
+        from zenodo_backpack import ZenodoBackpackDownloader
+        downloader = ZenodoBackpackDownloader(**kwargs)
+        downloader.doi_resolver_url = self.doi_resolver_url
+        downloader.records_url = self.records_url
+        return downloader
+
+    def file_url(self, name, record_id='1'):
+        return '{}/api/records/{}/files/{}/content'.format(self.url, record_id, name)
+
+    def add_file(self, path, name=None):
+        if name is None:
+            name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.files[name] = f.read()
+        return name
+
+    def add_record(self, record_id, version, paths, doi=None):
+        '''Add a record holding another version, with the files at paths. If
+        doi is given, it resolves to this record.'''
+        files = {}
+        for path in paths:
+            with open(path, 'rb') as f:
+                files[os.path.basename(path)] = f.read()
+        self.records[str(record_id)] = {'version': version, 'files': files}
+        if doi is not None:
+            self.dois[doi] = str(record_id)
+
+    def record_ids(self):
+        return ['1'] + list(self.records)
+
+    def record_files(self, record_id='1'):
+        return self.files if record_id == '1' else self.records[record_id]['files']
+
+    def range_requests(self):
+        return [headers['Range'] for _, headers in self.requests if 'Range' in headers]
+
+    def files_metadata(self, record_id='1'):
+        return [{
+            'key': name,
+            'size': len(data),
+            'checksum': 'md5:' + hashlib.md5(data).hexdigest(),
+            'links': {'self': self.file_url(name, record_id)},
+        } for name, data in self.record_files(record_id).items()]
+
+    def record_json(self, record_id='1'):
+        version = self.version if record_id == '1' else self.records[record_id]['version']
+        return {'id': int(record_id), 'metadata': {'version': version}, 'files': self.files_metadata(record_id)}
+
+    def versions_json(self):
+        hits = [self.record_json(record_id) for record_id in self.record_ids()]
+        return {'hits': {'hits': hits, 'total': len(hits)}}
+
+    def record_requests(self):
+        return [(path, headers) for path, headers in self.requests if path.startswith('/api/records/1') and not path.endswith('/content')]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempfile
+import json
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from zenodo_backpack import ZenodoBackpackCreator, ZenodoBackpackDownloader
+from zenodo_backpack import batch
+import zenodo_backpack
+
+from fake_zenodo import FakeZenodoServer
+from test_downloader import LocalDownloader, DATA_DIRECTORY
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_load_json_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            manifest = os.path.join(tmpdirname, 'manifest.json')
+            with open(manifest, 'w') as f:
+                json.dump([{'doi': '10.5281/zenodo.1', 'version': 2, 'output_directory': 'a'}], f)
+            self.assertEqual(
+                [{'doi': '10.5281/zenodo.1', 'version': '2', 'output_directory': 'a', 'env_var_name': None}],
+                batch.load_manifest(manifest))
+
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed')
+    def test_load_yaml_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            manifest = os.path.join(tmpdirname, 'manifest.yml')
+            with open(manifest, 'w') as f:
+                f.write('backpacks:\n'
+                        '  - doi: 10.5281/zenodo.1\n'
+                        '    version: 1.0\n'
+                        '    output_directory: a\n'
+                        '    env_var_name: A_PATH\n'
+                        '  - doi: 10.5281/zenodo.2\n'
+                        '    output_directory: b\n')
+            self.assertEqual([
+                {'doi': '10.5281/zenodo.1', 'version': '1.0', 'output_directory': 'a', 'env_var_name': 'A_PATH'},
+                {'doi': '10.5281/zenodo.2', 'version': None, 'output_directory': 'b', 'env_var_name': None},
+            ], batch.load_manifest(manifest))
+
+    def test_manifest_entry_needs_output_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            manifest = os.path.join(tmpdirname, 'manifest.json')
+            with open(manifest, 'w') as f:
+                json.dump({'backpacks': [{'doi': '10.5281/zenodo.1'}]}, f)
+            with self.assertRaises(ValueError):
+                batch.load_manifest(manifest)
+
+    def test_download_many(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+            entries = [
+                {'doi': 'doi1', 'version': None, 'output_directory': os.path.join(tmpdirname, 'a'), 'env_var_name': None},
+                {'doi': 'doi2', 'version': '0.1', 'output_directory': os.path.join(tmpdirname, 'b'), 'env_var_name': None},
+            ]
+            with FakeZenodoServer() as server:
+                size = len(server.files[server.add_file(archive)])
+                summaries = batch.download_many(entries, downloader=LocalDownloader(server))
+                self.assertEqual([batch.DOWNLOADED, batch.DOWNLOADED], [s['status'] for s in summaries])
+                self.assertEqual([size, size], [s['bytes'] for s in summaries])
+                self.assertEqual(os.path.join(tmpdirname, 'a', 'test_folder1.zb'), summaries[0]['path'])
+                self.assertEqual('0.1', summaries[1]['data_version'])
+
+                # Present already, so not downloaded again
+                server.requests = []
+                summaries = batch.download_many(entries, downloader=LocalDownloader(server))
+                self.assertEqual([batch.SKIPPED, batch.SKIPPED], [s['status'] for s in summaries])
+                self.assertEqual([], [path for path, _ in server.requests if path.endswith('/content')])
+
+                # A damaged backpack is downloaded again rather than skipped
+                with open(os.path.join(summaries[0]['path'], 'payload_directory', 'my.shuf'), 'a') as f:
+                    f.write('extra')
+                summaries = batch.download_many(entries, downloader=LocalDownloader(server))
+                self.assertEqual([batch.DOWNLOADED, batch.SKIPPED], [s['status'] for s in summaries])
+                zenodo_backpack.acquire(path=summaries[0]['path'], verify='full')
+
+                # Each backpack fails separately when its version does not match
+                summaries = batch.download_many(entries, downloader=LocalDownloader(server, version='0.2'))
+                self.assertEqual([batch.FAILED, batch.FAILED], [s['status'] for s in summaries])
+                self.assertIn('does not match', summaries[0]['error'])
+
+    def test_bandwidth_limit(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            data = os.path.join(tmpdirname, 'data.bin')
+            with open(data, 'wb') as f:
+                f.write(os.urandom(30000))
+            with FakeZenodoServer() as server:
+                server.add_file(data)
+                downloader = ZenodoBackpackDownloader(bandwidth_limit=20000)
+                start = time.time()
+                downloader._download_file(server.file_url('data.bin'), os.path.join(tmpdirname, 'out.bin'))
+                # The first second's worth arrives at once, the rest at the limit
+                self.assertGreater(time.time() - start, 0.4)
+
+
+if __name__ == "__main__":
+    unittest.main()
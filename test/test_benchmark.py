@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempfile
+import json
+import subprocess
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'benchmark', 'benchmark.py')
+
+
+class Tests(unittest.TestCase):
+    def test_benchmark_runs(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            output = os.path.join(tmpdirname, 'results.json')
+            subprocess.run([sys.executable, BENCHMARK, '--output', output, '--scale', '0.001', '--profiles', 'mixed'],
+                           check=True, stderr=subprocess.DEVNULL)
+            with open(output) as f:
+                results = json.load(f)
+            self.assertEqual(['create', 'download', 'verify', 'acquire', 'startup'],
+                             [r['operation'] for r in results['results']])
+            self.assertEqual([], results['results'][-1]['heavy_modules'])
+            for r in results['results']:
+                self.assertGreater(r['seconds'], 0)
+                self.assertGreater(r['peak_rss_bytes'], 0)
+
+            comparison = subprocess.run(
+                [sys.executable, BENCHMARK, '--output', os.path.join(tmpdirname, 'again.json'), '--scale', '0.001',
+                 '--profiles', 'mixed', '--operations', 'verify', '--compare', output],
+                check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.assertIn('verify', comparison.stdout.decode())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+import unittest
+import os.path
+import sys
+import tempfile
+from unittest import mock
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+import zenodo_backpack
+from zenodo_backpack import ZenodoBackpackCreator, ZenodoBackpackDownloader, BackpackCache
+from fake_zenodo import FakeZenodoServer
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+class Tests(unittest.TestCase):
+    def _archive(self, tmpdirname, version):
+        os.makedirs(os.path.join(tmpdirname, version))
+        archive = os.path.join(tmpdirname, version, 'test_folder1.zb.tar.gz')
+        ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, version)
+        return archive
+
+    def _content_requests(self, server):
+        return [path for path, _ in server.requests if path.endswith('/content')]
+
+    def test_acquire_and_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            root = os.path.join(tmpdirname, 'cache')
+            with FakeZenodoServer(version='0.2') as server:
+                server.add_file(self._archive(tmpdirname, '0.2'))
+                server.add_record('2', '0.1', [self._archive(tmpdirname, '0.1')])
+                cache = BackpackCache(root, downloader=server.downloader())
+
+                zb = cache.acquire('10.1234/x', '0.1')
+                self.assertEqual('0.1', zb.data_version_string())
+                self.assertEqual(os.path.join(root, '10.1234%2Fx', '0.1', 'test_folder1.zb'), zb.base_directory)
+                self.assertEqual(1, len(self._content_requests(server)))
+                self.assertEqual(zb.base_directory, cache.acquire('10.1234/x', '0.1').base_directory)
+                self.assertEqual(1, len(self._content_requests(server)))
+
+                entries = cache.entries()
+                self.assertEqual([('10.1234/x', '0.1', False)], [(e['doi'], e['version'], e['pinned']) for e in entries])
+                size = entries[0]['size']
+                self.assertGreater(size, 0)
+
+                # Evict the least recently used version to fit the quota
+                cache.quota = size + 1
+                with mock.patch.object(zenodo_backpack.cache, 'CACHE_EVICTION_MIN_AGE', 0):
+                    newest = cache.acquire('10.1234/x')
+                    self.assertEqual('0.2', newest.data_version_string())
+                    self.assertEqual(['0.2'], [e['version'] for e in cache.entries()])
+
+                    # Pinned versions stay
+                    cache.pin('10.1234/x', '0.2')
+                    cache.acquire('10.1234/x', '0.1')
+                    self.assertEqual([('0.2', True), ('0.1', False)],
+                                     [(e['version'], e['pinned']) for e in cache.entries()])
+                    self.assertEqual(['0.1'], [e['version'] for e in cache.prune(size, dry_run=True)])
+                    self.assertEqual(2, len(cache.entries()))
+                    cache.pin('10.1234/x', '0.2', pinned=False)
+                    self.assertEqual(['0.2'], [e['version'] for e in cache.prune(size)])
+                    self.assertEqual(['0.1'], [e['version'] for e in cache.entries()])
+
+                # Recently used versions are never evicted
+                self.assertEqual([], cache.prune(0))
+
+    def test_acquire_by_doi(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            root = os.path.join(tmpdirname, 'cache')
+            with FakeZenodoServer() as server, \
+                    mock.patch.object(ZenodoBackpackDownloader, 'doi_resolver_url', server.doi_resolver_url), \
+                    mock.patch.object(ZenodoBackpackDownloader, 'records_url', server.records_url), \
+                    mock.patch.dict(os.environ, {zenodo_backpack.CACHE_ROOT_ENV_VAR: root}):
+                server.add_file(self._archive(tmpdirname, '0.1'))
+                zb = zenodo_backpack.acquire(doi='10.1234/x', version='0.1', md5sum=True)
+                self.assertEqual('0.1', zb.data_version_string())
+                self.assertTrue(zb.base_directory.startswith(root))
+                with self.assertRaises(ValueError):
+                    zenodo_backpack.acquire(doi='10.1234/x', path=zb.base_directory)
+
+    def test_evicted_by_another_process(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            root = os.path.join(tmpdirname, 'cache')
+            with FakeZenodoServer(version='0.2') as server:
+                server.add_file(self._archive(tmpdirname, '0.2'))
+                server.add_record('2', '0.1', [self._archive(tmpdirname, '0.1')])
+                cache = BackpackCache(root, downloader=server.downloader())
+                cache.acquire('10.1234/x', '0.1')
+                cache.acquire('10.1234/x', '0.2')
+
+            entries = cache.entries()
+            # Another process removes a version after it was listed
+            BackpackCache(root)._remove(cache.entry_directory('10.1234/x', '0.1'))
+            with mock.patch.object(zenodo_backpack.cache, 'CACHE_EVICTION_MIN_AGE', 0), \
+                    mock.patch.object(cache, 'entries', return_value=entries):
+                self.assertEqual(['0.2'], [e['version'] for e in cache.prune(0)])
+            self.assertFalse(os.listdir(root))
+
+    def test_interrupted_removal_is_cleared(self):
+        with tempfile.TemporaryDirectory() as root:
+            trash = os.path.join(root, zenodo_backpack.cache.CACHE_TRASH_PREFIX + 'left')
+            os.makedirs(os.path.join(trash, '0.1'))
+            BackpackCache(root)
+            self.assertEqual([], os.listdir(root))
+
+    def test_hard_links_counted_once(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with open(os.path.join(tmpdirname, 'a'), 'wb') as f:
+                f.write(b'x' * 1000)
+            os.link(os.path.join(tmpdirname, 'a'), os.path.join(tmpdirname, 'b'))
+            self.assertEqual(1000, zenodo_backpack.cache._directory_size(tmpdirname))
+
+    def test_parse_size(self):
+        self.assertEqual(100, zenodo_backpack.parse_size('100'))
+        self.assertEqual(3 * 1024 ** 3, zenodo_backpack.parse_size('3G'))
+        self.assertEqual(512 * 1024, zenodo_backpack.parse_size('0.5MB'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import json
+import shutil
+import hashlib
+import os.path
+import sys
+import tempfile
+import tarfile
+import gzip
+import io
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from zenodo_backpack import ZenodoBackpackCreator
+import zenodo_backpack
+from zenodo_backpack import compression
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+EXPECTED_MD5SUMS = {
+    '/payload_directory/4': '302c28003d487124d97c242de94da856',
+    '/payload_directory/my.shuf': 'd3d0fa09972d97430e8d7449051084b6',
+}
+
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def _create_and_extract(self, tmpdirname, **kwargs):
+        archive = os.path.join(tmpdirname, 'out.zb.tar.gz')
+        ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1', **kwargs)
+        with tarfile.open(archive) as tf:
+            names = tf.getnames()
+            tf.extractall(tmpdirname)
+        return names, zenodo_backpack.acquire(path=os.path.join(tmpdirname, 'test_folder1.zb'), md5sum=True)
+
+    def test_create(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            names, zb = self._create_and_extract(tmpdirname, max_workers=2)
+            self.assertEqual('test_folder1.zb/CONTENTS.json', names[0])
+            self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+    def test_create_single_pass(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            names, zb = self._create_and_extract(tmpdirname, single_pass=True)
+            self.assertEqual([
+                'test_folder1.zb/payload_directory',
+                'test_folder1.zb/payload_directory/4',
+                'test_folder1.zb/payload_directory/my.shuf',
+                'test_folder1.zb/CONTENTS.json'], names)
+            self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+    def test_parallel_gzip_is_ordinary_gzip(self):
+        data = os.urandom(100000) + b'abc' * 100000
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = os.path.join(tmpdirname, 'out.gz')
+            with open(path, 'wb') as f:
+                writer = compression.ParallelGzipWriter(f, threads=3, block_size=50000)
+                for start in range(0, len(data), 7777):
+                    writer.write(data[start:start + 7777])
+                writer.close()
+            with gzip.open(path) as f:
+                self.assertEqual(data, f.read())
+
+    def test_create_parallel_gzip(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            _, zb = self._create_and_extract(tmpdirname, max_workers=4, compression_level=1)
+            self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_create_zstd(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), os.path.join(tmpdirname, 'out'), '0.1',
+                                           compression='zstd', max_workers=2)
+            archive = os.path.join(tmpdirname, 'out.zb.tar.zst')
+            with open(archive, 'rb') as f:
+                with compression.open_tar(f, compression.archive_compression(archive)) as tf:
+                    tf.extractall(tmpdirname)
+            zb = zenodo_backpack.acquire(path=os.path.join(tmpdirname, 'test_folder1.zb'), md5sum=True)
+            self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+
+    def _make_tree(self, tmpdirname):
+        # The folder name recurs within the tree, and '-' sorts before '/'
+        base = os.path.join(tmpdirname, 'abc')
+        for path, text in [('abc/abc/x', 'x'), ('abc/y', 'y'), ('abc-d', 'z'), ('b/abc', 'w')]:
+            os.makedirs(os.path.dirname(os.path.join(base, path)), exist_ok=True)
+            with open(os.path.join(base, path), 'w') as f:
+                f.write(text)
+        os.symlink(os.path.join(base, 'abc-d'), os.path.join(base, 'link'))
+        return base
+
+    def test_create_tree(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            base = self._make_tree(tmpdirname)
+            for single_pass in (False, True):
+                out = os.path.join(tmpdirname, 'single' if single_pass else 'two')
+                os.mkdir(out)
+                archive = os.path.join(out, 'out.zb.tar.gz')
+                ZenodoBackpackCreator().create(base, archive, '0.1', max_workers=2, single_pass=single_pass,
+                                               manifest=True)
+                with tarfile.open(archive) as tf:
+                    tf.extractall(out)
+                zb = zenodo_backpack.acquire(path=os.path.join(out, 'abc.zb'), md5sum=True)
+                expected = ['/payload_directory/abc/abc/x', '/payload_directory/abc/y', '/payload_directory/abc-d',
+                            '/payload_directory/b/abc', '/payload_directory/link']
+                self.assertEqual(expected, list(zb.contents['md5sums']))
+                self.assertEqual(expected, list(zb.manifest))
+                self.assertEqual(zb.contents['md5sums']['/payload_directory/abc-d'],
+                                 zb.contents['md5sums']['/payload_directory/link'])
+
+    def test_create_broken_symlink(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            base = self._make_tree(tmpdirname)
+            os.symlink(os.path.join(base, 'missing'), os.path.join(base, 'b', 'broken'))
+            for single_pass in (False, True):
+                with self.assertRaises(zenodo_backpack.BrokenSymlinkException):
+                    ZenodoBackpackCreator().create(base, os.path.join(tmpdirname, 'out'), '0.1', force=True,
+                                                   single_pass=single_pass)
+
+
+    def test_create_hash_algorithms(self):
+        for algorithm in zenodo_backpack.available_hash_algorithms():
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                names, zb = self._create_and_extract(tmpdirname, hash_algorithm=algorithm, manifest=True)
+                self.assertEqual(algorithm, zb.hash_algorithm())
+                checksums = dict(zb.checksums().items())
+                self.assertEqual(sorted(EXPECTED_MD5SUMS), sorted(checksums))
+                if algorithm == 'md5':
+                    self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+                    self.assertEqual(1, zb.zenodo_backpack_version_string())
+                else:
+                    self.assertNotIn('md5sums', zb.contents)
+                    self.assertEqual(checksums, zb.contents['checksums'])
+                    self.assertEqual(algorithm, zb.contents['hash_algorithm'])
+                    self.assertEqual(2, zb.zenodo_backpack_version_string())
+
+                with open(os.path.join(zb.payload_directory_string(), 'my.shuf'), 'a') as f:
+                    f.write('changed')
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException):
+                    zenodo_backpack.acquire(path=zb.base_directory, md5sum=True)
+
+    def test_create_chunk_checksums(self):
+        for single_pass in (False, True):
+            with tempfile.TemporaryDirectory() as tmpdirname:
+                _, zb = self._create_and_extract(tmpdirname, chunk_size=4, single_pass=single_pass, manifest=True)
+                chunk_size, chunks = zb.chunk_checksums()
+                self.assertEqual(4, chunk_size)
+                payload = zb.payload_directory_string()
+                for name, count in (('4', 2), ('my.shuf', 3)):
+                    with open(os.path.join(payload, name), 'rb') as f:
+                        data = f.read()
+                    self.assertEqual([hashlib.md5(data[i:i + 4]).hexdigest() for i in range(0, len(data), 4)],
+                                     chunks['/payload_directory/' + name])
+                    self.assertEqual(count, len(chunks['/payload_directory/' + name]))
+                self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+                with open(os.path.join(payload, 'my.shuf'), 'r+b') as f:
+                    f.seek(5)
+                    f.write(b'!')
+                with open(os.path.join(payload, '4'), 'ab') as f:
+                    f.write(b'extra')
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException) as cm:
+                    zenodo_backpack.acquire(path=zb.base_directory, md5sum=True, max_workers=2)
+                self.assertEqual({'/payload_directory/my.shuf': [(4, 4)], '/payload_directory/4': [(8, 5)]},
+                                 cm.exception.regions)
+                self.assertIn('my.shuf (bytes 4-7)', str(cm.exception))
+
+    def test_create_delta(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            _, previous = self._create_and_extract(tmpdirname)
+            changed = os.path.join(tmpdirname, 'new', 'test_folder1')
+            shutil.copytree(os.path.join(DATA_DIRECTORY, 'test_folder1'), changed)
+            with open(os.path.join(changed, 'my.shuf'), 'a') as f:
+                f.write('changed')
+            os.mkdir(os.path.join(changed, 'sub'))
+            with open(os.path.join(changed, 'sub', 'added'), 'w') as f:
+                f.write('added')
+
+            archive = os.path.join(tmpdirname, 'new', 'out.zb.tar.gz')
+            ZenodoBackpackCreator().create(changed, archive, '0.2', delta_from=previous.base_directory)
+            delta_file = os.path.join(tmpdirname, 'new', 'out.zbdelta.tar.gz')
+            with tarfile.open(delta_file) as tf:
+                self.assertEqual([
+                    'test_folder1.zb/DELTA.json',
+                    'test_folder1.zb/CONTENTS.json',
+                    'test_folder1.zb/payload_directory',
+                    'test_folder1.zb/payload_directory/my.shuf',
+                    'test_folder1.zb/payload_directory/sub/added',
+                ], tf.getnames())
+                delta = json.load(tf.extractfile('test_folder1.zb/DELTA.json'))
+                contents = json.load(tf.extractfile('test_folder1.zb/CONTENTS.json'))
+            self.assertEqual({'base_version': '0.1', 'files': ['/payload_directory/my.shuf', '/payload_directory/sub/added']},
+                             delta)
+            with tarfile.open(archive) as tf:
+                self.assertEqual(json.load(tf.extractfile('test_folder1.zb/CONTENTS.json')), contents)
+
+            with self.assertRaises(FileExistsError):
+                ZenodoBackpackCreator().create(changed, archive, '0.2', delta_from=previous.base_directory)
+
+    def test_create_index(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            for single_pass in (False, True):
+                archive = os.path.join(tmpdirname, 'out.zb.tar.gz')
+                ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1',
+                                               force=True, single_pass=single_pass, index=True)
+                with open(os.path.join(tmpdirname, 'out.zbindex.json')) as f:
+                    index = json.load(f)
+                self.assertEqual('out.zb.tar.gz', index['archive'])
+                with open(archive, 'rb') as f:
+                    data = f.read()
+                # An ordinary gzip file, each of whose members can also be read on its own
+                with tarfile.open(archive) as tf:
+                    names = [m.name for m in tf.getmembers() if m.isfile()]
+                    self.assertEqual(sorted(names), sorted(index['members']))
+                    for name, entry in index['members'].items():
+                        out = io.BytesIO()
+                        zenodo_backpack.index.copy_member([data[entry[0]:entry[1]]], entry, out)
+                        self.assertEqual(tf.extractfile(name).read(), out.getvalue())
+
+            with self.assertRaises(ValueError):
+                ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'),
+                                               os.path.join(tmpdirname, 'out.zb.tar.zst'), '0.1', index=True)
+
+    def test_unavailable_hash_algorithm(self):
+        unavailable = set(zenodo_backpack.HASH_ALGORITHMS) - set(zenodo_backpack.available_hash_algorithms())
+        if not unavailable:
+            self.skipTest('All hash algorithms are available')
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with self.assertRaises(ImportError):
+                ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), os.path.join(tmpdirname, 'out'),
+                                               '0.1', hash_algorithm=unavailable.pop())
+            self.assertEqual([], os.listdir(tmpdirname))
+
+
+if __name__ == "__main__":
+    unittest.main()
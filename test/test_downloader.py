@@ -22,19 +22,773 @@
 #=======================================================================
 
 import unittest
+import shutil
 import os.path
 import sys
 import tempfile
+import io
+import json
+import tarfile
+import threading
+import socket
+import subprocess
+import time
+from unittest import mock
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 
-from zenodo_backpack import ZenodoBackpackDownloader
+from zenodo_backpack import ZenodoBackpackDownloader, ZenodoBackpackCreator
 import zenodo_backpack
 
+from fake_zenodo import FakeZenodoServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import asyncio
+    from zenodo_backpack.aio import AsyncZenodoBackpackDownloader
+except ImportError:
+    AsyncZenodoBackpackDownloader = None
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+class LocalDownloader(ZenodoBackpackDownloader):
+    '''Downloader which takes record metadata from a FakeZenodoServer rather
+    than from zenodo.org.'''
+
+    def __init__(self, server, version='0.1', **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+        self.version = version
+
+    def _retrieve_record_ID(self, doi):
+        return '1'
+
+    def _retrieve_record_metadata(self, recordID, version):
+        js = {'metadata': {'version': self.version}, 'files': self.server.files_metadata()}
+        return js, js['files']
+
+
+if AsyncZenodoBackpackDownloader is not None:
+    class LocalAsyncDownloader(AsyncZenodoBackpackDownloader):
+        '''AsyncZenodoBackpackDownloader which takes record metadata from a
+        FakeZenodoServer, as LocalDownloader does.'''
+
+        def __init__(self, server, version='0.1', **kwargs):
+            super().__init__(**kwargs)
+            self.server = server
+            self.version = version
+
+        async def _retrieve_record_ID(self, doi):
+            return '1'
+
+        async def _retrieve_record_metadata(self, recordID, version):
+            return {'metadata': {'version': self.version}}, self.server.files_metadata()
+
+
+class CachingDownloader(ZenodoBackpackDownloader):
+    '''Downloader which fetches record metadata from a FakeZenodoServer over
+    HTTP, so that the metadata cache can be exercised.'''
+
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+        self.records_url = server.records_url
+
+    def _retrieve_record_ID(self, doi):
+        return '1'
+
 
 class Tests(unittest.TestCase):
     maxDiff = None
 
+    def _create_backpack(self, tmpdir, name='test_folder1.zb.tar.gz', version='0.1'):
+        archive = os.path.join(tmpdir, name)
+        ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, version)
+        return archive
+
+    def test_local_download_and_extract_in_parallel(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            extra = os.path.join(tmpdirname, 'README.txt')
+            with open(extra, 'w') as f:
+                f.write('readme\n' * 1000)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                server.add_file(extra)
+                out = os.path.join(tmpdirname, 'out')
+                zb = LocalDownloader(server).download_and_extract(out, 'doi', max_workers=2)
+
+            self.assertEqual('0.1', zb.data_version_string())
+            self.assertEqual(os.path.join(out, 'test_folder1.zb', 'payload_directory'), zb.payload_directory_string())
+            self.assertTrue(os.path.exists(os.path.join(out, 'README.txt')))
+            self.assertFalse(os.path.exists(os.path.join(out, 'test_folder1.zb.tar.gz')))
+
+    def test_local_download_bad_checksum_cancels(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                files = server.files_metadata()
+                files[0]['checksum'] = 'md5:00000000000000000000000000000000'
+                downloader = LocalDownloader(server)
+                downloader._retrieve_record_metadata = lambda recordID, version: ({'metadata': {'version': '0.1'}}, files)
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackMalformedException):
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', max_workers=2)
+
+    def _download_big_file(self, support_range):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            big = os.path.join(tmpdirname, 'big.bin')
+            with open(big, 'wb') as f:
+                f.write(os.urandom(1000003))
+            with FakeZenodoServer(support_range=support_range) as server:
+                server.add_file(big)
+                downloader = ZenodoBackpackDownloader()
+                downloader.segment_threshold = 1000
+                out = os.path.join(tmpdirname, 'out.bin')
+                downloader._download_file(server.file_url('big.bin'), out, size=1000003, segments=4)
+                with open(big, 'rb') as f1, open(out, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+                return server.range_requests()
+
+    def _lock_file(self, directory, holder):
+        os.makedirs(directory)
+        lock_file = os.path.join(directory, zenodo_backpack.DOWNLOAD_LOCK_FILE)
+        with open(lock_file, 'w') as f:
+            json.dump(holder, f)
+        return lock_file
+
+    def test_concurrent_downloads_share_one_download(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            out = os.path.join(tmpdirname, 'out')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                # Hold the lock until both downloaders are waiting for it
+                lock_file = self._lock_file(out, {'host': socket.gethostname(), 'pid': os.getpid(), 'token': 'test'})
+                results = []
+
+                def download():
+                    downloader = LocalDownloader(server)
+                    downloader.lock_poll_interval = 0.01
+                    results.append(downloader.download_and_extract(out, 'doi'))
+
+                threads = [threading.Thread(target=download) for _ in range(2)]
+                for thread in threads:
+                    thread.start()
+                time.sleep(0.2)
+                os.remove(lock_file)
+                for thread in threads:
+                    thread.join()
+
+                content_requests = [path for path, _ in server.requests if path.endswith('/content')]
+                self.assertEqual(1, len(content_requests))
+            self.assertEqual(2, len(results))
+            self.assertEqual(results[0].base_directory, results[1].base_directory)
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+
+    def test_lock_holder_download_of_another_record_is_not_used(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            other = self._create_backpack(tmpdirname, name='other.zb.tar.gz')
+            out = os.path.join(tmpdirname, 'out')
+            with FakeZenodoServer() as server, FakeZenodoServer() as other_server:
+                server.add_file(archive)
+                other_server.add_file(other)
+                lock_file = self._lock_file(out, {'host': socket.gethostname(), 'pid': os.getpid(), 'token': 'test'})
+                results = []
+
+                def download():
+                    downloader = LocalDownloader(server)
+                    downloader.lock_poll_interval = 0.01
+                    results.append(downloader.download_and_extract(out, 'doi'))
+
+                thread = threading.Thread(target=download)
+                thread.start()
+                # The holder of the lock downloads a record of the same version with another DOI
+                LocalDownloader(other_server).download_and_extract(out, 'other doi', lock=False)
+                os.remove(lock_file)
+                thread.join()
+
+                content_requests = [path for path, _ in server.requests if path.endswith('/content')]
+                self.assertEqual(1, len(content_requests))
+            self.assertEqual(1, len(results))
+            self.assertEqual('0.1', results[0].data_version_string())
+
+    def test_stale_lock_is_broken(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+
+                # Held by a process on this host which has exited
+                process = subprocess.Popen([sys.executable, '-c', 'pass'])
+                process.wait()
+                out = os.path.join(tmpdirname, 'dead')
+                self._lock_file(out, {'host': socket.gethostname(), 'pid': process.pid, 'token': 'dead'})
+                zb = LocalDownloader(server).download_and_extract(out, 'doi', lock_timeout=5)
+                self.assertEqual('0.1', zb.data_version_string())
+
+                # Held by a process elsewhere whose heartbeat has stopped
+                out = os.path.join(tmpdirname, 'silent')
+                lock_file = self._lock_file(out, {'host': 'elsewhere', 'pid': 1, 'token': 'silent'})
+                os.utime(lock_file, (time.time() - 1000, time.time() - 1000))
+                zb = LocalDownloader(server).download_and_extract(out, 'doi', lock_timeout=5)
+                self.assertEqual('0.1', zb.data_version_string())
+                self.assertFalse(os.path.exists(lock_file))
+
+    def test_lock_timeout(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            out = os.path.join(tmpdirname, 'out')
+            self._lock_file(out, {'host': 'elsewhere', 'pid': 1, 'token': 'busy'})
+            with FakeZenodoServer() as server:
+                downloader = LocalDownloader(server)
+                downloader.lock_poll_interval = 0.01
+                with self.assertRaises(zenodo_backpack.DownloadLockTimeoutException):
+                    downloader.download_and_extract(out, 'doi', lock_timeout=0.1)
+
+    def test_interrupted_extraction_leaves_no_backpack(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            out = os.path.join(tmpdirname, 'out')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                downloader = LocalDownloader(server)
+                extract_archive = downloader._extract_archive
+
+                def extract_then_fail(*args):
+                    extract_archive(*args)
+                    raise OSError('No space left on device')
+
+                with mock.patch.object(downloader, '_extract_archive', side_effect=extract_then_fail):
+                    with self.assertRaises(OSError):
+                        downloader.download_and_extract(out, 'doi')
+                self.assertEqual([zenodo_backpack.DOWNLOAD_STAGING_DIRECTORY], os.listdir(out))
+
+                zb = downloader.download_and_extract(out, 'doi')
+            self.assertEqual('0.1', zb.data_version_string())
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+
+    def test_stale_partial_downloads_are_not_kept(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            out = os.path.join(tmpdirname, 'out')
+            staging = os.path.join(out, zenodo_backpack.DOWNLOAD_STAGING_DIRECTORY)
+            os.makedirs(staging)
+            # Left by an interrupted download of a file not in this record
+            for name in ('other.bin.part', 'other.bin.part.json'):
+                with open(os.path.join(staging, name), 'w') as f:
+                    f.write('stale')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                LocalDownloader(server).download_and_extract(out, 'doi')
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+
+    def test_segmented_download(self):
+        self.assertEqual(
+            ['bytes=0-250000', 'bytes=250001-500001', 'bytes=500002-750002', 'bytes=750003-1000002'],
+            sorted(self._download_big_file(True)))
+
+    def test_segmented_download_falls_back_without_range_support(self):
+        self.assertEqual(['bytes=0-250000'], self._download_big_file(False))
+
+    def test_download_returns_digest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                expected = server.files_metadata()[0]['checksum'].split(':')[1]
+                for progress_bar in (False, True):
+                    out = os.path.join(tmpdirname, 'out{}.tar.gz'.format(progress_bar))
+                    self.assertEqual(expected, ZenodoBackpackDownloader()._download_file(
+                        server.file_url('test_folder1.zb.tar.gz'), out, progress_bar=progress_bar))
+
+    def test_resume_interrupted_download(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                server.interruptions = [100]
+                zb = LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'out'), 'doi')
+                self.assertEqual(['bytes=100-'], server.range_requests())
+            self.assertEqual('0.1', zb.data_version_string())
+            self.assertEqual([], [f for f in os.listdir(os.path.join(tmpdirname, 'out')) if '.part' in f])
+
+    def test_download_retries(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                with self.assertRaises(ValueError):
+                    LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'out0'), 'doi',
+                                                                 download_retries=0)
+                server.interruptions = [100]
+                with self.assertRaises(zenodo_backpack.ZenodoConnectionException) as cm:
+                    LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'out1'), 'doi',
+                                                                 download_retries=1)
+                self.assertIsNotNone(cm.exception.__cause__)
+
+    def test_partial_download_longer_than_file(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                data = server.files['test_folder1.zb.tar.gz']
+                f = server.files_metadata()[0]
+                outs = [os.path.join(tmpdirname, name) for name in ('out.tar.gz', 'async.tar.gz')]
+                for out in outs:
+                    with open(out + '.part', 'wb') as part:
+                        part.write(data + b'extra')
+                    ZenodoBackpackDownloader()._save_partial_download(out + '.part', {
+                        'url': f['links']['self'], 'size': f['size'], 'checksum': f['checksum'], 'segments': None})
+                # Rejected with 416, so the partial download is started again
+                self.assertEqual(f['checksum'].split(':')[1], ZenodoBackpackDownloader()._download_file(
+                    f['links']['self'], outs[0], size=f['size'], checksum=f['checksum']))
+                self.assertEqual(['bytes={}-'.format(len(data) + 5)], server.range_requests())
+
+                if AsyncZenodoBackpackDownloader is not None:
+                    async def download():
+                        async with AsyncZenodoBackpackDownloader() as downloader:
+                            return await downloader._download_file(
+                                f['links']['self'], outs[1], size=f['size'], checksum=f['checksum'])
+                    self.assertEqual(f['checksum'].split(':')[1], asyncio.run(download()))
+            for out in outs:
+                with open(out, 'rb') as downloaded:
+                    self.assertEqual(data, downloaded.read())
+                self.assertFalse(os.path.exists(out + '.part'))
+                self.assertFalse(os.path.exists(out + '.part.json'))
+
+    def test_resume_segmented_download_in_later_run(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            big = os.path.join(tmpdirname, 'big.bin')
+            with open(big, 'wb') as f:
+                f.write(os.urandom(300000))
+            out = os.path.join(tmpdirname, 'out.bin')
+            with FakeZenodoServer() as server:
+                server.add_file(big)
+                url = server.file_url('big.bin')
+                downloader = ZenodoBackpackDownloader()
+                downloader.segment_threshold = 1000
+                server.interruptions = [140000]
+                with self.assertRaises(Exception):
+                    downloader._download_file(url, out, size=300000, segments=2, checksum='md5:x')
+                self.assertTrue(os.path.exists(out + '.part'))
+                self.assertTrue(os.path.exists(out + '.part.json'))
+
+                server.requests = []
+                downloader._download_file(url, out, size=300000, segments=2, checksum='md5:x')
+                # The first segment continues after the last whole 64 KiB chunk
+                self.assertEqual('bytes=131072-149999', sorted(server.range_requests())[0])
+                with open(big, 'rb') as f1, open(out, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+                self.assertFalse(os.path.exists(out + '.part.json'))
+
+    def test_stream_extract(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                out = os.path.join(tmpdirname, 'out')
+                zb = LocalDownloader(server).download_and_extract(out, 'doi', stream_extract=True)
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+            with open(os.path.join(zb.payload_directory_string(), 'my.shuf')) as f:
+                self.assertEqual('3\n2\n1\n4\n5\n', f.read())
+
+    def test_stream_extract_single_pass_archive(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1', single_pass=True)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                zb = LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', stream_extract=True)
+            self.assertEqual(2, len(zb.contents['md5sums']))
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_download_zstd(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.zst')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                for stream_extract in (False, True):
+                    out = os.path.join(tmpdirname, 'out{}'.format(stream_extract))
+                    zb = LocalDownloader(server).download_and_extract(out, 'doi', stream_extract=stream_extract)
+                    self.assertEqual(2, len(zb.contents['md5sums']))
+
+    def test_stream_extract_bad_payload_checksum(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'bad.zb.tar.gz')
+            contents = json.dumps({
+                'md5sums': {'/payload_directory/a': '00000000000000000000000000000000'},
+                'zenodo_backpack_version': 1, 'data_version': '0.1', 'payload_directory': 'payload_directory'}).encode()
+            with tarfile.open(archive, 'w:gz') as tf:
+                for name, data in (('bad.zb/CONTENTS.json', contents), ('bad.zb/payload_directory/a', b'a\n')):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackMalformedException):
+                    LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', stream_extract=True)
+
+    def test_verify_reports_all_mismatches(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with tarfile.open(archive) as tf:
+                tf.extractall(tmpdirname)
+            base = os.path.join(tmpdirname, 'test_folder1.zb')
+            zenodo_backpack.acquire(path=base, md5sum=True, max_workers=2)
+
+            payload = os.path.join(base, 'payload_directory')
+            with open(os.path.join(payload, 'my.shuf'), 'a') as f:
+                f.write('6\n')
+            os.remove(os.path.join(payload, '4'))
+            for use_processes in (False, True):
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException) as cm:
+                    ZenodoBackpackDownloader().verify(zenodo_backpack.acquire(path=base), max_workers=2, use_processes=use_processes)
+                self.assertEqual(['/payload_directory/my.shuf'], cm.exception.mismatched)
+                self.assertEqual(['/payload_directory/4'], cm.exception.missing)
+
+    def test_verification_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with tarfile.open(archive) as tf:
+                tf.extractall(tmpdirname)
+            base = os.path.join(tmpdirname, 'test_folder1.zb')
+            hashed = mock.patch.object(zenodo_backpack.downloader, '_hash_payload_file',
+                                       wraps=zenodo_backpack.downloader._hash_payload_file)
+
+            with hashed as m:
+                zenodo_backpack.acquire(path=base, md5sum=True, verification_cache=True)
+                self.assertEqual(2, m.call_count)
+            self.assertTrue(os.path.exists(os.path.join(base, zenodo_backpack.VERIFICATION_CACHE_FILE)))
+            with hashed as m:
+                zenodo_backpack.acquire(path=base, md5sum=True, verification_cache=True)
+                self.assertEqual(0, m.call_count)
+            with hashed as m:
+                zenodo_backpack.acquire(path=base, md5sum=True, verification_cache=True, full=True)
+                self.assertEqual(2, m.call_count)
+
+            with open(os.path.join(base, 'payload_directory', 'my.shuf'), 'a') as f:
+                f.write('6\n')
+            with hashed as m:
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException):
+                    zenodo_backpack.acquire(path=base, md5sum=True, verification_cache=True)
+                self.assertEqual(1, m.call_count)
+
+    def test_quick_verify(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with tarfile.open(archive) as tf:
+                tf.extractall(tmpdirname)
+            base = os.path.join(tmpdirname, 'test_folder1.zb')
+            with mock.patch.object(zenodo_backpack.downloader, '_hash_payload_file',
+                                   wraps=zenodo_backpack.downloader._hash_payload_file) as m:
+                zenodo_backpack.acquire(path=base, verify='quick')
+                # Of two small files, only one is sampled
+                self.assertEqual(1, m.call_count)
+                # Files without chunk checksums which are too large to sample
+                # are not read whole, but reported
+                with mock.patch.object(zenodo_backpack.downloader, 'QUICK_VERIFY_MAX_FILE_SIZE', 1), \
+                        self.assertLogs(level='WARNING') as logs:
+                    zenodo_backpack.acquire(path=base, verify='quick')
+                self.assertEqual(1, m.call_count)
+                self.assertTrue(any('chunk_size' in line for line in logs.output))
+            with self.assertRaises(ValueError):
+                zenodo_backpack.acquire(path=base, verify='sometimes')
+
+            os.remove(os.path.join(base, 'payload_directory', '4'))
+            with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException) as cm:
+                zenodo_backpack.acquire(path=base, verify='quick')
+            self.assertEqual(['/payload_directory/4'], cm.exception.missing)
+            with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException):
+                zenodo_backpack.acquire(path=base, verify='full')
+
+    def test_update_with_delta(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            out = os.path.join(tmpdirname, 'out')
+            os.mkdir(out)
+            with tarfile.open(self._create_backpack(tmpdirname)) as tf:
+                tf.extractall(out)
+            installed = zenodo_backpack.acquire(path=os.path.join(out, 'test_folder1.zb'))
+            unchanged_inode = os.stat(os.path.join(installed.payload_directory_string(), '4')).st_ino
+
+            changed = os.path.join(tmpdirname, 'new', 'test_folder1')
+            shutil.copytree(os.path.join(DATA_DIRECTORY, 'test_folder1'), changed)
+            with open(os.path.join(changed, 'my.shuf'), 'a') as f:
+                f.write('6\n')
+            archive = os.path.join(tmpdirname, 'new', 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(changed, archive, '0.2', delta_from=installed.base_directory)
+
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                server.add_file(os.path.join(tmpdirname, 'new', 'test_folder1.zbdelta.tar.gz'))
+                zb = LocalDownloader(server, version='0.2').update(installed, 'doi')
+                downloaded = [path for path, _ in server.requests]
+
+                # Full downloads, or updates from another version, ignore the delta
+                other = os.path.join(tmpdirname, 'other')
+                with tarfile.open(self._create_backpack(tmpdirname, 'old.zb.tar.gz', version='0.0')) as tf:
+                    tf.extractall(other)
+                server.requests.clear()
+                LocalDownloader(server, version='0.2').update(
+                    zenodo_backpack.acquire(path=os.path.join(other, 'test_folder1.zb')), 'doi')
+                self.assertEqual(['/api/records/1/files/test_folder1.zb.tar.gz/content'],
+                                 [path for path, _ in server.requests if not path.endswith('zbdelta.tar.gz/content')])
+                self.assertEqual('0.2', zenodo_backpack.acquire(path=os.path.join(other, 'test_folder1.zb'), md5sum=True)
+                                 .data_version_string())
+
+            self.assertEqual(['/api/records/1/files/test_folder1.zbdelta.tar.gz/content'], downloaded)
+            self.assertEqual('0.2', zb.data_version_string())
+            self.assertEqual(os.path.join(out, 'test_folder1.zb'), zb.base_directory)
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+            self.assertEqual(sorted([zenodo_backpack.DOWNLOAD_SOURCE_FILE, 'CONTENTS.json', 'payload_directory']),
+                             sorted(os.listdir(zb.base_directory)))
+            zenodo_backpack.acquire(path=zb.base_directory, md5sum=True)
+            self.assertEqual(unchanged_inode, os.stat(os.path.join(zb.payload_directory_string(), '4')).st_ino)
+            with open(os.path.join(zb.payload_directory_string(), 'my.shuf')) as f:
+                self.assertTrue(f.read().endswith('6\n'))
+
+    def test_open_remote(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1', index=True)
+            for support_range in (True, False):
+                out = os.path.join(tmpdirname, 'remote{}'.format(support_range))
+                with FakeZenodoServer(support_range=support_range) as server:
+                    server.add_file(archive)
+                    server.add_file(os.path.join(tmpdirname, 'test_folder1.zbindex.json'))
+                    zb = LocalDownloader(server).open_remote(out, 'doi')
+                    self.assertEqual('0.1', zb.data_version_string())
+                    path = zb.fetch('my.shuf')
+                    self.assertEqual(path, zb.fetch('my.shuf'))
+                    with zb.open('my.shuf') as f, open(os.path.join(DATA_DIRECTORY, 'test_folder1', 'my.shuf'), 'rb') as g:
+                        self.assertEqual(g.read(), f.read())
+                    with self.assertRaises(FileNotFoundError):
+                        zb.fetch('missing')
+                    with self.assertRaises(FileNotFoundError):
+                        zb.fetch('../CONTENTS.json')
+                    requests = [path for path, _ in server.requests]
+
+                # The index and CONTENTS.json, then my.shuf once
+                self.assertEqual(['/api/records/1/files/test_folder1.zbindex.json/content'] +
+                                 ['/api/records/1/files/test_folder1.zb.tar.gz/content'] * 2, requests)
+                self.assertEqual(['my.shuf'], os.listdir(zb.payload_directory_string()))
+
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                server.add_file(os.path.join(tmpdirname, 'test_folder1.zbindex.json'))
+                # Fetched files are reused, and full downloads skip the index
+                zb = LocalDownloader(server).open_remote(out, 'doi')
+                zb.fetch('my.shuf')
+                self.assertEqual([], server.requests)
+                zb = LocalDownloader(server).download_and_extract(os.path.join(tmpdirname, 'full'), 'doi')
+                self.assertEqual(['test_folder1.zb'], os.listdir(os.path.join(tmpdirname, 'full')))
+
+    @unittest.skipIf(AsyncZenodoBackpackDownloader is None, 'aiohttp is not installed')
+    def test_async_download_and_extract(self):
+        async def download_two(server, tmpdirname):
+            async with LocalAsyncDownloader(server) as downloader:
+                return await asyncio.gather(
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'out1'), 'doi'),
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'out2'), 'doi', max_workers=2))
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                # Leave a partial download behind, as an interrupted run would
+                f = server.files_metadata()[0]
+                part_file = os.path.join(tmpdirname, 'out1', zenodo_backpack.DOWNLOAD_STAGING_DIRECTORY,
+                                         'test_folder1.zb.tar.gz.part')
+                os.makedirs(os.path.dirname(part_file))
+                with open(part_file, 'wb') as out:
+                    out.write(server.files['test_folder1.zb.tar.gz'][:100])
+                ZenodoBackpackDownloader()._save_partial_download(part_file, {
+                    'url': f['links']['self'], 'size': f['size'], 'checksum': f['checksum'], 'segments': None})
+                backpacks = asyncio.run(download_two(server, tmpdirname))
+                self.assertEqual(['bytes=100-'], server.range_requests())
+            self.assertEqual(['0.1', '0.1'], [zb.data_version_string() for zb in backpacks])
+            self.assertEqual(['test_folder1.zb'], os.listdir(os.path.join(tmpdirname, 'out1')))
+
+    @unittest.skipIf(AsyncZenodoBackpackDownloader is None, 'aiohttp is not installed')
+    def test_async_downloads_share_lock(self):
+        async def download_twice(server, out):
+            async with LocalAsyncDownloader(server) as downloader:
+                downloader._downloader.lock_poll_interval = 0.05
+                return await asyncio.gather(downloader.download_and_extract(out, 'doi'),
+                                            downloader.download_and_extract(out, 'doi'))
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            out = os.path.join(tmpdirname, 'out')
+            with FakeZenodoServer(latency=0.2) as server:
+                server.add_file(archive)
+                backpacks = asyncio.run(download_twice(server, out))
+                downloads = [path for path, _ in server.requests if path.endswith('/content')]
+            self.assertEqual(1, len(downloads))
+            self.assertEqual([backpacks[0].base_directory] * 2, [zb.base_directory for zb in backpacks])
+            self.assertEqual(['test_folder1.zb'], os.listdir(out))
+
+    def test_metadata_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            cache_dir = os.path.join(tmpdirname, 'cache')
+            with FakeZenodoServer() as server:
+                server.add_file(self._create_backpack(tmpdirname))
+                downloader = CachingDownloader(server, metadata_cache_directory=cache_dir)
+                downloader.download_and_extract(os.path.join(tmpdirname, 'a'), 'doi')
+                downloader.download_and_extract(os.path.join(tmpdirname, 'b'), 'doi')
+                self.assertEqual(1, len(server.record_requests()))
+
+                # Once stale, the record is revalidated with its ETag
+                downloader = CachingDownloader(server, metadata_cache_directory=cache_dir, metadata_cache_ttl=0)
+                downloader.download_and_extract(os.path.join(tmpdirname, 'c'), 'doi')
+                requests = server.record_requests()
+                self.assertEqual(2, len(requests))
+                self.assertIn('If-None-Match', requests[1][1])
+
+                # A changed record is fetched again
+                server.version = '0.2'
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackMalformedException):
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'd'), 'doi')
+                self.assertEqual('0.2', downloader.metadata_cache.get('doi', None)['metadata']['metadata']['version'])
+
+            # Offline, the cache is used without contacting the server
+            downloader = CachingDownloader(server, metadata_cache_directory=cache_dir, offline=True)
+            metadata, files = downloader._resolve_metadata('doi', None)
+            self.assertEqual('0.2', metadata['metadata']['version'])
+            with self.assertRaises(zenodo_backpack.ZenodoConnectionException):
+                downloader._resolve_metadata('other doi', None)
+
+    def test_metadata_cache_written_by_threads(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = zenodo_backpack.MetadataCache(cache_dir)
+
+            def put():
+                for _ in range(50):
+                    cache.put('doi', None, '1', None, {'metadata': {'version': '0.1'}})
+
+            with mock.patch.object(zenodo_backpack.metadata_cache.logging, 'warning') as warning:
+                threads = [threading.Thread(target=put) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(0, warning.call_count)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            self.assertEqual('1', cache.get('doi', None)['record_id'])
+
+    def test_offline_requires_metadata_cache(self):
+        with self.assertRaises(ValueError):
+            ZenodoBackpackDownloader(offline=True)
+
+    def test_local_download_by_doi(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            old = self._create_backpack(tmpdirname, name='old.zb.tar.gz', version='0.1')
+            new = self._create_backpack(tmpdirname, name='new.zb.tar.gz', version='0.2')
+            with FakeZenodoServer(version='0.2') as server:
+                server.add_file(new)
+                server.add_record(2, '0.1', [old], doi='10.5281/zenodo.2')
+                downloader = server.downloader()
+
+                self.assertEqual('1', downloader._retrieve_record_ID('10.5281/zenodo.1'))
+                self.assertEqual('2', downloader._retrieve_record_ID('10.5281/zenodo.2'))
+                _, files = downloader._retrieve_record_metadata('1', '0.1')
+                self.assertEqual(['old.zb.tar.gz'], [f['key'] for f in files])
+
+                zb = downloader.download_and_extract(os.path.join(tmpdirname, 'newest'), '10.5281/zenodo.1')
+                self.assertEqual('0.2', zb.data_version_string())
+                zb = downloader.download_and_extract(os.path.join(tmpdirname, 'pinned'), '10.5281/zenodo.2', version='0.1')
+                self.assertEqual('0.1', zb.data_version_string())
+                with self.assertRaises(zenodo_backpack.ZenodoBackpackVersionException):
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'missing'), '10.5281/zenodo.1', version='0.3')
+
+    def test_server_latency_and_bandwidth(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            data = os.path.join(tmpdirname, 'data.bin')
+            with open(data, 'wb') as f:
+                f.write(os.urandom(100000))
+            with FakeZenodoServer(latency=0.2, bandwidth=200000) as server:
+                server.add_file(data)
+                start = time.time()
+                server.downloader()._download_file(server.file_url('data.bin'), os.path.join(tmpdirname, 'out.bin'))
+                self.assertGreater(time.time() - start, 0.6)
+
+    def test_events(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            received = []
+            metrics = zenodo_backpack.Metrics()
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                size = len(server.files['test_folder1.zb.tar.gz'])
+                server.interruptions = [100]
+                downloader = server.downloader(callbacks=[received.append, metrics],
+                                               retry_policy=zenodo_backpack.RetryPolicy(backoff=0.01))
+                zb = downloader.download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', progress_bar=True)
+
+            ends = [(e['phase'], e.get('file')) for e in received if e['event'] == 'end']
+            self.assertEqual([
+                ('resolve_doi', None),
+                ('fetch_metadata', None),
+                ('download', 'test_folder1.zb.tar.gz'),
+                ('extract', 'test_folder1.zb.tar.gz'),
+                ('verify', None),
+            ], ends)
+            # Progress of the interrupted attempt is taken back before the retry
+            progress = [e['bytes'] for e in received if e['event'] == 'progress']
+            self.assertEqual(size, sum(progress))
+            self.assertIn(-100, progress)
+
+            summary = metrics.summary()
+            self.assertEqual(size, summary['download']['bytes'])
+            payload_size = sum(os.path.getsize(os.path.join(root, name))
+                               for root, _, names in os.walk(zb.payload_directory_string()) for name in names)
+            self.assertEqual(payload_size, summary['verify']['bytes'])
+            self.assertEqual(1, summary['extract']['count'])
+
+    @unittest.skipIf(AsyncZenodoBackpackDownloader is None, 'aiohttp is not installed')
+    def test_async_events(self):
+        async def download(server, out, callbacks):
+            async with LocalAsyncDownloader(server, callbacks=callbacks) as downloader:
+                return await downloader.download_and_extract(out, 'doi')
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = self._create_backpack(tmpdirname)
+            received = []
+            metrics = zenodo_backpack.Metrics()
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                size = len(server.files['test_folder1.zb.tar.gz'])
+                asyncio.run(download(server, os.path.join(tmpdirname, 'out'), [received.append, metrics]))
+
+            ends = [(e['phase'], e.get('file')) for e in received if e['event'] == 'end']
+            self.assertEqual([
+                ('resolve_doi', None),
+                ('fetch_metadata', None),
+                ('download', 'test_folder1.zb.tar.gz'),
+                ('extract', 'test_folder1.zb.tar.gz'),
+                ('verify', None),
+            ], ends)
+            self.assertEqual(size, sum(e['bytes'] for e in received if e['event'] == 'progress'))
+            self.assertEqual(size, metrics.summary()['download']['bytes'])
+
+    def test_event_error(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with tarfile.open(self._create_backpack(tmpdirname)) as tf:
+                tf.extractall(tmpdirname)
+            zb = zenodo_backpack.ZenodoBackpack(os.path.join(tmpdirname, 'test_folder1.zb'))
+            with open(os.path.join(zb.payload_directory_string(), 'my.shuf'), 'a') as f:
+                f.write('extra')
+            received = []
+            with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException):
+                ZenodoBackpackDownloader(callbacks=[received.append]).verify(zb)
+            # Hashing finished, so the phase ended even though verification failed
+            self.assertEqual(['start', 'end'], [e['event'] for e in received])
+
     def test_newest_version(self):
         doi = '10.5281/zenodo.5523588'
 
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+import unittest
+import os.path
+import sys
+import tempfile
+import tarfile
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+import zenodo_backpack
+from zenodo_backpack import ZenodoBackpackCreator
+from zenodo_backpack.manifest import Manifest, write_manifest
+from fake_zenodo import FakeZenodoServer
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+EXPECTED_MD5SUMS = {
+    '/payload_directory/4': '302c28003d487124d97c242de94da856',
+    '/payload_directory/my.shuf': 'd3d0fa09972d97430e8d7449051084b6',
+}
+
+
+class Tests(unittest.TestCase):
+    def test_write_and_read(self):
+        checksums = {'/p/b': '00' * 16, '/p/a/z': '11' * 16, '/p/a-b': '22' * 16, '/p/a/y/x': '33' * 16}
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = os.path.join(tmpdirname, 'CONTENTS.zbm')
+            write_manifest(path, {'data_version': '1.0'}, checksums)
+            with Manifest(path) as manifest:
+                self.assertEqual({'data_version': '1.0'}, manifest.metadata)
+                self.assertEqual(4, len(manifest))
+                # Files in a directory come together, whatever characters sort before '/'
+                self.assertEqual(['/p/a/y/x', '/p/a/z', '/p/a-b', '/p/b'], list(manifest))
+                self.assertEqual(checksums, dict(manifest.items()))
+                for path_in_backpack, digest in checksums.items():
+                    self.assertIn(path_in_backpack, manifest)
+                    self.assertEqual(digest, manifest[path_in_backpack])
+                self.assertNotIn('/p/a', manifest)
+                self.assertIsNone(manifest.get('/p/c'))
+                with self.assertRaises(KeyError):
+                    manifest['/p']
+
+    def test_truncated(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            path = os.path.join(tmpdirname, 'CONTENTS.zbm')
+            write_manifest(path, {}, {'/p/a': '00' * 16})
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with self.assertRaises(ValueError):
+                Manifest(path)
+
+    def test_create_with_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'out.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1', manifest=True)
+            with tarfile.open(archive) as tf:
+                self.assertEqual(['test_folder1.zb/CONTENTS.json', 'test_folder1.zb/CONTENTS.zbm'], tf.getnames()[:2])
+                tf.extractall(tmpdirname)
+
+            zb = zenodo_backpack.acquire(path=os.path.join(tmpdirname, 'test_folder1.zb'), md5sum=True, version='0.1')
+            self.assertEqual('0.1', zb.data_version_string())
+            self.assertTrue(zb.payload_directory_string().endswith('payload_directory'))
+            self.assertEqual(EXPECTED_MD5SUMS, dict(zb.checksums().items()))
+            # Only the manifest was read
+            self.assertIsNone(zb._contents)
+            self.assertEqual(EXPECTED_MD5SUMS, zb.contents['md5sums'])
+
+            with open(os.path.join(zb.payload_directory_string(), '4'), 'a') as f:
+                f.write('changed')
+            with self.assertRaises(zenodo_backpack.ZenodoBackpackChecksumException) as cm:
+                zenodo_backpack.acquire(path=zb.base_directory, md5sum=True)
+            self.assertEqual(['/payload_directory/4'], cm.exception.mismatched)
+
+    def test_stream_extract_with_manifest(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1',
+                                           single_pass=True, manifest=True)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                zb = server.downloader().download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', stream_extract=True)
+            self.assertIsNotNone(zb.manifest)
+            self.assertEqual(EXPECTED_MD5SUMS, dict(zb.checksums().items()))
+
+
+    def test_stream_extract_other_hash_algorithm(self):
+        # CONTENTS.json comes last, so files are first hashed with md5 and then again
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1',
+                                           single_pass=True, hash_algorithm='sha256')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                zb = server.downloader().download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', stream_extract=True)
+            self.assertEqual('sha256', zb.hash_algorithm())
+            self.assertEqual(64, len(zb.checksums()['/payload_directory/4']))
+
+
+if __name__ == "__main__":
+    unittest.main()
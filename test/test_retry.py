@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import sys
+import tempfile
+import time
+import email.utils
+import errno
+import socket
+from unittest import mock
+
+import requests
+import urllib3
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from zenodo_backpack import ZenodoBackpackDownloader, ZenodoBackpackCreator, ZenodoConnectionException, \
+    ZenodoDownloadException, RetryPolicy
+import zenodo_backpack.retry
+
+from fake_zenodo import FakeZenodoServer
+from test_downloader import LocalDownloader, DATA_DIRECTORY
+
+try:
+    import asyncio
+    from zenodo_backpack.aio import AsyncZenodoBackpackDownloader
+    from test_downloader import LocalAsyncDownloader
+except ImportError:
+    AsyncZenodoBackpackDownloader = None
+
+
+def fast_downloader(server, **kwargs):
+    downloader = ZenodoBackpackDownloader(retry_policy=RetryPolicy(backoff=0.01, **kwargs))
+    downloader.records_url = server.records_url
+    return downloader
+
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_retry_throttled_metadata_request(self):
+        with FakeZenodoServer() as server:
+            server.errors = [429, 503]
+            server.retry_after = 0
+            self.assertEqual('0.1', fast_downloader(server)._retrieve_record_json('1')['metadata']['version'])
+            self.assertEqual(3, len(server.record_requests()))
+
+    def test_retry_connection_reset(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            data = os.path.join(tmpdirname, 'data.bin')
+            with open(data, 'wb') as f:
+                f.write(os.urandom(10000))
+            with FakeZenodoServer() as server:
+                server.add_file(data)
+                server.errors = ['reset', 502]
+                out = os.path.join(tmpdirname, 'out.bin')
+                fast_downloader(server)._download_file(server.file_url('data.bin'), out)
+                with open(data, 'rb') as f1, open(out, 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+                self.assertEqual(3, len(server.requests))
+
+    def test_errors_not_worth_retrying(self):
+        with FakeZenodoServer() as server:
+            server.errors = [404]
+            with self.assertRaises(ZenodoConnectionException):
+                fast_downloader(server)._retrieve_record_json('1')
+            self.assertEqual(1, len(server.requests))
+
+    def test_attempts_and_budget(self):
+        with FakeZenodoServer() as server:
+            server.errors = [500] * 10
+            with self.assertRaises(ZenodoConnectionException):
+                fast_downloader(server, attempts=3)._retrieve_record_json('1')
+            self.assertEqual(3, len(server.requests))
+
+            # The budget is shared between requests
+            server.requests = []
+            downloader = fast_downloader(server, budget=3)
+            for _ in range(2):
+                with self.assertRaises(ZenodoConnectionException):
+                    downloader._retrieve_record_json('1')
+            self.assertEqual(5, len(server.requests))
+
+    def test_long_retry_after_is_not_waited_for(self):
+        with FakeZenodoServer() as server:
+            server.errors = [429]
+            server.retry_after = 3600
+            start = time.time()
+            with self.assertRaises(ZenodoConnectionException):
+                fast_downloader(server)._retrieve_record_json('1')
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(1, len(server.requests))
+
+    def test_throttling_pauses_host(self):
+        with FakeZenodoServer() as server:
+            server.errors = [429]
+            server.retry_after = 0.3
+            downloader = fast_downloader(server)
+            start = time.time()
+            downloader._retrieve_record_json('1')
+            # Later requests to the same host wait out the delay too
+            downloader.retry_policy.pause_host(server.url, 0.3)
+            downloader._retrieve_record_json('1')
+            self.assertGreater(time.time() - start, 0.6)
+
+    def test_retry_after_date(self):
+        response = mock.Mock(headers={'Retry-After': email.utils.formatdate(time.time() + 30, usegmt=True)})
+        self.assertAlmostEqual(30, RetryPolicy().retry_after_delay(response), delta=2)
+        response = mock.Mock(headers={'Retry-After': 'soon'})
+        self.assertIsNone(RetryPolicy().retry_after_delay(response))
+
+    def test_download_and_extract_through_throttling(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                server.errors = [429, 'reset']
+                server.retry_after = 0
+                server.interruptions = [100]
+                downloader = LocalDownloader(server, retry_policy=RetryPolicy(backoff=0.01))
+                # Three failed attempts, each counted once
+                zb = downloader.download_and_extract(os.path.join(tmpdirname, 'out'), 'doi', download_retries=4)
+                self.assertEqual(4, len([path for path, _ in server.requests if path.endswith('/content')]))
+            self.assertEqual('0.1', zb.data_version_string())
+
+
+    def _archive(self, tmpdirname):
+        archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+        ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+        return archive
+
+    def _content_requests(self, server):
+        return [path for path, _ in server.requests if path.endswith('/content')]
+
+    def test_download_attempts(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with FakeZenodoServer() as server:
+                server.add_file(self._archive(tmpdirname))
+                downloader = LocalDownloader(server, retry_policy=RetryPolicy(backoff=0.01))
+
+                # Statuses not worth retrying fail at once
+                server.errors = [404]
+                with self.assertRaises(ZenodoDownloadException) as cm:
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'out1'), 'doi')
+                self.assertEqual(404, cm.exception.status)
+                self.assertEqual(1, len(self._content_requests(server)))
+
+                # download_retries is the only count of attempts
+                server.requests = []
+                server.errors = [503] * 10
+                with self.assertRaises(ZenodoConnectionException):
+                    downloader.download_and_extract(os.path.join(tmpdirname, 'out2'), 'doi', download_retries=3)
+                self.assertEqual(3, len(self._content_requests(server)))
+
+                # Nor are disk errors retried
+                server.requests = []
+                server.errors = []
+                with mock.patch.object(zenodo_backpack.downloader.shutil, 'copyfileobj',
+                                       side_effect=OSError(errno.ENOSPC, 'No space left on device')):
+                    with self.assertRaises(OSError) as cm:
+                        downloader.download_and_extract(os.path.join(tmpdirname, 'out3'), 'doi')
+                self.assertEqual(errno.ENOSPC, cm.exception.errno)
+                self.assertEqual(1, len(self._content_requests(server)))
+
+    def test_name_resolution_is_not_retried(self):
+        gaierror = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        error = requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(
+            None, 'https://zenodo.invalid/', urllib3.exceptions.NewConnectionError(None, str(gaierror))))
+        error.args[0].reason.__context__ = gaierror
+        self.assertFalse(zenodo_backpack.retry.is_retryable(error))
+        self.assertIsNone(RetryPolicy().error_retry_delay('https://zenodo.invalid/', 0, error))
+        self.assertTrue(zenodo_backpack.retry.is_retryable(requests.exceptions.ConnectionError('reset')))
+
+    @unittest.skipIf(AsyncZenodoBackpackDownloader is None, 'aiohttp is not installed')
+    def test_async_download_attempts(self):
+        async def download(server, out, **kwargs):
+            async with LocalAsyncDownloader(server, retry_policy=RetryPolicy(backoff=0.01)) as downloader:
+                return await downloader.download_and_extract(out, 'doi', **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with FakeZenodoServer() as server:
+                server.add_file(self._archive(tmpdirname))
+                server.errors = [404]
+                with self.assertRaises(ZenodoDownloadException):
+                    asyncio.run(download(server, os.path.join(tmpdirname, 'out1')))
+                self.assertEqual(1, len(self._content_requests(server)))
+
+                server.requests = []
+                server.errors = [503] * 10
+                with self.assertRaises(ZenodoConnectionException):
+                    asyncio.run(download(server, os.path.join(tmpdirname, 'out2'), download_retries=3))
+                self.assertEqual(3, len(self._content_requests(server)))
+
+    def _async_download(self, server, out, retry_policy):
+        async def download():
+            async with AsyncZenodoBackpackDownloader(retry_policy=retry_policy) as downloader:
+                downloader._downloader.doi_resolver_url = server.doi_resolver_url
+                downloader._downloader.records_url = server.records_url
+                return await downloader.download_and_extract(out, 'doi')
+        return asyncio.run(download())
+
+    @unittest.skipIf(AsyncZenodoBackpackDownloader is None, 'aiohttp is not installed')
+    def test_async_download_through_throttling(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                # Throttled while resolving the DOI, then the download is cut short
+                server.errors = [429, 503]
+                server.retry_after = 0.3
+                server.interruptions = [100]
+                start = time.time()
+                zb = self._async_download(server, os.path.join(tmpdirname, 'out'), RetryPolicy(backoff=0.01))
+                self.assertEqual('0.1', zb.data_version_string())
+                # Retry-After was waited for, twice
+                self.assertGreater(time.time() - start, 0.6)
+                self.assertEqual(2, len([path for path, _ in server.requests if path.endswith('/content')]))
+
+                # Retries are spent from the budget of the policy
+                server.requests = []
+                server.errors = [500] * 10
+                with self.assertRaises(ZenodoConnectionException):
+                    self._async_download(server, os.path.join(tmpdirname, 'out2'), RetryPolicy(backoff=0.01, budget=2))
+                self.assertEqual(3, len(server.requests))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+import unittest
+import os.path
+import sys
+import json
+import subprocess
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path = [ROOT] + sys.path
+
+import zenodo_backpack
+
+# Prints the modules newly imported by importing the package and running the
+# code given as the first argument
+IMPORTED_MODULES_SCRIPT = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+before = set(sys.modules)
+import zenodo_backpack
+exec(sys.argv[2])
+print(json.dumps(sorted(set(sys.modules) - before)))
+'''
+
+HEAVY_MODULES = ('requests', 'tqdm', 'tarfile', 'tempfile', 'zenodo_backpack.downloader', 'zenodo_backpack.creator')
+
+
+class Tests(unittest.TestCase):
+    def imported_modules(self, code=''):
+        result = subprocess.run([sys.executable, '-c', IMPORTED_MODULES_SCRIPT, ROOT, code],
+                                check=True, stdout=subprocess.PIPE)
+        return json.loads(result.stdout.decode())
+
+    def test_import_is_light(self):
+        imported = self.imported_modules()
+        self.assertEqual([], [m for m in HEAVY_MODULES if m in imported])
+
+    def test_acquire_is_light(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            with open(os.path.join(tmpdirname, 'CONTENTS.json'), 'w') as f:
+                json.dump({'payload_directory': 'payload_directory', 'data_version': '1.0',
+                           'zenodo_backpack_version': 1, 'md5sums': {}}, f)
+            imported = self.imported_modules(
+                'zb = zenodo_backpack.acquire(path={!r}, version="1.0"); zb.payload_directory_string()'.format(tmpdirname))
+            self.assertEqual([], [m for m in HEAVY_MODULES if m in imported])
+
+    def test_command_line_is_light(self):
+        # Building the parser must not import requests for every sub-command
+        script = os.path.join(ROOT, 'bin', 'zenodo_backpack')
+        imported = self.imported_modules(
+            'import contextlib, io, runpy; sys.argv = [{0!r}, "--version"]\n'
+            'with contextlib.redirect_stdout(io.StringIO()):\n'
+            '    try:\n        runpy.run_path({0!r}, run_name="__main__")\n    except SystemExit:\n        pass'.format(script))
+        self.assertEqual([], [m for m in ('requests', 'zenodo_backpack.downloader', 'zenodo_backpack.batch')
+                              if m in imported])
+
+    def test_lazy_names(self):
+        self.assertIs(zenodo_backpack.ZenodoBackpackDownloader, zenodo_backpack.downloader.ZenodoBackpackDownloader)
+        self.assertIs(zenodo_backpack.ZenodoBackpackCreator, zenodo_backpack.creator.ZenodoBackpackCreator)
+        self.assertEqual(4, zenodo_backpack.DOWNLOAD_SEGMENTS)
+        self.assertIn('ZenodoBackpackDownloader', dir(zenodo_backpack))
+        with self.assertRaises(AttributeError):
+            zenodo_backpack.no_such_name
+
+
+if __name__ == "__main__":
+    unittest.main()
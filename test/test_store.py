@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+import unittest
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+from unittest import mock
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+import zenodo_backpack
+from zenodo_backpack import ZenodoBackpackCreator, ObjectStore
+from fake_zenodo import FakeZenodoServer
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+class Tests(unittest.TestCase):
+    def _inodes(self, zb):
+        payload = zb.payload_directory_string()
+        return {name: os.stat(os.path.join(payload, name)).st_ino for name in sorted(os.listdir(payload))}
+
+    def test_downloads_share_objects(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            archive = os.path.join(tmpdirname, 'test_folder1.zb.tar.gz')
+            ZenodoBackpackCreator().create(os.path.join(DATA_DIRECTORY, 'test_folder1'), archive, '0.1')
+            store_directory = os.path.join(tmpdirname, 'store')
+            store = ObjectStore(store_directory)
+            with FakeZenodoServer() as server:
+                server.add_file(archive)
+                downloader = server.downloader(object_store_directory=store_directory)
+                first = downloader.download_and_extract(os.path.join(tmpdirname, 'first'), 'doi')
+                second = downloader.download_and_extract(os.path.join(tmpdirname, 'second'), 'doi')
+                streamed = downloader.download_and_extract(os.path.join(tmpdirname, 'streamed'), 'doi', stream_extract=True)
+
+            self.assertEqual(self._inodes(first), self._inodes(second))
+            self.assertEqual(self._inodes(first), self._inodes(streamed))
+            for key, digest in first.checksums().items():
+                path = os.path.join(first.base_directory, key[1:])
+                self.assertTrue(store.holds(path, 'md5', digest))
+                self.assertEqual(4, os.stat(path).st_nlink)
+                self.assertFalse(os.stat(path).st_mode & stat.S_IWUSR)
+
+            # Files linked to the store are not hashed again
+            with mock.patch.object(zenodo_backpack.downloader, '_hash_payload_file',
+                                   wraps=zenodo_backpack.downloader._hash_payload_file) as m:
+                downloader.verify(second)
+                self.assertEqual(0, m.call_count)
+                zenodo_backpack.ZenodoBackpackDownloader().verify(second)
+                self.assertEqual(2, m.call_count)
+
+            self.assertEqual((0, 0), store.collect_garbage())
+            for backpack in (first, second, streamed):
+                shutil.rmtree(backpack.base_directory)
+            self.assertEqual((2, 18), store.collect_garbage(dry_run=True))
+            self.assertEqual((2, 18), store.collect_garbage())
+            self.assertEqual([], os.listdir(os.path.join(store_directory, 'objects', 'md5')))
+
+    def test_add_links_existing_object(self):
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            store = ObjectStore(os.path.join(tmpdirname, 'store'))
+            paths = [os.path.join(tmpdirname, name) for name in ('a', 'b')]
+            for path in paths:
+                with open(path, 'w') as f:
+                    f.write('same')
+                store.add(path, 'md5', '1a2b' * 8)
+            self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+            self.assertEqual(3, os.stat(paths[0]).st_nlink)
+            self.assertEqual([], [name for name in os.listdir(tmpdirname) if name.endswith('.tmp')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,383 @@
+'''asyncio interface for downloading backpacks from within an event loop.
+
+Metadata requests and file downloads are coroutines using the optional
+aiohttp package, retried under the same RetryPolicy as blocking requests.
+Writing, hashing, extraction and verification run in an executor so that
+the event loop is never blocked on disk or CPU, and share their
+implementation with ZenodoBackpackDownloader.
+'''
+
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+
+import aiohttp
+
+from . import compression
+from . import events
+from .backpack import ZenodoBackpackMalformedException, ZenodoConnectionException, ZenodoDownloadException
+from .delta import is_delta_archive
+from .downloader import ZenodoBackpackDownloader, _FileProgress
+from .retry import is_retryable
+
+# Downloaded data is passed to the executor in pieces of about this size
+WRITE_BLOCK_SIZE = 1024 * 1024
+# Exceptions raised by aiohttp which may succeed when tried again
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+def _write_and_hash(f, hasher, data):
+    hasher.update(data)
+    f.write(data)
+
+
+def _hash_existing(hasher, path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(WRITE_BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+
+
+def _finish_download(part_file, out_file):
+    os.replace(part_file, out_file)
+    os.remove(part_file + '.json')
+
+
+class AsyncZenodoBackpackDownloader:
+    '''Coroutine counterpart of ZenodoBackpackDownloader.
+
+    Use as an async context manager, or call close() when done, to release the
+    aiohttp session. A session to share with other code can be passed in
+    instead, in which case it is not closed.
+
+    Example:
+        async with AsyncZenodoBackpackDownloader() as downloader:
+            backpacks = await asyncio.gather(
+                downloader.download_and_extract('/data/a', '10.5281/zenodo.1'),
+                downloader.download_and_extract('/data/b', '10.5281/zenodo.2'))
+    '''
+
+    def __init__(self, session=None, executor=None, retry_policy=None, callbacks=None):
+        '''
+        Parameters
+        ----------
+        session: aiohttp.ClientSession
+            Session to make requests with. If None, one is created when needed.
+        executor: concurrent.futures.Executor
+            Where to run blocking work. If None, the event loop's default
+            executor is used.
+        retry_policy: None or RetryPolicy
+            When to retry failed requests, as for ZenodoBackpackDownloader.
+            A policy may be shared with blocking downloaders, so that they
+            share its retry budget and hold back from a throttling host
+            together.
+        callbacks: None or list
+            Functions called with each event reporting the progress and
+            timing of the work, as for ZenodoBackpackDownloader. See
+            zenodo_backpack.events.
+        '''
+        self._downloader = ZenodoBackpackDownloader(retry_policy=retry_policy, callbacks=callbacks)
+        self.events = self._downloader.events
+        self._session = session
+        self._own_session = session is None
+        self._executor = executor
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def _run(self, func, *args, **kwargs):
+        '''Run blocking func in the executor.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def download_and_extract(self, directory, doi, check_version=True, download_retries=3, version=None, max_workers=1,
+                                   lock=True, lock_timeout=None):
+        """Download a backpack, extract and verify it, as
+        ZenodoBackpackDownloader.download_and_extract does, staging files in
+        the same way and holding the same lock on directory, so that it can
+        run alongside other async or blocking downloads into directory.
+
+        Parameters
+        ----------
+        directory: str
+            Where to download to
+        doi: str
+            DOI of the Zenodo series
+        check_version: bool
+            If True, check Zenodo metadata verifies
+        download_retries: int
+            Number of download attempts, at least 1
+        version: None or str
+            If None, return the newest version. If specified, target that specific version.
+        max_workers: int
+            Number of files in the record to download at the same time, and
+            of payload files to verify at the same time.
+        lock: bool
+            If True, hold a lock on directory while downloading.
+        lock_timeout: None or float
+            Seconds to wait for another download's lock on directory before
+            raising DownloadLockTimeoutException. If None, wait indefinitely.
+
+        Returns a ZenodoBackpack object containing the downloaded files
+        """
+        await self._run(self._downloader._make_sure_path_exists, directory)
+
+        if doi is None:
+            raise ZenodoConnectionException('Record could not get accessed.')
+        with self.events.phase(events.RESOLVE_DOI, doi=doi):
+            recordID = await self._retrieve_record_ID(doi)
+        with self.events.phase(events.FETCH_METADATA, doi=doi, version=version):
+            metadata, files = await self._retrieve_record_metadata(recordID, version)
+
+        if not lock:
+            return await self._download_and_extract_into(directory, metadata, files, check_version, download_retries,
+                                                         max_workers)
+        download_lock = self._downloader._download_lock(directory, lock_timeout)
+        acquiring = asyncio.ensure_future(self._run(download_lock.acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The lock is still being taken in the executor, so let it go once it is
+            acquiring.add_done_callback(lambda f: f.cancelled() or f.exception() or download_lock.release())
+            raise
+        try:
+            if download_lock.waited:
+                zb = await self._run(self._downloader._downloaded_by_lock_holder, directory, metadata, files,
+                                     check_version)
+                if zb is not None:
+                    return zb
+            return await self._download_and_extract_into(directory, metadata, files, check_version, download_retries,
+                                                         max_workers)
+        finally:
+            await self._run(download_lock.release)
+
+    async def _download_and_extract_into(self, directory, metadata, files, check_version, download_retries,
+                                         max_workers):
+        """Download and extract the files of a record into the staging
+        directory of directory, then move them into place and verify the
+        backpack, as ZenodoBackpackDownloader does."""
+        staging, files, partial = await self._run(self._downloader._start_staging, directory, files)
+        files = [f for f in files if not is_delta_archive(f['key'])]
+
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        async def download_and_extract_file(f):
+            async with semaphore:
+                return await self._download_and_extract_file(staging, f, download_retries)
+
+        tasks = [asyncio.ensure_future(download_and_extract_file(f)) for f in files]
+        try:
+            zb_folders = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        logging.debug('All files have been downloaded.')
+
+        return await self._run(self._downloader._finish_staging, directory, staging, partial, zb_folders, metadata,
+                               files, check_version, False, max_workers)
+
+    async def _download_and_extract_file(self, directory, f, download_retries):
+        if download_retries < 1:
+            raise ValueError('download_retries must be at least 1, not {}'.format(download_retries))
+        link = f['links']['self']
+        filename = f['key'].split('/')[-1]
+        checksum = f['checksum']
+        filepath = os.path.join(directory, filename)
+        retry_policy = self._downloader.retry_policy
+        file_progress = _FileProgress(self.events, filename)
+
+        # download_retries attempts, each continuing from where the last one
+        # stopped and making its request once, as in ZenodoBackpackDownloader
+        with self.events.phase(events.DOWNLOAD, file=filename, stream_extract=False) as info:
+            info['bytes'] = int(f.get('size', 0))
+            for attempt in range(download_retries):
+                try:
+                    digest = await self._download_file(link, filepath, size=f.get('size'), checksum=checksum,
+                                                       progress=file_progress, attempts=1)
+                except Exception as e:
+                    file_progress.rewind()
+                    if not is_retryable(e, RETRY_EXCEPTIONS):
+                        raise
+                    delay = retry_policy.download_retry_delay(link, attempt, download_retries, e)
+                    if delay is None:
+                        raise ZenodoConnectionException('Too many unsuccessful retries. Download is aborted') from e
+                    # Back off before continuing from where this attempt stopped
+                    await asyncio.sleep(delay)
+                else:
+                    break
+
+        if digest is not None:
+            correct = digest == checksum.split(':')[-1]
+        else:
+            with self.events.phase(events.HASH, file=filename, bytes=int(f.get('size', 0))):
+                correct = await self._run(self._downloader._check_hash, filepath, checksum)
+        if not correct:
+            await self._run(os.remove, filepath)
+            raise ZenodoBackpackMalformedException(
+                f"Checksum is incorrect for downloaded file '{filename}'. Please download again.")
+
+        archive_compression = compression.archive_compression(filename)
+        if archive_compression is None:
+            return None
+        return await self._run(self._downloader._extract_archive, filepath, directory, archive_compression)
+
+    async def _download_file(self, file_url, out_file, size=None, checksum=None, progress=None, attempts=None):
+        """Download a file to disk, continuing from a .part file left by an
+        earlier attempt as ZenodoBackpackDownloader._download_file does.
+        progress, if given, has its update(n) method called as each n bytes
+        arrive, and the request is tried at most attempts times if given.
+
+        Returns the hex digest of the file, or None if it was already complete
+        and so was not hashed.
+        """
+        part_file = out_file + '.part'
+        state = await self._run(self._downloader._load_partial_download, part_file, file_url, size, checksum)
+        if state is not None and state['segments'] is not None:
+            # Segmented downloads are not resumed here, so start again
+            await self._run(self._downloader._discard_partial_download, part_file)
+            state = None
+        if state is None:
+            state = {'url': file_url, 'size': size, 'checksum': checksum, 'segments': None}
+        resume_from = await self._run(lambda: os.path.getsize(part_file) if os.path.exists(part_file) else 0)
+
+        headers = {'Range': 'bytes={}-'.format(resume_from)} if resume_from > 0 else {}
+        hasher = hashlib.new(checksum.split(':')[0] if checksum else 'md5')
+        response = await self._request(file_url, attempts=attempts, headers=headers)
+        if resume_from > 0 and response.status == 416:
+            response.release()
+            if size is not None and resume_from == int(size):
+                await self._run(_finish_download, part_file, out_file)
+                return None
+            # The partial download is longer than the file, so start again
+            logging.info('Cannot resume download of {} from byte {}, so starting again'.format(file_url, resume_from))
+            await self._run(self._downloader._discard_partial_download, part_file)
+            resume_from = 0
+            response = await self._request(file_url, attempts=attempts)
+        async with response:
+            if resume_from > 0:
+                if response.status == 206:
+                    logging.info('Resuming download of {} from byte {}'.format(file_url, resume_from))
+                else:
+                    resume_from = 0
+            if response.status >= 400:
+                raise ZenodoDownloadException('HTTP status {} while downloading {}'.format(response.status, file_url),
+                                              response.status, response.headers)
+
+            await self._run(self._downloader._save_partial_download, part_file, state)
+            if resume_from > 0:
+                await self._run(_hash_existing, hasher, part_file)
+            if progress is not None:
+                progress.update(resume_from)
+
+            logging.info('Downloading {} to {}.'.format(file_url, out_file))
+            f = await self._run(open, part_file, 'ab' if resume_from > 0 else 'wb')
+            buffer = bytearray()
+            try:
+                async for data in response.content.iter_any():
+                    if progress is not None:
+                        progress.update(len(data))
+                    buffer += data
+                    if len(buffer) >= WRITE_BLOCK_SIZE:
+                        await self._run(_write_and_hash, f, hasher, bytes(buffer))
+                        buffer.clear()
+            finally:
+                # Keep what did arrive, so that a retry can continue from it
+                if buffer:
+                    await self._run(_write_and_hash, f, hasher, bytes(buffer))
+                await self._run(f.close)
+
+        downloaded = await self._run(os.path.getsize, part_file)
+        if size is not None and downloaded != int(size):
+            raise ZenodoDownloadException('Download of {} ended after {} of {} bytes'.format(file_url, downloaded, size))
+        await self._run(_finish_download, part_file, out_file)
+        return hasher.hexdigest()
+
+    async def _request(self, url, attempts=None, **kwargs):
+        '''Return the response of a GET request, retried according to the
+        downloader's RetryPolicy as ZenodoBackpackDownloader._get is, for at
+        most attempts tries if given. The response of the last attempt is
+        returned even if its status is an error, and the exception of the
+        last attempt is raised if it did not complete.'''
+        retry_policy = self._downloader.retry_policy
+        attempt = 0
+        while True:
+            delay = retry_policy.host_delay(url)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                response = await self._get_session().get(url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                delay = retry_policy.error_retry_delay(url, attempt, e, attempts)
+                if delay is None:
+                    raise
+            else:
+                delay = retry_policy.status_retry_delay(url, attempt, response.status, response, attempts)
+                if delay is None:
+                    return response
+                response.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get(self, url):
+        '''Return the response, final URL and text of a GET request,
+        following redirects.'''
+        try:
+            async with await self._request(url, timeout=aiohttp.ClientTimeout(total=15.)) as r:
+                return r, str(r.url), await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ZenodoConnectionException('Connection error: {}'.format(e))
+
+    async def _get_json(self, url):
+        r, _, text = await self._get(url)
+        if r.status >= 400:
+            raise ZenodoConnectionException('Error during metadata retrieval: HTTP status {} for {}'.format(r.status, url))
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise ZenodoConnectionException('Error during metadata retrieval: {}'.format(e))
+
+    async def _retrieve_record_ID(self, doi):
+        """Resolve a DOI to the ID of the Zenodo record it points to."""
+        if not doi.startswith('http'):
+            doi = self._downloader.doi_resolver_url + doi
+        logging.debug(f"Retrieving URL {doi}")
+        r, url, _ = await self._get(doi)
+        if r.status >= 400:
+            raise ZenodoConnectionException('DOI could not be resolved. Check your DOI is correct.')
+        return url.split('/')[-1].strip()
+
+    async def _retrieve_record_json(self, recordID):
+        return await self._get_json(self._downloader.records_url + recordID)
+
+    async def _retrieve_versions_record_json(self, recordID, version):
+        js = await self._get_json(self._downloader.records_url + recordID + '/versions')
+        return self._downloader._select_version(js, recordID, version)
+
+    async def _retrieve_record_metadata(self, recordID, version):
+        """Return the metadata of a record and its list of files, as
+        ZenodoBackpackDownloader._retrieve_record_metadata does."""
+        if version is None:
+            js = await self._retrieve_record_json(recordID)
+        else:
+            js = await self._retrieve_versions_record_json(recordID, version)
+        return js, js['files']
@@ -0,0 +1,266 @@
+'''Reading backpacks which are already on disk.
+
+This module, imported by the package itself, only uses os, json, mmap and
+logging, so that programs which acquire() a backpack at startup do not pay for
+importing requests, tqdm and tarfile, which downloading and creating need.
+'''
+
+import json
+import logging
+import os
+
+from .manifest import Manifest, MANIFEST_FILE
+
+
+class ZenodoBackpackMalformedException(Exception):
+    pass  # No implementation needed
+
+
+class ZenodoBackpackVersionException(Exception):
+    pass
+
+
+class ZenodoConnectionException(Exception):
+    pass
+
+class ZenodoDownloadException(ZenodoConnectionException):
+    '''Raised when downloading a file is answered with an error status, in
+    which case status and headers are those of the response, or ends early,
+    in which case status is None.'''
+    def __init__(self, message, status=None, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers if headers is not None else {}
+
+class BrokenSymlinkException(Exception):
+    pass
+
+class DownloadCancelledException(Exception):
+    pass
+
+class ZenodoBackpackChecksumException(ZenodoBackpackMalformedException):
+    '''Raised when verification finds payload files that are missing or whose
+    checksum does not match CONTENTS.json. All such files are listed, not
+    just the first. For files with chunk checksums, regions gives the
+    (offset, length) of each corrupted piece, by file.'''
+    def __init__(self, mismatched, missing, regions=None):
+        self.mismatched = mismatched
+        self.missing = missing
+        self.regions = regions or {}
+        problems = ['checksum mismatch: {}{}'.format(f, self._describe_regions(f)) for f in mismatched] + \
+            ['missing: {}'.format(f) for f in missing]
+        shown = problems[:20]
+        if len(problems) > len(shown):
+            shown.append('... and {} more'.format(len(problems) - len(shown)))
+        super().__init__('Verification failed for {} extracted file(s):\n  {}'.format(
+            len(problems), '\n  '.join(shown)))
+
+    def _describe_regions(self, f):
+        if f not in self.regions:
+            return ''
+        regions = ['{}-{}'.format(offset, offset + length - 1) for offset, length in self.regions[f][:5]]
+        if len(self.regions[f]) > len(regions):
+            regions.append('...')
+        return ' (bytes {})'.format(', '.join(regions))
+
+CURRENT_ZENODO_BACKPACK_VERSION = 1
+# Backpacks checksummed with an algorithm other than md5 record it under
+# HASH_ALGORITHM, and their checksums under CHECKSUMS rather than MD5SUMS.
+# Older versions of zenodo_backpack cannot verify these, so they are given
+# a version of their own, which those versions refuse.
+CHECKSUMS_ZENODO_BACKPACK_VERSION = 2
+SUPPORTED_ZENODO_BACKPACK_VERSIONS = (CURRENT_ZENODO_BACKPACK_VERSION, CHECKSUMS_ZENODO_BACKPACK_VERSION)
+
+PAYLOAD_DIRECTORY_KEY = 'payload_directory'
+PAYLOAD_DIRECTORY = 'payload_directory'
+DATA_VERSION = 'data_version'
+ZB_VERSION = 'zenodo_backpack_version'
+MD5SUMS = 'md5sums'
+CHECKSUMS = 'checksums'
+HASH_ALGORITHM = 'hash_algorithm'
+# Files larger than CHUNK_SIZE may also have a checksum of each CHUNK_SIZE
+# piece, listed by file under CHUNK_CHECKSUMS
+CHUNK_SIZE = 'chunk_size'
+CHUNK_CHECKSUMS = 'chunk_checksums'
+
+class ZenodoBackpack:
+    def __init__(self, base_directory):
+        self.base_directory = base_directory
+        self._contents = None
+        self.manifest = None
+
+        # With a manifest, the metadata is read from its header, and
+        # CONTENTS.json is only parsed if contents is used
+        manifest_path = os.path.join(self.base_directory, MANIFEST_FILE)
+        if os.path.isfile(manifest_path):
+            try:
+                self.manifest = Manifest(manifest_path)
+            except (OSError, ValueError):
+                raise ZenodoBackpackMalformedException('Failed to load {}'.format(MANIFEST_FILE))
+            self.metadata = self.manifest.metadata
+        else:
+            self.metadata = self.contents
+        #self.zenodo_backpack_version = self.contents[ZB_VERSION]
+        #self.data_version = self.contents[DATA_VERSION]
+
+    @property
+    def contents(self):
+        '''CONTENTS.json, loaded when first used.'''
+        if self._contents is None:
+            try:
+                with open(os.path.join(self.base_directory, 'CONTENTS.json')) as jsonfile:
+                    self._contents = json.load(jsonfile)
+            except:
+                raise ZenodoBackpackMalformedException('Failed to load CONTENTS.json')
+        return self._contents
+
+    def checksums(self):
+        '''Return a mapping of each payload file, as a path within the
+        backpack starting with '/', to its checksum, as computed by
+        hash_algorithm(). This is the manifest if the backpack has one, so
+        that CONTENTS.json need not be loaded.'''
+        if self.manifest is not None:
+            return self.manifest
+        if CHECKSUMS in self.contents:
+            return self.contents[CHECKSUMS]
+        return self.contents[MD5SUMS]
+
+    def chunk_checksums(self):
+        '''Returns (chunk size, checksums of the chunks of each file), where
+        the chunk size is None if the backpack has no chunk checksums. Only
+        files larger than a chunk are listed.'''
+        if CHUNK_SIZE not in self.metadata:
+            return None, {}
+        return self.metadata[CHUNK_SIZE], self.metadata.get(CHUNK_CHECKSUMS, {})
+
+    def hash_algorithm(self):
+        '''Returns the algorithm of the payload checksums, md5 unless another
+        was chosen when the backpack was created.'''
+        return self.metadata.get(HASH_ALGORITHM, 'md5')
+
+    def payload_directory_string(self, enter_single_payload_directory=False):
+        '''Returns the payload directory string.
+
+        Parameters
+        ----------
+        enter_single_payload_directory: bool
+            If True, the payload directory contains a single directory. Return
+            that directory instead of the payload directory itself.
+        '''
+        payload_dir = os.path.join(self.base_directory, self.metadata[PAYLOAD_DIRECTORY_KEY])
+        if enter_single_payload_directory:
+            files = os.listdir(payload_dir)
+            if len(files) != 1:
+                raise ZenodoBackpackMalformedException(
+                    'Payload directory contains more than one file, but enter_single_payload_directory was set to True.')
+            payload_dir = os.path.join(payload_dir, files[0])
+            if not os.path.isdir(payload_dir):
+                raise ZenodoBackpackMalformedException(
+                    'Payload directory contains a file, not a directory, but enter_single_payload_directory was set to True.')
+            return payload_dir
+        else:
+            return payload_dir
+
+    def data_version_string(self):
+        return self.metadata[DATA_VERSION]
+
+    def zenodo_backpack_version_string(self):
+        return self.metadata[ZB_VERSION]
+
+
+def acquire(path=None, env_var_name=None, md5sum=False, version=None, max_workers=1, verification_cache=False, full=False,
+            verify=None, doi=None, cache_root=None, quota=None):
+    ''' Look for folder corresponding to a path or environmental variable and
+    return it.
+
+    Parameters
+    ----------
+    path: str
+        Path to the backpack. Cannot be used with env_var_name.
+    env_var_name: str
+        Name of an environment variable that contains a path to a backpack
+    md5sum: bool
+        If True, use the contents.json file to verify files.
+    version: str
+        Excpected version of the backpack. If not provided, the version in the CONTENTS.json file is checked.
+    max_workers: int
+        Number of files to verify at the same time when md5sum is True.
+    verification_cache: bool
+        When md5sum is True, skip files whose size, modification time and inode
+        are unchanged since they were last verified. See
+        ZenodoBackpackDownloader.verify.
+    full: bool
+        With verification_cache, hash every file and refresh the cache.
+    verify: None or str
+        'full' to verify every file, as md5sum does, or 'quick' to check that
+        every file exists and verify a random sample of about 1% of the
+        payload, chosen in proportion to size. The sample is made of the
+        chunks of files with chunk checksums, and of whole files otherwise.
+    doi: str
+        DOI of a backpack to take from a managed cache, downloading the given
+        version, or the newest if version is None, when it is not there.
+        Cannot be used with path or env_var_name. See zenodo_backpack.cache.
+    cache_root: None or str
+        Root of the cache used with doi. If None, that named by the
+        ZENODO_BACKPACK_CACHE environment variable, or else
+        ~/.cache/zenodo_backpack.
+    quota: None, int or str
+        Most bytes the cache may take, such as '500G'. The least recently
+        used versions which are not pinned are removed to stay within it.
+    
+    Raises
+    ------
+    ZenodoBackpackMalformedException: 
+        If the environment variable does not point to a valid ZenodoBackpack
+        i.e. a directory with a CONTENTS.json in it.
+    ZenodoBackpackVersionException:
+        If not expected Backpack version
+    '''
+
+    if doi:
+        if path or env_var_name:
+            raise ValueError('doi cannot be used with path or env_var_name')
+        from .cache import BackpackCache, default_cache_root
+        cache = BackpackCache(cache_root or default_cache_root(), quota=quota)
+        basefolder = cache.acquire(doi, version, max_workers=max_workers).base_directory
+        logging_description = "Version {} of {} in the cache at {}".format(version, doi, cache.root)
+
+    elif path:
+        logging_description = "Path {}".format(path)
+        basefolder = path
+
+    elif env_var_name:
+        logging_description = f"Environment variable {env_var_name}"
+        if env_var_name not in os.environ:
+            raise ZenodoBackpackMalformedException(f'Environment variable {env_var_name} was undefined, when it should define the path to the ZenodoBackpack data.')
+        else:
+            basefolder = os.environ[env_var_name]
+    else:
+        raise ZenodoBackpackMalformedException()
+
+    if os.path.isdir(basefolder):
+        if 'CONTENTS.json' in os.listdir(basefolder):
+            logging.info('Retrieval successful. Location of backpack is: {}'.format(basefolder))
+
+            zb = ZenodoBackpack(basefolder)
+
+            if version:
+                if version != zb.data_version_string():
+                    raise ZenodoBackpackMalformedException(
+                f'Version in CONTENTS.json: {zb.data_version_string()} does not match version provided: {version}')
+            if verify not in (None, 'full', 'quick'):
+                raise ValueError("verify must be None, 'full' or 'quick', not {!r}".format(verify))
+            if md5sum or verify == 'full':
+                from .downloader import ZenodoBackpackDownloader
+                ZenodoBackpackDownloader().verify(zb, passed_version=version, max_workers=max_workers,
+                                                  use_cache=verification_cache, full=full)
+            elif verify == 'quick':
+                from .downloader import ZenodoBackpackDownloader, QUICK_VERIFY_FRACTION
+                ZenodoBackpackDownloader().verify(zb, passed_version=version, max_workers=max_workers,
+                                                  sample=QUICK_VERIFY_FRACTION)
+            return zb
+
+        else:
+            raise ZenodoBackpackMalformedException(f"{logging_description} does not contain a CONTENTS.json file, so is not a valid ZenodoBackpack")
+    else:
+        raise ZenodoBackpackMalformedException(f"{logging_description} is not a directory so cannot hold a ZenodoBackpack")
@@ -0,0 +1,196 @@
+'''Download many backpacks at once, as listed in a manifest.
+
+A manifest is a JSON or YAML file holding a list of backpacks, either at the
+top level or under a 'backpacks' key. Each backpack is a mapping with keys:
+
+    doi: DOI of the Zenodo series (required)
+    output_directory: where to download the backpack to (required)
+    version: version to download. If omitted, the newest version.
+    env_var_name: environment variable which may point to an existing copy
+        of the backpack, as for acquire()
+
+For example, in YAML:
+
+    backpacks:
+      - doi: 10.5281/zenodo.5739611
+        version: 3.2.1
+        output_directory: /data/singlem
+        env_var_name: SINGLEM_METAPACKAGE_PATH
+      - doi: 10.5281/zenodo.11438051
+        output_directory: /data/test
+'''
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .backpack import ZenodoBackpackMalformedException, ZenodoBackpackVersionException, acquire
+from .downloader import ZenodoBackpackDownloader, DOWNLOAD_SEGMENTS
+
+# Backpacks downloaded at the same time by default
+DEFAULT_MAX_BACKPACKS = 4
+# Connections open to each host at once by default
+DEFAULT_MAX_CONNECTIONS = 8
+
+SKIPPED = 'skipped'
+DOWNLOADED = 'downloaded'
+FAILED = 'failed'
+
+
+def load_manifest(path):
+    '''Read a JSON or YAML manifest, returning its list of backpacks.
+
+    YAML manifests, recognised by a .yml or .yaml suffix, need the PyYAML
+    package.
+    '''
+    with open(path) as f:
+        if path.endswith('.yml') or path.endswith('.yaml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('The PyYAML package is required for YAML manifests. Install it with "pip install pyyaml".')
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('backpacks')
+    if not isinstance(manifest, list):
+        raise ValueError('Manifest {} does not contain a list of backpacks'.format(path))
+    entries = []
+    for i, entry in enumerate(manifest):
+        if not isinstance(entry, dict) or 'doi' not in entry or 'output_directory' not in entry:
+            raise ValueError('Entry {} of manifest {} must give a doi and an output_directory'.format(i + 1, path))
+        unknown = set(entry) - {'doi', 'version', 'output_directory', 'env_var_name'}
+        if unknown:
+            raise ValueError('Entry {} of manifest {} has unknown keys: {}'.format(i + 1, path, ', '.join(sorted(unknown))))
+        entries.append({
+            'doi': str(entry['doi']),
+            # YAML reads versions such as 1.0 as numbers
+            'version': None if entry.get('version') is None else str(entry['version']),
+            'output_directory': entry['output_directory'],
+            'env_var_name': entry.get('env_var_name'),
+        })
+    return entries
+
+
+def download_many(entries, downloader=None, max_backpacks=DEFAULT_MAX_BACKPACKS, max_connections=DEFAULT_MAX_CONNECTIONS,
+                  bandwidth_limit=None, max_workers=2, check_version=True, download_retries=3, segments=DOWNLOAD_SEGMENTS,
+                  lock_timeout=None, verify='full'):
+    '''Download the backpacks listed in a manifest, skipping those already
+    present which acquire() finds valid.
+
+    The metadata of every backpack is looked up at once. Then up to
+    max_backpacks backpacks are downloaded at the same time, their transfers
+    sharing max_connections connections and the bandwidth limit, so that the
+    time taken depends on the total size rather than the number of backpacks.
+
+    Parameters
+    ----------
+    entries: list
+        Backpacks to download, as returned by load_manifest
+    downloader: ZenodoBackpackDownloader
+        Downloader to use, e.g. one with a metadata cache. If None, one is
+        created with max_connections and bandwidth_limit.
+    max_backpacks: int
+        Number of backpacks to download at the same time
+    max_connections: None or int
+        Number of connections to each host open at once, across all backpacks
+    bandwidth_limit: None or float
+        Total bytes per second to download at most
+    max_workers: int
+        Number of files of each backpack to download, check and extract at
+        the same time
+    check_version: bool
+        If True, check each backpack's version against its Zenodo metadata
+    download_retries: int
+        Number of download attempts for each file
+    segments: int
+        Number of connections used to download each large file
+    lock_timeout: None or float
+        Seconds to wait for another process downloading into the same
+        directory. If None, wait indefinitely.
+    verify: None or str
+        How backpacks already present are verified before being skipped, as
+        for acquire(): 'full', 'quick', or None to check only their version.
+        Full verification keeps a verification cache in each backpack, so
+        that it is fast when run again.
+
+    Returns a list with a summary of each backpack, in the order of entries:
+    a dict of its doi, version, output_directory, status (one of SKIPPED,
+    DOWNLOADED or FAILED), path of the backpack, data_version, bytes
+    downloaded, seconds taken and error message.
+    '''
+    if downloader is None:
+        downloader = ZenodoBackpackDownloader(max_connections=max_connections, bandwidth_limit=bandwidth_limit)
+    summaries = [{
+        'doi': entry['doi'],
+        'version': entry['version'],
+        'output_directory': entry['output_directory'],
+        'status': None,
+        'path': None,
+        'data_version': None,
+        'bytes': 0,
+        'seconds': 0.0,
+        'error': None,
+    } for entry in entries]
+
+    def resolve(entry):
+        return downloader._resolve_metadata(entry['doi'], entry['version'])
+
+    def fetch(entry, summary, resolved):
+        start = time.time()
+        try:
+            metadata, files = resolved.result()
+            zb = _existing_backpack(downloader, entry, metadata, check_version, verify)
+            if zb is not None:
+                logging.info('Backpack {} is already present at {}'.format(entry['doi'], zb.base_directory))
+                summary['status'] = SKIPPED
+            else:
+                zb = downloader._download_and_extract_resolved(
+                    entry['output_directory'], metadata, files, check_version=check_version,
+                    download_retries=download_retries, max_workers=max_workers, segments=segments,
+                    lock_timeout=lock_timeout)
+                summary['status'] = DOWNLOADED
+                summary['bytes'] = sum(int(f.get('size', 0)) for f in files)
+            summary['path'] = zb.base_directory
+            summary['data_version'] = zb.data_version_string()
+        except Exception as e:
+            logging.error('Failed to download backpack {}: {}'.format(entry['doi'], e))
+            summary['status'] = FAILED
+            summary['error'] = str(e)
+        summary['seconds'] = time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, len(entries))) as resolver, \
+            ThreadPoolExecutor(max_workers=max(1, max_backpacks)) as executor:
+        resolved = [resolver.submit(resolve, entry) for entry in entries]
+        for future in [executor.submit(fetch, entry, summary, r) for entry, summary, r in zip(entries, summaries, resolved)]:
+            future.result()
+
+    logging.info('Downloaded {} backpacks ({} bytes), skipped {}, failed {}'.format(
+        sum(s['status'] == DOWNLOADED for s in summaries), sum(s['bytes'] for s in summaries),
+        sum(s['status'] == SKIPPED for s in summaries), sum(s['status'] == FAILED for s in summaries)))
+    return summaries
+
+
+def _existing_backpack(downloader, entry, metadata, check_version, verify):
+    '''Return the backpack of entry if it is already present, through its
+    environment variable or in its output directory, and acquire() verifies
+    it, otherwise None.'''
+    version = str(metadata['metadata']['version']).strip()
+    paths = []
+    if entry['env_var_name'] and entry['env_var_name'] in os.environ:
+        paths.append(os.environ[entry['env_var_name']])
+    if os.path.isdir(entry['output_directory']):
+        zb = downloader._find_extracted_backpack(entry['output_directory'], metadata)
+        if zb is not None:
+            paths.append(zb.base_directory)
+    for path in paths:
+        try:
+            return acquire(path=path, version=version if check_version else None, verify=verify,
+                           verification_cache=True)
+        except (ZenodoBackpackMalformedException, ZenodoBackpackVersionException) as e:
+            logging.info('Not using backpack at {}: {}'.format(path, e))
+    return None
@@ -0,0 +1,297 @@
+'''Managed cache of downloaded backpacks, by DOI and version.
+
+Each version of a backpack is downloaded into its own directory under the
+cache root, <root>/<DOI>/<version>, with the DOI and version quoted to be
+safe as file names. Beside the backpack are small files recording it:
+
+    .zb_cache.json      DOI, version, size in bytes and backpack folder,
+                        written once the download is complete
+    .zb_cache_access    touched whenever the backpack is acquired, so its
+                        modification time is the time of last use
+    .zb_cache_pin       present if the version is pinned
+
+Given a quota, the least recently used versions which are not pinned are
+removed to make room before each download, and to bring the cache back
+under the quota afterwards. Room is also made for the download itself
+when the filesystem is short of space. Versions used within the last
+CACHE_EVICTION_MIN_AGE seconds are never removed, as a job may be reading
+them.
+'''
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+
+from .backpack import ZenodoBackpack, ZenodoConnectionException
+
+# Environment variable giving the cache root used by acquire(doi=...)
+CACHE_ROOT_ENV_VAR = 'ZENODO_BACKPACK_CACHE'
+CACHE_ENTRY_FILE = '.zb_cache.json'
+CACHE_ACCESS_FILE = '.zb_cache_access'
+CACHE_PIN_FILE = '.zb_cache_pin'
+# Prefix of the directories under the root which versions are moved into
+# while they are removed
+CACHE_TRASH_PREFIX = '.zb_cache_removing.'
+# Versions used more recently than this many seconds ago are not evicted
+CACHE_EVICTION_MIN_AGE = 10 * 60
+# Room made for a download, as a multiple of the size of the files in its
+# record, allowing for the archive and its extracted contents
+CACHE_DOWNLOAD_SPACE_FACTOR = 2
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def default_cache_root():
+    '''The cache root named by the ZENODO_BACKPACK_CACHE environment
+    variable, or else zenodo_backpack in the user's cache directory.'''
+    if os.environ.get(CACHE_ROOT_ENV_VAR):
+        return os.environ[CACHE_ROOT_ENV_VAR]
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'zenodo_backpack')
+
+
+def parse_size(size):
+    '''Return a number of bytes given as an int, or a string such as '500G'
+    with a K, M, G or T suffix in powers of 1024.'''
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _SIZE_SUFFIXES:
+        return int(float(size[:-1]) * _SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+class BackpackCache:
+    '''Cache of backpacks in a root directory, downloading each version on
+    first use and evicting the least recently used to stay within a quota.'''
+
+    def __init__(self, root, quota=None, downloader=None):
+        '''
+        Parameters
+        ----------
+        root: str
+            Directory holding the cache
+        quota: None, int or str
+            Most bytes the cache may take, as for parse_size. If None, the
+            cache is only pruned to make room on a full filesystem.
+        downloader: None or ZenodoBackpackDownloader
+            Used for downloads. If None, a default one is created when
+            first needed.
+        '''
+        self.root = root
+        self.quota = parse_size(quota) if quota is not None else None
+        self._downloader = downloader
+        self._clear_trash()
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            from .downloader import ZenodoBackpackDownloader
+            self._downloader = ZenodoBackpackDownloader()
+        return self._downloader
+
+    def entry_directory(self, doi, version):
+        return os.path.join(self.root, urllib.parse.quote(doi, safe=''), urllib.parse.quote(str(version), safe=''))
+
+    def acquire(self, doi, version=None, **kwargs):
+        '''Return the backpack of a DOI and version, downloading it into the
+        cache if it is not there already, and record that it was used.
+
+        If version is None, the newest version is looked up. If Zenodo
+        cannot be reached, the most recently used cached version is returned
+        instead, if there is one.
+
+        Other arguments are passed to download_and_extract.
+        '''
+        if version is None:
+            try:
+                metadata, files = self.downloader._resolve_metadata(doi, None)
+            except ZenodoConnectionException:
+                entries = [entry for entry in self.entries() if entry['doi'] == doi]
+                if not entries:
+                    raise
+                entry = max(entries, key=lambda e: e['last_access'])
+                logging.warning('Could not find the newest version of {}, so using cached version {}'.format(
+                    doi, entry['version']))
+                return self._use(entry['path'], entry)
+            version = str(metadata['metadata']['version'])
+        else:
+            metadata = files = None
+
+        directory = self.entry_directory(doi, version)
+        entry = self._read_entry(directory)
+        if entry is not None:
+            return self._use(directory, entry)
+
+        if metadata is None:
+            metadata, files = self.downloader._resolve_metadata(doi, version)
+        needed = CACHE_DOWNLOAD_SPACE_FACTOR * sum(int(f.get('size', 0)) for f in files)
+        self._make_room(needed)
+        logging.info('Downloading version {} of {} into the cache at {}'.format(version, doi, directory))
+        zb = self.downloader._download_and_extract_resolved(directory, metadata, files, **kwargs)
+        entry = {
+            'doi': doi,
+            'version': version,
+            'size': _directory_size(directory),
+            'backpack': os.path.relpath(zb.base_directory, directory),
+        }
+        _write_json(os.path.join(directory, CACHE_ENTRY_FILE), entry)
+        zb = self._use(directory, entry)
+        if self.quota is not None:
+            self.prune(self.quota, keep=[directory])
+        return zb
+
+    def _use(self, directory, entry):
+        with open(os.path.join(directory, CACHE_ACCESS_FILE), 'a'):
+            pass
+        os.utime(os.path.join(directory, CACHE_ACCESS_FILE))
+        return ZenodoBackpack(os.path.join(directory, entry['backpack']))
+
+    def _read_entry(self, directory):
+        try:
+            with open(os.path.join(directory, CACHE_ENTRY_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def entries(self):
+        '''Return a list of the cached versions, each a dict of doi, version,
+        size, path, last_access (seconds since the epoch) and pinned,
+        least recently used first.'''
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for doi_directory in sorted(os.listdir(self.root)):
+            if doi_directory.startswith('.') or not os.path.isdir(os.path.join(self.root, doi_directory)):
+                continue
+            for version_directory in sorted(os.listdir(os.path.join(self.root, doi_directory))):
+                directory = os.path.join(self.root, doi_directory, version_directory)
+                entry = self._read_entry(directory)
+                if entry is None:
+                    continue
+                try:
+                    last_access = os.stat(os.path.join(directory, CACHE_ACCESS_FILE)).st_mtime
+                except FileNotFoundError:
+                    last_access = os.stat(os.path.join(directory, CACHE_ENTRY_FILE)).st_mtime
+                entry.update(path=directory, last_access=last_access,
+                             pinned=os.path.exists(os.path.join(directory, CACHE_PIN_FILE)))
+                entries.append(entry)
+        entries.sort(key=lambda e: e['last_access'])
+        return entries
+
+    def size(self):
+        '''Total bytes of the cached versions.'''
+        return sum(entry['size'] for entry in self.entries())
+
+    def pin(self, doi, version, pinned=True):
+        '''Pin a cached version so that it is never evicted, or unpin it.'''
+        directory = self.entry_directory(doi, version)
+        if self._read_entry(directory) is None:
+            raise KeyError('Version {} of {} is not in the cache at {}'.format(version, doi, self.root))
+        pin_file = os.path.join(directory, CACHE_PIN_FILE)
+        if pinned:
+            with open(pin_file, 'a'):
+                pass
+        elif os.path.exists(pin_file):
+            os.remove(pin_file)
+
+    def prune(self, quota=None, keep=(), dry_run=False):
+        '''Remove the least recently used versions which are not pinned, until
+        the cache takes at most quota bytes, or self.quota if quota is None.
+        Versions whose directory is in keep, or which were used in the last
+        CACHE_EVICTION_MIN_AGE seconds, are not removed.
+
+        Returns the entries removed.
+        '''
+        quota = parse_size(quota) if quota is not None else self.quota
+        if quota is None:
+            return []
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        return self._evict(entries, lambda removed_bytes: total - removed_bytes <= quota, keep, dry_run)
+
+    def _make_room(self, needed):
+        '''Evict versions so that needed bytes more fit within the quota and
+        on the filesystem.'''
+        os.makedirs(self.root, exist_ok=True)
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        free = shutil.disk_usage(self.root).free
+
+        def enough(removed_bytes):
+            return (self.quota is None or total - removed_bytes + needed <= self.quota) and free + removed_bytes >= needed
+        self._evict(entries, enough, (), False)
+        if shutil.disk_usage(self.root).free < needed:
+            logging.warning('Only {} bytes are free in {}, but about {} may be needed'.format(
+                shutil.disk_usage(self.root).free, self.root, needed))
+
+    def _evict(self, entries, enough, keep, dry_run):
+        removed = []
+        removed_bytes = 0
+        now = time.time()
+        keep = set(os.path.abspath(k) for k in keep)
+        for entry in entries:
+            if enough(removed_bytes):
+                break
+            if entry['pinned'] or os.path.abspath(entry['path']) in keep \
+                    or now - entry['last_access'] < CACHE_EVICTION_MIN_AGE:
+                continue
+            logging.info('{} version {} of {} from the cache, last used {}'.format(
+                'Would remove' if dry_run else 'Removing', entry['version'], entry['doi'],
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['last_access']))))
+            if not dry_run and not self._remove(entry['path']):
+                continue
+            removed.append(entry)
+            removed_bytes += entry['size']
+        return removed
+
+    def _clear_trash(self):
+        '''Finish removing versions whose removal was interrupted.'''
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name.startswith(CACHE_TRASH_PREFIX):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def _remove(self, directory):
+        '''Remove an entry's directory, returning False if another process
+        removed it first.'''
+        # Moved out first, so that it stops being an entry at once
+        trash = tempfile.mkdtemp(prefix=CACHE_TRASH_PREFIX, dir=self.root)
+        try:
+            os.rename(directory, os.path.join(trash, os.path.basename(directory)))
+        except FileNotFoundError:
+            logging.debug('{} was already removed from the cache'.format(directory))
+            os.rmdir(trash)
+            return False
+        shutil.rmtree(trash)
+        try:
+            os.rmdir(os.path.dirname(directory))
+        except OSError:
+            # Other versions of the DOI remain
+            pass
+        return True
+
+
+def _directory_size(directory):
+    # Files hard-linked from the same object in a store are counted once
+    total = 0
+    seen = set()
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            stat = os.lstat(os.path.join(dirpath, filename))
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+def _write_json(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
@@ -0,0 +1,269 @@
+'''Compression formats for backpack archives.
+
+Archives are written through open_writer and read back through open_tar,
+which pick the implementation for each format: gzip, compressed in parallel
+blocks when several threads are available, and zstd through the optional
+zstandard package. When the optional isal package is installed, gzip
+archives are decompressed with it.
+'''
+
+import gzip
+import tarfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+COMPRESSIONS = (GZIP, ZSTD)
+
+# Suffix given to archives of each format
+ARCHIVE_SUFFIXES = {
+    GZIP: '.tar.gz',
+    ZSTD: '.tar.zst',
+}
+# Other suffixes recognised when reading
+_READ_SUFFIXES = {
+    '.tar.gz': GZIP,
+    '.tgz': GZIP,
+    '.tar.zst': ZSTD,
+    '.tar.zstd': ZSTD,
+    '.tzst': ZSTD,
+}
+_MAGIC = {
+    b'\x1f\x8b': GZIP,
+    b'\x28\xb5\x2f\xfd': ZSTD,
+}
+
+DEFAULT_LEVELS = {
+    GZIP: 9, # the tarfile default
+    ZSTD: 3,
+}
+
+# Uncompressed size of each block compressed by a separate thread
+PARALLEL_GZIP_BLOCK_SIZE = 1024 * 1024
+# Each block is primed with the end of the previous one, so that splitting
+# the data costs little compression
+_DEFLATE_WINDOW = 32 * 1024
+
+
+def archive_compression(filename):
+    '''Return the compression format of an archive judged by its file name,
+    or None if it is not a recognised archive.'''
+    for suffix, compression in _READ_SUFFIXES.items():
+        if suffix in filename:
+            return compression
+    return None
+
+
+def sniff_compression(head):
+    '''Return the compression format given the first bytes of a file, or
+    None if it is not recognised.'''
+    for magic, compression in _MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('The zstandard package is required for zstd compressed backpacks. Install it with "pip install zstandard".')
+    return zstandard
+
+
+def _isal_igzip():
+    try:
+        from isal import igzip
+    except ImportError:
+        return None
+    return igzip
+
+
+def open_writer(path, compression=GZIP, level=None, threads=1, indexed=False):
+    '''Open path for writing compressed data, returning a file-like object to
+    pass to tarfile.open(fileobj=..., mode='w|'). Closing it closes the file.
+
+    With more than one thread, gzip output is compressed in parallel blocks
+    but is still a single ordinary gzip member, readable by any gzip reader.
+    If indexed is True, an IndexedGzipWriter is returned instead, which
+    compresses in one thread. Only gzip can be indexed.
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {}, expected one of {}'.format(compression, ', '.join(COMPRESSIONS)))
+    if indexed and compression != GZIP:
+        raise ValueError('Only gzip archives can be indexed, not {}'.format(compression))
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+
+    f = open(path, 'wb')
+    try:
+        if indexed:
+            return IndexedGzipWriter(f, level)
+        elif compression == ZSTD:
+            zstandard = _zstandard()
+            compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+            return compressor.stream_writer(f, closefd=True)
+        elif threads > 1:
+            return ParallelGzipWriter(f, level, threads)
+        else:
+            return _ClosingGzipFile(f, level)
+    except BaseException:
+        f.close()
+        raise
+
+
+def open_tar(fileobj, compression=GZIP):
+    '''Open a TarFile in stream mode, reading compressed data from fileobj.
+
+    gzip is decompressed with isal when it is installed, and otherwise by
+    tarfile itself. zstd requires the zstandard package.
+    '''
+    if compression == ZSTD:
+        reader = _zstandard().ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+        return tarfile.open(fileobj=reader, mode='r|')
+    elif compression == GZIP:
+        igzip = _isal_igzip()
+        if igzip is not None:
+            return tarfile.open(fileobj=igzip.IGzipFile(fileobj=fileobj, mode='rb'), mode='r|')
+        return tarfile.open(fileobj=fileobj, mode='r|gz')
+    raise ValueError('Unknown compression {}'.format(compression))
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    '''GzipFile which closes the file it writes to.'''
+
+    def __init__(self, f, level):
+        super().__init__(fileobj=f, mode='wb', compresslevel=level)
+        self._raw = f
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw.close()
+
+
+class ParallelGzipWriter:
+    '''Writes a single gzip member whose deflate stream is compressed in
+    independent blocks by a pool of threads, in the manner of pigz.
+
+    Each block is flushed to a byte boundary so that the compressed blocks can
+    simply be concatenated, and is primed with the last 32 KiB of the block
+    before it.
+    '''
+
+    def __init__(self, f, level=DEFAULT_LEVELS[GZIP], threads=2, block_size=PARALLEL_GZIP_BLOCK_SIZE):
+        self.f = f
+        self.level = level
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+        self.pending = []
+        self.buffer = bytearray()
+        self.previous_tail = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # gzip header: deflate, no flags, no mtime, unknown OS
+        self.f.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def _compress_block(self, data, zdict, last):
+        if zdict:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, data, last):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append(self.executor.submit(self._compress_block, data, self.previous_tail, last))
+        self.previous_tail = data[-_DEFLATE_WINDOW:]
+        while len(self.pending) > (0 if last else self.max_pending):
+            self.f.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block, False)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.buffer), True)
+            self.f.write((self.crc & 0xffffffff).to_bytes(4, 'little'))
+            self.f.write((self.size & 0xffffffff).to_bytes(4, 'little'))
+        finally:
+            self.executor.shutdown()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IndexedGzipWriter:
+    '''Writes a single gzip member, in which full_flush() makes a point from
+    which the rest of the deflate stream can be decompressed without any of
+    the data before it. Given the offsets of these points, parts of the
+    file can be read without decompressing it from the start.
+
+    tell() gives the number of bytes written so far, so that the writer can
+    be used with tarfile.open(fileobj=..., mode='w'), which writes each
+    member straight through rather than buffering it as mode 'w|' does.
+    '''
+
+    def __init__(self, f, level=DEFAULT_LEVELS[GZIP]):
+        self.f = f
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # gzip header: deflate, no flags, no mtime, unknown OS
+        header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+        self.f.write(header)
+        self.compressed_size = len(header)
+
+    def _write_compressed(self, data):
+        self.f.write(data)
+        self.compressed_size += len(data)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._write_compressed(self.compressor.compress(data))
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def full_flush(self):
+        '''Make a full flush point, returning its offset in the compressed
+        file.'''
+        self._write_compressed(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        return self.compressed_size
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._write_compressed(self.compressor.flush(zlib.Z_FINISH))
+            self.f.write((self.crc & 0xffffffff).to_bytes(4, 'little'))
+            self.f.write((self.size & 0xffffffff).to_bytes(4, 'little'))
+        finally:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,385 @@
+'''Creating backpacks from a directory of files.'''
+
+import collections
+import json
+import logging
+import os
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# create() has an argument named compression
+from . import compression as _compression
+from . import delta as _delta
+from . import index as _index
+from .backpack import ZenodoBackpack, BrokenSymlinkException, CURRENT_ZENODO_BACKPACK_VERSION, CHECKSUMS_ZENODO_BACKPACK_VERSION, \
+    PAYLOAD_DIRECTORY_KEY, PAYLOAD_DIRECTORY, DATA_VERSION, ZB_VERSION, MD5SUMS, CHECKSUMS, HASH_ALGORITHM, \
+    CHUNK_SIZE, CHUNK_CHECKSUMS
+from .hashing import MD5, new_hasher, _hash_file, _ChunkHasher, _HashingReader
+from .manifest import MANIFEST_FILE, ManifestWriter
+
+
+class ZenodoBackpackCreator:
+
+    def create(self, input_directory, output_file, data_version, force=False, max_workers=1, single_pass=False,
+               compression=None, compression_level=None, manifest=False, hash_algorithm=MD5,
+               chunk_size=None, delta_from=None, index=False):
+
+
+        """Creates Zenodo backpack
+
+                Parameters:
+        ----------
+        input_directory: str
+            Files to be packaged
+        output_file: str
+            Archive .tar.gz to be created. Automatically appends '.zb.tar.gz' if
+            needed, or '.zb.tar.zst' for zstd compression
+        force: True or False
+            If True, overwrite an existing output_file if required. If False,
+            don't overwrite.
+        data_version:
+            Passes the data version of the file to archive
+
+                NOTE!! Same version must be specified in Zenodo metadata when file is uploaded, else error.
+        max_workers: int
+            Number of files to hash at the same time, and number of threads
+            used to compress the archive
+        single_pass: bool
+            If True, hash each file while adding it to the archive, so that it
+            is only read once. CONTENTS.json is then written at the end of the
+            archive rather than the start.
+        compression: None or str
+            'gzip' or 'zstd'. If None, zstd is used when output_file ends in
+            '.tar.zst', and gzip otherwise. zstd requires the zstandard
+            package.
+        compression_level: None or int
+            Compression level, defaulting to 9 for gzip and 3 for zstd
+        manifest: bool
+            If True, add a binary manifest, CONTENTS.zbm, next to
+            CONTENTS.json, so that backpacks with very many files can be
+            read without parsing CONTENTS.json. See zenodo_backpack.manifest.
+        hash_algorithm: str
+            Algorithm of the payload checksums, one of HASH_ALGORITHMS.
+            blake3 and xxh3_128 are several times faster to verify than md5,
+            but need the blake3 or xxhash package. Backpacks not using md5
+            cannot be verified by older versions of zenodo_backpack.
+        chunk_size: None or int
+            If given, also record the checksum of each chunk_size bytes of
+            files larger than chunk_size, so that the chunks of a large file
+            can be verified in parallel, corruption can be located within it,
+            and a sample of chunks can be checked by a quick verify.
+        delta_from: None or str
+            Directory of a previous version of the backpack. If given, also
+            write a delta archive next to output_file, named with '.zbdelta'
+            in place of '.zb', holding only the payload files which are new
+            or have changed since that version. Uploaded to the same record
+            as output_file, it lets ZenodoBackpackDownloader.update move an
+            installed previous version to this one without downloading the
+            unchanged files. See zenodo_backpack.delta.
+        index: bool
+            If True, write the archive so that each payload file can be read
+            without decompressing the files before it, and write an index of
+            where they are next to output_file, named with '.zbindex.json' in
+            place of '.zb.tar.gz'. Uploaded to the same record as output_file,
+            it lets RemoteZenodoBackpack fetch just the payload files a job
+            opens. Only gzip archives can be indexed, and they are compressed
+            in a single thread. See zenodo_backpack.index.
+
+        Returns nothing, unless input_directory is not a directory or output_file exists, which raises Exceptions
+        """
+
+        # Fail now, rather than after hashing, if the algorithm is unavailable
+        new_hasher(hash_algorithm)
+        if chunk_size is not None and chunk_size <= 0:
+            raise ValueError('chunk_size must be positive, not {}'.format(chunk_size))
+        previous = None
+        if delta_from is not None:
+            previous = ZenodoBackpack(delta_from)
+            if previous.hash_algorithm() != hash_algorithm:
+                raise ValueError('A delta can only be made from a backpack with {} checksums, not {}'.format(
+                    hash_algorithm, previous.hash_algorithm()))
+
+        if compression is None:
+            compression = _compression.archive_compression(str(output_file)) or _compression.GZIP
+        suffix = _compression.ARCHIVE_SUFFIXES[compression]
+        if not str(output_file).endswith(suffix):
+            output_file = os.path.join('{}.zb{}'.format(str(output_file), suffix))
+        delta_file = _delta.delta_archive_name(str(output_file)) if previous is not None else None
+        index_file = _index.index_name(str(output_file)) if index else None
+
+        for existing in (output_file, delta_file, index_file):
+            if existing is not None and os.path.isfile(existing):
+                if not force:
+                    raise FileExistsError('File exists. Please use --force to overwrite existing archives.')
+                os.remove(existing)
+        if not os.path.isdir(input_directory):
+            raise NotADirectoryError('Only the archiving of directories is currently supported.')
+        if os.path.isdir(output_file):
+            raise IsADirectoryError('Cannot specify existing directory as output. Output must be named *{} file.'.format(suffix))
+
+        base_folder = os.path.basename(os.path.normpath(input_directory))
+        root_folder_name = f'{base_folder}.zb'
+        payload_arcname = os.path.join(root_folder_name, PAYLOAD_DIRECTORY)
+        metadata = {
+            ZB_VERSION: CURRENT_ZENODO_BACKPACK_VERSION,
+            DATA_VERSION: data_version,
+            PAYLOAD_DIRECTORY_KEY: PAYLOAD_DIRECTORY,
+        }
+        if hash_algorithm != MD5:
+            metadata[ZB_VERSION] = CHECKSUMS_ZENODO_BACKPACK_VERSION
+            metadata[HASH_ALGORITHM] = hash_algorithm
+        if chunk_size is not None:
+            metadata[CHUNK_SIZE] = chunk_size
+
+        # Checksums are written to CONTENTS.json (and the manifest) as each
+        # file is hashed, so that they are never all held in memory
+        tmpdir = tempfile.TemporaryDirectory()
+        contents_json = os.path.join(tmpdir.name, 'CONTENTS.json')
+        contents_manifest = os.path.join(tmpdir.name, MANIFEST_FILE) if manifest else None
+        writer = None
+        archive = None
+        try:
+            with _ContentsWriter(contents_json, contents_manifest, MD5SUMS if hash_algorithm == MD5 else CHECKSUMS,
+                                 previous.checksums() if previous is not None else None) as contents:
+                if single_pass:
+                    logging.info('Creating archive at: {}'.format(output_file))
+                    writer, archive = self._open_archive(output_file, compression, compression_level, max_workers,
+                                                         index)
+                    self._add_and_hash(archive, input_directory, payload_arcname, '/' + PAYLOAD_DIRECTORY, contents,
+                                       hash_algorithm, chunk_size)
+                else:
+                    logging.info('Reading files and calculating checksums.')
+                    files = ((key, entry.path) for key, entry in self._scan(input_directory, '/' + PAYLOAD_DIRECTORY)
+                             if entry.is_file())
+                    for key, digest, chunks in self._hash_files(files, max_workers, hash_algorithm, chunk_size):
+                        contents.add(key, digest, chunks)
+                contents.close(metadata)
+
+            if single_pass:
+                archive.add(contents_json, os.path.join(root_folder_name, 'CONTENTS.json'))
+                if manifest:
+                    archive.add(contents_manifest, os.path.join(root_folder_name, MANIFEST_FILE))
+            else:
+                logging.info('Creating archive at: {}'.format(output_file))
+
+                writer, archive = self._open_archive(output_file, compression, compression_level, max_workers, index)
+
+                archive.add(contents_json, os.path.join(root_folder_name, 'CONTENTS.json'))
+                if manifest:
+                    archive.add(contents_manifest, os.path.join(root_folder_name, MANIFEST_FILE))
+                # TarFile.add visits each directory in sorted order, as _scan does
+                archive.add(input_directory, arcname=payload_arcname)
+            archive.close()
+            writer.close()
+            if index:
+                with open(index_file, 'w') as f:
+                    json.dump({_index.ARCHIVE: os.path.basename(output_file),
+                               _index.MEMBERS: archive.members_index}, f)
+
+            if previous is not None:
+                self._write_delta(delta_file, input_directory, root_folder_name, contents_json, contents_manifest,
+                                  contents.changed, previous.data_version_string(), tmpdir.name, compression,
+                                  compression_level, max_workers)
+        except BaseException:
+            # Leave no partial archive behind
+            if archive is not None:
+                archive.close()
+            if writer is not None:
+                writer.close()
+                os.remove(output_file)
+            if index_file is not None and os.path.exists(index_file):
+                os.remove(index_file)
+            raise
+        finally:
+            tmpdir.cleanup()
+
+        logging.info('ZenodoBackpack created successfully!')
+
+    def _open_archive(self, output_file, compression, compression_level, max_workers, index):
+        writer = _compression.open_writer(output_file, compression, compression_level, max_workers, indexed=index)
+        try:
+            if index:
+                # Written straight through, so that members start where the index says
+                return writer, _index.IndexingTarFile.open(fileobj=writer, mode="w", dereference=True)
+            return writer, tarfile.open(fileobj=writer, mode="w|", dereference=True)
+        except BaseException:
+            writer.close()
+            raise
+
+    def _write_delta(self, delta_file, input_directory, root_folder_name, contents_json, contents_manifest, changed,
+                     base_version, tmpdir, compression, compression_level, max_workers):
+        """Write a delta archive holding DELTA.json, the contents files and the
+        changed payload files, given by their keys in CONTENTS.json."""
+        logging.info('Creating delta archive of {} changed files at: {}'.format(len(changed), delta_file))
+        delta_json = os.path.join(tmpdir, _delta.DELTA_FILE)
+        with open(delta_json, 'w') as f:
+            json.dump({_delta.BASE_VERSION: base_version, _delta.FILES: changed}, f)
+        payload_arcname = os.path.join(root_folder_name, PAYLOAD_DIRECTORY)
+        prefix = '/' + PAYLOAD_DIRECTORY + '/'
+
+        writer = _compression.open_writer(delta_file, compression, compression_level, max_workers)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|", dereference=True) as archive:
+                # DELTA.json first, so that a delta for another version is abandoned early
+                archive.add(delta_json, os.path.join(root_folder_name, _delta.DELTA_FILE))
+                archive.add(contents_json, os.path.join(root_folder_name, 'CONTENTS.json'))
+                if contents_manifest is not None:
+                    archive.add(contents_manifest, os.path.join(root_folder_name, MANIFEST_FILE))
+                archive.add(input_directory, arcname=payload_arcname, recursive=False)
+                for key in changed:
+                    archive.add(os.path.join(input_directory, key[len(prefix):]),
+                                arcname=os.path.join(payload_arcname, key[len(prefix):]), recursive=False)
+            writer.close()
+        except BaseException:
+            writer.close()
+            os.remove(delta_file)
+            raise
+
+    def _checksum_file(self, file, algorithm=MD5, chunk_size=None):
+        """Computes checksum of file.
+        Arguments:
+            file (str): Path of file to checksum
+            algorithm (str): One of HASH_ALGORITHMS
+            chunk_size (int): If given, also hash each chunk_size piece
+        Returns:
+            str: hex digest, or a (hex digest, chunk hex digests or None)
+            tuple if chunk_size is given
+        """
+        return _hash_file(file, algorithm, chunk_size)
+
+    def _add_and_hash(self, archive, directory, arcname, key, contents, algorithm=MD5, chunk_size=None):
+        """Add directory to archive in the same way as TarFile.add, recording
+        the checksum of each regular file in contents as its data is written.
+        Arguments:
+            archive (TarFile): Archive being written
+            directory (str): Directory to add
+            arcname (str): Name of directory within the archive
+            key (str): Name of directory within CONTENTS.json
+            contents (_ContentsWriter): Given the checksum of each file
+            algorithm (str): One of HASH_ALGORITHMS
+            chunk_size (int): If given, also hash each chunk_size piece of
+                files larger than chunk_size
+        """
+        archive.addfile(archive.gettarinfo(directory, arcname))
+        for entry_key, entry in self._scan(directory, key):
+            try:
+                tarinfo = archive.gettarinfo(entry.path, arcname + entry_key[len(key):])
+            except FileNotFoundError:
+                if entry.is_symlink():
+                    raise BrokenSymlinkException(entry.path)
+                raise
+            if tarinfo.isreg():
+                if chunk_size is not None and tarinfo.size > chunk_size:
+                    hasher = _ChunkHasher(algorithm, chunk_size)
+                else:
+                    hasher = new_hasher(algorithm)
+                with open(entry.path, 'rb') as f:
+                    archive.addfile(tarinfo, _HashingReader(f, hasher))
+                chunks = hasher.chunk_hexdigests() if isinstance(hasher, _ChunkHasher) else None
+                contents.add(entry_key, hasher.hexdigest(), chunks)
+            else:
+                archive.addfile(tarinfo)
+
+    def _scan(self, directory, key):
+        """Yield (key, DirEntry) for everything within directory, where key is
+        the entry's path below directory appended to the given key. Entries
+        are yielded in sorted order, each directory before its contents, so
+        that the order is reproducible and matches that of a manifest.
+        Symbolic links are followed, as they are when archiving. Directories
+        are scanned one at a time rather than recursively, and the DirEntry
+        type information is used so that most entries are not stat()ed.
+        Raises BrokenSymlinkException for a link to nothing.
+        """
+        stack = [(iter(self._sorted_entries(directory)), key)]
+        while stack:
+            entries, prefix = stack[-1]
+            for entry in entries:
+                entry_key = prefix + '/' + entry.name
+                if not entry.is_dir() and not entry.is_file() and entry.is_symlink() \
+                        and not os.path.exists(entry.path):
+                    raise BrokenSymlinkException(entry.path)
+                yield entry_key, entry
+                if entry.is_dir():
+                    stack.append((iter(self._sorted_entries(entry.path)), entry_key))
+                    break
+            else:
+                stack.pop()
+
+    def _sorted_entries(self, directory):
+        with os.scandir(directory) as it:
+            return sorted(it, key=lambda entry: entry.name)
+
+    def _hash_files(self, files, max_workers, algorithm=MD5, chunk_size=None):
+        """Yield (key, checksum, chunk checksums or None) for each (key, path)
+        of files, in the same order. Up to max_workers files are hashed at
+        once, reading only a few files ahead so that memory use does not grow
+        with the number of files.
+        """
+        if max_workers <= 1:
+            for key, path in files:
+                yield (key,) + self._checksums(path, algorithm, chunk_size)
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = collections.deque()
+            for key, path in files:
+                pending.append((key, executor.submit(self._checksums, path, algorithm, chunk_size)))
+                if len(pending) >= max_workers * 4:
+                    done_key, future = pending.popleft()
+                    yield (done_key,) + future.result()
+            while pending:
+                done_key, future = pending.popleft()
+                yield (done_key,) + future.result()
+
+    def _checksums(self, path, algorithm, chunk_size):
+        if chunk_size is None:
+            return self._checksum_file(path, algorithm), None
+        return self._checksum_file(path, algorithm, chunk_size)
+
+
+class _ContentsWriter:
+    """Writes CONTENTS.json, and optionally a manifest, one file at a time,
+    in the same form as json.dump of the whole contents would. Files must be
+    added in the sorted order of ZenodoBackpackCreator._scan."""
+
+    def __init__(self, contents_json, manifest=None, key=MD5SUMS, previous=None):
+        self.f = open(contents_json, 'w')
+        self.f.write('{{{}: {{'.format(json.dumps(key)))
+        self.manifest = ManifestWriter(manifest) if manifest else None
+        self.count = 0
+        # Only files larger than a chunk have these, so there are few
+        self.chunks = {}
+        # Given the checksums of a previous version, the keys of files which
+        # are new or changed since
+        self.previous = previous
+        self.changed = []
+
+    def add(self, key, digest, chunks=None):
+        self.f.write('{}{}: {}'.format(', ' if self.count else '', json.dumps(key), json.dumps(digest)))
+        if self.manifest is not None:
+            self.manifest.add(key, digest)
+        if chunks is not None:
+            self.chunks[key] = chunks
+        if self.previous is not None and self.previous.get(key) != digest:
+            self.changed.append(key)
+        self.count += 1
+
+    def close(self, metadata):
+        if CHUNK_SIZE in metadata:
+            metadata = dict(metadata)
+            metadata[CHUNK_CHECKSUMS] = self.chunks
+        self.f.write('}')
+        for key, value in metadata.items():
+            self.f.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        self.f.write('}')
+        self.f.close()
+        if self.manifest is not None:
+            self.manifest.close(metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+        if self.manifest is not None:
+            self.manifest.discard()
@@ -0,0 +1,42 @@
+'''Delta archives, which move an installed backpack to a new data version.
+
+A delta archive is made by ZenodoBackpackCreator.create(delta_from=...)
+alongside the full archive, and uploaded to the same Zenodo record. It is
+named as the full archive with DELTA_ARCHIVE_MARKER in place of '.zb', and
+holds, in order:
+
+    DELTA.json      the data version it applies to, under BASE_VERSION, and
+                    the payload files it holds, under FILES
+    CONTENTS.json   as in the full archive, and CONTENTS.zbm if there is one
+    payload         only the payload files which are new or have changed
+                    since the base version
+
+ZenodoBackpackDownloader.update reads DELTA.json first, so that a delta for
+another base version is abandoned after its first few bytes. Payload files
+whose checksum is the same in both versions are hard-linked, or copied,
+from the installed backpack. Full downloads skip delta archives.
+'''
+
+from .compression import ARCHIVE_SUFFIXES
+
+DELTA_FILE = 'DELTA.json'
+DELTA_ARCHIVE_MARKER = '.zbdelta'
+BASE_VERSION = 'base_version'
+FILES = 'files'
+
+
+def is_delta_archive(filename):
+    '''Return True if filename is named as a delta archive.'''
+    return any(filename.endswith(DELTA_ARCHIVE_MARKER + suffix) for suffix in ARCHIVE_SUFFIXES.values())
+
+
+def delta_archive_name(archive):
+    '''Return the name of the delta archive to go with a full archive, with
+    DELTA_ARCHIVE_MARKER in place of any '.zb' before its suffix.'''
+    for suffix in ARCHIVE_SUFFIXES.values():
+        if archive.endswith(suffix):
+            stem = archive[:-len(suffix)]
+            if stem.endswith('.zb'):
+                stem = stem[:-len('.zb')]
+            return stem + DELTA_ARCHIVE_MARKER + suffix
+    raise ValueError('{} is not named as a backpack archive'.format(archive))
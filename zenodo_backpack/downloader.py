@@ -0,0 +1,1647 @@
+'''Downloading backpacks from Zenodo, and verifying them against their
+CONTENTS.json.'''
+
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import requests
+
+from . import compression
+from . import events
+from .delta import DELTA_FILE, BASE_VERSION, FILES, is_delta_archive
+from .index import ARCHIVE, MEMBERS, is_index_file
+from .backpack import ZenodoBackpack, ZenodoBackpackMalformedException, ZenodoBackpackVersionException, \
+    ZenodoConnectionException, ZenodoDownloadException, DownloadCancelledException, ZenodoBackpackChecksumException, \
+    SUPPORTED_ZENODO_BACKPACK_VERSIONS, MD5SUMS, CHECKSUMS, HASH_ALGORITHM
+from .events import EventDispatcher, TqdmProgress
+from .hashing import MD5, new_hasher, _hash_file, _stat_signature, _hash_payload_file, _hash_payload_range
+from .locking import DownloadLock, LOCK_STALE_AFTER, LOCK_HEARTBEAT_INTERVAL, LOCK_POLL_INTERVAL
+from .manifest import MANIFEST_FILE
+from .metadata_cache import MetadataCache, METADATA_CACHE_TTL
+from .remote import RemoteZenodoBackpack
+from .retry import RetryPolicy, is_retryable
+from .store import ObjectStore, link_or_copy
+
+DOI_RESOLVER_URL = 'https://doi.org/'
+ZENODO_RECORDS_URL = 'https://zenodo.org/api/records/'
+# Held in the output directory while a download is in progress
+DOWNLOAD_LOCK_FILE = '.zb_download.lock'
+# Files are downloaded and extracted here, then moved into the output directory
+DOWNLOAD_STAGING_DIRECTORY = '.zb_download'
+# Connections kept alive to each host by a downloader's session
+HTTP_POOL_SIZE = 32
+
+# Files at least this large are downloaded as several byte ranges at once
+SEGMENTED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+DOWNLOAD_SEGMENTS = 4
+
+# Fraction of the payload verified by acquire(verify='quick')
+QUICK_VERIFY_FRACTION = 0.01
+# Largest file hashed whole by a quick verification whose fraction covers no
+# file or chunk, so that small backpacks still have one file checked
+QUICK_VERIFY_MAX_FILE_SIZE = 16 * 1024 * 1024
+
+# Sidecar next to CONTENTS.json recording the stat signature and digest of
+# each payload file when it was last verified
+VERIFICATION_CACHE_FILE = '.zb_verification_cache.json'
+# Files modified this recently are not cached, since a later change within
+# the same mtime tick would go unnoticed
+VERIFICATION_CACHE_RACY_NS = 2 * 10**9
+# Sidecar next to CONTENTS.json recording the files of the Zenodo record the
+# backpack was downloaded from, so that a process which waited for the
+# download lock only uses the backpack if it came from the record it wants
+DOWNLOAD_SOURCE_FILE = '.zb_download_source.json'
+
+
+def _record_files(files):
+    """Return the key and checksum of each file of a record which makes up
+    its backpack, leaving out index files and delta archives."""
+    return sorted([f['key'], f['checksum']] for f in files
+                  if not is_index_file(f['key']) and not is_delta_archive(f['key']))
+
+
+def _hash_verify_part(part, algorithm):
+    """Hash a (path, offset, length) part of a payload file, or the whole file
+    if offset is None, as _hash_payload_file does."""
+    path, offset, length = part
+    if offset is None:
+        return _hash_payload_file(path, algorithm)
+    return _hash_payload_range(path, offset, length, algorithm)
+
+
+def _hashed_bytes(offset, length, signature):
+    if signature is None:
+        return 0
+    if offset is None:
+        return signature[0]
+    return max(0, min(length, signature[0] - offset))
+
+
+class ZenodoBackpackDownloader:
+
+    segment_threshold = SEGMENTED_DOWNLOAD_THRESHOLD
+    doi_resolver_url = DOI_RESOLVER_URL
+    records_url = ZENODO_RECORDS_URL
+    lock_stale_after = LOCK_STALE_AFTER
+    lock_heartbeat_interval = LOCK_HEARTBEAT_INTERVAL
+    lock_poll_interval = LOCK_POLL_INTERVAL
+
+    def __init__(self, session=None, metadata_cache_directory=None, metadata_cache_ttl=METADATA_CACHE_TTL, offline=False,
+                 max_connections=None, bandwidth_limit=None, retry_policy=None, callbacks=None,
+                 object_store_directory=None):
+        '''
+        Parameters
+        ----------
+        session: requests.Session
+            Session used for all requests. If None, one is created when first
+            needed, keeping connections alive between requests.
+        metadata_cache_directory: None or str
+            If given, cache the metadata of each DOI and version here.
+            Metadata of a pinned version is always taken from the cache, and
+            that of the newest version once it is older than
+            metadata_cache_ttl seconds is revalidated with an If-None-Match
+            request. Stale metadata is used if Zenodo cannot be reached.
+        metadata_cache_ttl: float
+            Seconds for which metadata of the newest version is used without
+            checking with Zenodo.
+        offline: bool
+            If True, take metadata from the cache alone, never contacting
+            doi.org or the Zenodo API. Requires metadata_cache_directory.
+        max_connections: None or int
+            If given, open at most this many connections to each host at once,
+            with requests waiting for a free connection. Applies to the session
+            created by the downloader, so cannot be used with session.
+        bandwidth_limit: None or float
+            If given, limit the total rate of all downloads made by this
+            downloader to this many bytes per second.
+        retry_policy: None or RetryPolicy
+            When and how often to retry failed requests, and downloads which
+            stop part way. If None, a default RetryPolicy is used.
+        callbacks: None or list
+            Functions called with each event describing progress and timing,
+            as documented in zenodo_backpack.events. More can be added with
+            self.events.add().
+        object_store_directory: None or str
+            If given, keep each distinct payload file of the backpacks
+            downloaded once, in a content-addressed store in this directory,
+            with backpacks holding hard links to it. Files already in the
+            store are linked rather than extracted, and are not hashed again
+            by verify. See zenodo_backpack.store.
+        '''
+        if session is not None and max_connections is not None:
+            raise ValueError('max_connections cannot be used with a session passed in.')
+        self.max_connections = max_connections
+        self.bandwidth_limiter = _BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.events = EventDispatcher(callbacks)
+        self._session = session
+        self._session_lock = threading.Lock()
+        if metadata_cache_directory is not None:
+            self.metadata_cache = MetadataCache(metadata_cache_directory, metadata_cache_ttl)
+        else:
+            self.metadata_cache = None
+        if offline and self.metadata_cache is None:
+            raise ValueError('Offline mode requires a metadata cache directory.')
+        self.offline = offline
+        self.object_store = ObjectStore(object_store_directory) if object_store_directory is not None else None
+
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+                if self.max_connections is None:
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+                else:
+                    # Block until a connection is free rather than opening another
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=HTTP_POOL_SIZE, pool_maxsize=self.max_connections, pool_block=True)
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def _get(self, url, attempts=None, **kwargs):
+        """GET url with the session, retrying as set by the retry policy, for
+        at most attempts tries if given."""
+        return self.retry_policy.get(self.session, url, attempts=attempts, **kwargs)
+
+    def download_and_extract(self, directory, doi, check_version=True, progress_bar=False, download_retries=3, version=None, max_workers=1, segments=DOWNLOAD_SEGMENTS, stream_extract=False, lock=True, lock_timeout=None):
+        """Actually do the download, to a given path. Also extract the archive,
+        and then call verify on it.
+
+        Files are downloaded and extracted into a staging directory inside
+        directory, and only moved into place once all have been checked, so
+        an interrupted download never leaves a partly extracted backpack
+        behind. Unless lock is False, the download holds a lock on directory
+        so that processes downloading into it at once do not interfere. A
+        process which had to wait for the lock uses the backpack downloaded by
+        the lock holder if there is one of the expected version.
+
+        Parameters
+        ----------
+        directory: str
+            Where to download to
+        doi: str
+            DOI of the Zenodo series
+        progress_bar: bool
+            If True, display graphical progress bar while downloading from Zenodo
+        check_version: bool
+            If True, check Zenodo metadata verifies
+        download_retries: int
+            Number of download attempts, at least 1
+        version: None or str
+            If None, return the newest version. If specified, target that specific version.
+        max_workers: int
+            Number of files in the record to download, check and extract at
+            the same time.
+        segments: int
+            Number of connections used to download each file larger than
+            segment_threshold, each fetching a separate byte range.
+        stream_extract: bool
+            If True, extract each archive as it is downloaded instead
+            of saving it to disk first. Each payload file is checked against
+            CONTENTS.json as it is written, so they are not read again
+            afterwards. Interrupted downloads cannot be resumed in this mode.
+        lock: bool
+            If True, hold a lock on directory while downloading.
+        lock_timeout: None or float
+            Seconds to wait for another process's lock on directory before
+            raising DownloadLockTimeoutException. If None, wait indefinitely.
+
+        Returns a ZenodoBackpack object containing the downloaded files
+        """
+        # get record via DOI, then read in json metadata from records_url
+        if doi is None:
+            raise ZenodoConnectionException('Record could not get accessed.')
+        metadata, files = self._resolve_metadata(doi, version)
+        return self._download_and_extract_resolved(
+            directory, metadata, files, check_version, progress_bar, download_retries, max_workers, segments,
+            stream_extract, lock, lock_timeout)
+
+    def update(self, zenodo_backpack, doi, version=None, directory=None, check_version=True, progress_bar=False,
+               download_retries=3, max_workers=1, segments=DOWNLOAD_SEGMENTS, lock=True, lock_timeout=None):
+        """Move an installed backpack to another version of the same DOI.
+
+        If the record of that version has a delta archive made from the
+        installed version (see zenodo_backpack.delta), only the payload files
+        which changed are downloaded, and the rest are hard-linked, or copied
+        where they cannot be, from the installed backpack. Otherwise the
+        whole version is downloaded as by download_and_extract. Either way,
+        the new version is staged and then replaces the installed backpack if
+        it is in directory.
+
+        Unchanged files are not hashed again, so are trusted to match the
+        installed CONTENTS.json; acquire(..., md5sum=True) checks them too.
+
+        Parameters
+        ----------
+        zenodo_backpack: ZenodoBackpack
+            Installed backpack
+        doi: str
+            DOI of the Zenodo series
+        version: None or str
+            Version to update to. If None, the newest version.
+        directory: None or str
+            Where to put the new version. If None, the directory holding the
+            installed backpack, which it then replaces.
+        check_version, progress_bar, download_retries, max_workers, segments, lock, lock_timeout:
+            As for download_and_extract
+
+        Returns a ZenodoBackpack of the new version
+        """
+        if doi is None:
+            raise ZenodoConnectionException('Record could not get accessed.')
+        metadata, files = self._resolve_metadata(doi, version)
+        if directory is None:
+            directory = os.path.dirname(os.path.abspath(zenodo_backpack.base_directory))
+        if str(zenodo_backpack.data_version_string()).strip() == str(metadata['metadata']['version']).strip() \
+                and os.path.dirname(os.path.abspath(zenodo_backpack.base_directory)) == os.path.abspath(directory):
+            logging.info('Backpack is already at version {}'.format(zenodo_backpack.data_version_string()))
+            return zenodo_backpack
+        return self._download_and_extract_resolved(
+            directory, metadata, files, check_version, progress_bar, download_retries, max_workers, segments,
+            lock=lock, lock_timeout=lock_timeout, base=zenodo_backpack)
+
+    def open_remote(self, directory, doi, version=None, check_version=True):
+        """Open a backpack from its Zenodo record without downloading it, so
+        that each payload file is fetched only when first asked for. The
+        record must hold an indexed archive, made by
+        ZenodoBackpackCreator.create(index=True).
+
+        The index and the contents files are fetched into directory when the
+        backpack is opened, and payload files beneath them as they are
+        fetched, so that a later open_remote into the same directory reuses
+        them.
+
+        Parameters
+        ----------
+        directory: str
+            Where fetched files are kept
+        doi: str
+            DOI of the Zenodo series
+        version: None or str
+            If None, open the newest version. If specified, that version.
+        check_version: bool
+            If True, check that the version matches the Zenodo metadata
+
+        Returns a RemoteZenodoBackpack, whose fetch(path) gives the local path
+        of a payload file
+        """
+        if doi is None:
+            raise ZenodoConnectionException('Record could not get accessed.')
+        metadata, files = self._resolve_metadata(doi, version)
+        indexes = [f for f in files if is_index_file(f['key'])]
+        if not indexes:
+            raise ZenodoBackpackMalformedException(
+                'Version {} of {} has no archive index, so cannot be read remotely'.format(
+                    metadata['metadata']['version'], doi))
+        self._make_sure_path_exists(directory)
+        index, changed = self._load_index(directory, indexes[0])
+
+        archives = [f for f in files if f['key'].split('/')[-1] == index[ARCHIVE]]
+        if not archives:
+            raise ZenodoBackpackMalformedException('The record has no archive {}, which {} indexes'.format(
+                index[ARCHIVE], indexes[0]['key']))
+        zb_folder = next(iter(index[MEMBERS])).split('/')[0]
+        if changed and os.path.isdir(os.path.join(directory, zb_folder)):
+            logging.info('Removing files fetched from another version of the archive')
+            shutil.rmtree(os.path.join(directory, zb_folder))
+        zb = RemoteZenodoBackpack(os.path.join(directory, zb_folder), archives[0]['links']['self'],
+                                  index[MEMBERS], self)
+        if check_version:
+            self.verify(zb, metadata=metadata, checksums=False)
+        return zb
+
+    def _load_index(self, directory, f):
+        """Return an archive index, downloading it into directory unless an
+        unchanged copy is there already, and whether it was downloaded."""
+        path = os.path.join(directory, f['key'].split('/')[-1])
+        changed = not os.path.isfile(path) or not self._check_hash(path, f['checksum'])
+        if changed:
+            logging.info('Downloading archive index {}'.format(f['key']))
+            with self.events.phase(events.DOWNLOAD, file=f['key'], index=True) as info:
+                self._download_file(f['links']['self'], path, size=f.get('size'), checksum=f['checksum'])
+                info['bytes'] = os.path.getsize(path)
+            if not self._check_hash(path, f['checksum']):
+                os.remove(path)
+                raise ZenodoBackpackMalformedException(
+                    f"Checksum is incorrect for downloaded file '{f['key']}'. Please download again.")
+        with open(path) as index_file:
+            return json.load(index_file), changed
+
+    def _download_and_extract_resolved(self, directory, metadata, files, check_version=True, progress_bar=False,
+                                       download_retries=3, max_workers=1, segments=DOWNLOAD_SEGMENTS,
+                                       stream_extract=False, lock=True, lock_timeout=None, base=None):
+        """download_and_extract, given the metadata and files of the record.
+        If base is an installed backpack, update it using a delta archive
+        where the record has one which applies."""
+        self._make_sure_path_exists(directory)
+        if not lock:
+            return self._download_and_extract_into(
+                directory, metadata, files, check_version, progress_bar, download_retries, max_workers, segments,
+                stream_extract, base)
+
+        with self._download_lock(directory, lock_timeout) as download_lock:
+            if download_lock.waited:
+                zb = self._downloaded_by_lock_holder(directory, metadata, files, check_version)
+                if zb is not None:
+                    return zb
+            return self._download_and_extract_into(
+                directory, metadata, files, check_version, progress_bar, download_retries, max_workers, segments,
+                stream_extract, base)
+
+    def _download_lock(self, directory, lock_timeout=None):
+        """Return the DownloadLock of directory, not yet acquired."""
+        return DownloadLock(os.path.join(directory, DOWNLOAD_LOCK_FILE), timeout=lock_timeout,
+                            stale_after=self.lock_stale_after, heartbeat_interval=self.lock_heartbeat_interval,
+                            poll_interval=self.lock_poll_interval)
+
+    def _downloaded_by_lock_holder(self, directory, metadata, files, check_version):
+        """After waiting for the lock on directory, return the backpack which
+        its holder downloaded from the same record, or None if there is none."""
+        zb = self._find_extracted_backpack(directory, metadata, files)
+        if zb is not None:
+            logging.info('Using backpack {} downloaded by another process'.format(zb.base_directory))
+            if check_version:
+                self.verify(zb, metadata=metadata, checksums=False)
+        return zb
+
+    def _download_and_extract_into(self, directory, metadata, files, check_version, progress_bar, download_retries,
+                                   max_workers, segments, stream_extract, base=None):
+        """Download and extract the files of a record into a staging directory,
+        move them into directory, then open and verify the backpack."""
+        staging, files, partial = self._start_staging(directory, files)
+
+        # Delta archives are only of use when updating
+        deltas = [f for f in files if is_delta_archive(f['key'])]
+        files = [f for f in files if not is_delta_archive(f['key'])]
+        zb_folders = None
+        if base is not None and deltas:
+            zb_folder = self._apply_deltas(staging, base, deltas, partial)
+            if zb_folder is not None:
+                # Files other than archives are downloaded as usual
+                others = [f for f in files if compression.archive_compression(f['key']) is None]
+                zb_folders = self._download_and_extract_files(
+                    staging, others, progress_bar, download_retries, max_workers, segments) + [zb_folder]
+                # Changed files were checked as they arrived, and others are linked from base
+                stream_extract = True
+        if zb_folders is None:
+            zb_folders = self._download_and_extract_files(
+                staging, files, progress_bar, download_retries, max_workers, segments, stream_extract)
+        logging.debug('All files have been downloaded.')
+        return self._finish_staging(directory, staging, partial, zb_folders, metadata, files, check_version,
+                                    stream_extract, max_workers)
+
+    def _start_staging(self, directory, files):
+        """Make the staging directory of directory ready for the files of a
+        record.
+
+        Returns the staging directory, the files to download there, and the
+        names of the partial downloads they may leave in it.
+        """
+        staging = os.path.join(directory, DOWNLOAD_STAGING_DIRECTORY)
+        self._make_sure_path_exists(staging)
+        # Archive indexes are only of use for reading files remotely
+        files = [f for f in files if not is_index_file(f['key'])]
+        # Anything but partial downloads of this record is left over from an
+        # interrupted extraction, or from a download of another record
+        partial = self._partial_download_names(files)
+        self._clear_staging(staging, partial)
+        return staging, files, partial
+
+    def _finish_staging(self, directory, staging, partial, zb_folders, metadata, files, check_version,
+                        stream_extract, max_workers):
+        """Move what was downloaded and extracted into staging to directory,
+        then open and verify the backpack and record the files of the record
+        it came from."""
+        for entry in os.listdir(staging):
+            if entry in partial:
+                # Only left by files which were not needed after all
+                continue
+            target = os.path.join(directory, entry)
+            if os.path.isdir(target) and not os.path.islink(target):
+                # Directories cannot be replaced in one step, so move the old one aside first
+                old = os.path.join(staging, '.old.' + entry)
+                os.rename(target, old)
+                os.rename(os.path.join(staging, entry), target)
+                shutil.rmtree(old)
+            else:
+                os.replace(os.path.join(staging, entry), target)
+        shutil.rmtree(staging)
+
+        # Payload files extracted from a stream have already been checked
+        zb = self._open_extracted_backpack(directory, zb_folders, metadata, check_version,
+                                           checksums=not stream_extract, max_workers=max_workers)
+        if self.object_store is not None:
+            self.object_store.add_backpack(zb)
+        self._save_download_source(zb, files)
+        return zb
+
+    def _save_download_source(self, zenodo_backpack, files):
+        path = os.path.join(zenodo_backpack.base_directory, DOWNLOAD_SOURCE_FILE)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'files': _record_files(files)}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.debug('Could not write download source {}: {}'.format(path, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _load_download_source(self, zenodo_backpack):
+        """Return the files of the record a backpack was downloaded from, or
+        None if they were not recorded."""
+        try:
+            with open(os.path.join(zenodo_backpack.base_directory, DOWNLOAD_SOURCE_FILE)) as f:
+                return json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _find_extracted_backpack(self, directory, metadata, files=None):
+        """Return a backpack in a subdirectory of directory with the data
+        version given in the metadata, or None if there is none. If files are
+        given, the backpack must also have been downloaded from a record with
+        those files, so that another record of the same version is not taken
+        for it."""
+        version = str(metadata['metadata']['version']).strip()
+        for entry in sorted(os.listdir(directory)):
+            if not os.path.isfile(os.path.join(directory, entry, 'CONTENTS.json')):
+                continue
+            try:
+                zb = ZenodoBackpack(os.path.abspath(os.path.join(directory, entry)))
+                if str(zb.data_version_string()).strip() != version:
+                    continue
+                if files is not None and self._load_download_source(zb) != _record_files(files):
+                    continue
+                return zb
+            except (ZenodoBackpackMalformedException, KeyError):
+                continue
+        return None
+
+    def _partial_download_names(self, files):
+        """Names of the partial download files which the files of a record
+        may leave in the staging directory."""
+        names = set()
+        for f in files:
+            filename = f['key'].split('/')[-1]
+            names.update((filename + '.part', filename + '.part.json'))
+        return names
+
+    def _clear_staging(self, staging, keep=()):
+        """Remove everything in staging but the entries named in keep."""
+        for entry in os.listdir(staging):
+            if entry not in keep:
+                self._remove_path(os.path.join(staging, entry))
+
+    def _remove_path(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def _open_extracted_backpack(self, directory, zb_folders, metadata, check_version, checksums=True, max_workers=1):
+        """Open and verify the backpack extracted into directory, given the
+        common prefix of each file of the record (None for non-archives)."""
+        zb_folders = [folder for folder in zb_folders if folder is not None]
+        if len(zb_folders) == 0:
+            raise ZenodoBackpackMalformedException('No .tar.gz or .tar.zst archive was found in the Zenodo record.')
+        zb_folder = os.path.abspath(os.path.join(directory, zb_folders[-1]))
+
+        zb = ZenodoBackpack(zb_folder)
+
+        if not check_version:
+            self.verify(zb, checksums=checksums, max_workers=max_workers)
+        else:
+            self.verify(zb, metadata=metadata, checksums=checksums, max_workers=max_workers)
+
+        return zb
+
+    def _download_and_extract_files(self, directory, files, progress_bar, download_retries, max_workers, segments=1, stream_extract=False):
+        """Download, check and extract each file of a record using a pool of
+        max_workers threads. The first failure cancels the remaining files and
+        is re-raised.
+
+        Returns a list, in the same order as files, of the common prefix of
+        each extracted archive, or None for files that are not archives.
+        """
+        cancel = threading.Event()
+        if progress_bar:
+            progress = TqdmProgress(total=sum(int(f.get('size', 0)) for f in files))
+            self.events.add(progress)
+        else:
+            progress = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futures = [
+                    executor.submit(self._download_and_extract_file, directory, f, download_retries, cancel, segments, stream_extract)
+                    for f in files]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    cancel.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            if progress is not None:
+                self.events.remove(progress)
+                progress.close()
+
+        return [future.result() for future in futures]
+
+    def _download_and_extract_file(self, directory, f, download_retries, cancel=None, segments=1, stream_extract=False):
+        """Download a single file of a record, check its hash and extract it if
+        it is a .tar.gz or .tar.zst archive. With stream_extract, archives are extracted
+        while they download.
+
+        Returns the common prefix of the archive member names, or None if the
+        file is not an archive.
+        """
+        if download_retries < 1:
+            raise ValueError('download_retries must be at least 1, not {}'.format(download_retries))
+        link = f['links']['self']
+        filename = f['key'].split('/')[-1]
+        checksum = f['checksum']
+        filepath = os.path.join(directory, filename)
+
+        file_progress = _FileProgress(self.events, filename)
+        archive_compression = compression.archive_compression(filename)
+        stream = stream_extract and archive_compression is not None
+
+        # download_retries attempts, each continuing from where the last one
+        # stopped. Each makes its requests once, so that the retry policy
+        # counts these attempts rather than retrying within them.
+        with self.events.phase(events.DOWNLOAD, file=filename, stream_extract=stream) as info:
+            info['bytes'] = int(f.get('size', 0))
+            for attempt in range(download_retries):
+                try:
+                    if stream:
+                        return self._stream_extract_file(link, directory, checksum, archive_compression, file_progress,
+                                                         cancel, attempts=1)
+                    digest = self._download_file(link, filepath, progress=file_progress, cancel=cancel,
+                                        size=f.get('size'), segments=segments, checksum=checksum, attempts=1)
+                except Exception as e:
+                    file_progress.rewind()
+                    if not is_retryable(e):
+                        raise
+                    delay = self.retry_policy.download_retry_delay(link, attempt, download_retries, e)
+                    if delay is None:
+                        raise ZenodoConnectionException('Too many unsuccessful retries. Download is aborted') from e
+                    # Back off before continuing from where this attempt stopped
+                    if cancel is None:
+                        time.sleep(delay)
+                    elif cancel.wait(delay):
+                        raise DownloadCancelledException(link)
+                else:
+                    break
+
+        if digest is not None:
+            # Hashed as it was downloaded, so no need to read the file again
+            correct = digest == checksum.split(':')[-1]
+        else:
+            with self.events.phase(events.HASH, file=filename, bytes=int(f.get('size', 0))):
+                correct = self._check_hash(filepath, checksum)
+        if correct:
+            logging.debug('Correct checksum for downloaded file.')
+        else:
+            os.remove(filepath)
+            raise ZenodoBackpackMalformedException(
+                f"Checksum is incorrect for downloaded file '{filename}'. Please download again.")
+
+        if archive_compression is None:
+            return None
+        return self._extract_archive(filepath, directory, archive_compression)
+
+    def _extract_archive(self, filepath, directory, archive_compression=compression.GZIP):
+        """Extract a downloaded archive into directory, then remove it.
+
+        Returns the common prefix of the archive member names.
+        """
+        logging.debug('Extracting {}'.format(filepath))
+        with self.events.phase(events.EXTRACT, file=os.path.basename(filepath), bytes=os.path.getsize(filepath)), \
+                open(filepath, 'rb') as f:
+            archive_compression = compression.sniff_compression(f.read(4)) or archive_compression
+            f.seek(0)
+            with compression.open_tar(f, archive_compression) as tf:
+                if self.object_store is not None:
+                    # So that files already in the store are linked rather than written
+                    zb_folder = self._extract_verified_members(tf, directory)
+                else:
+                    tf.extractall(directory)
+                    zb_folder = os.path.commonprefix(tf.getnames())
+        os.remove(filepath)
+        return zb_folder
+
+    def _stream_extract_file(self, file_url, directory, checksum, archive_compression=compression.GZIP, progress=None, cancel=None,
+                             attempts=None):
+        """Download an archive and extract it as it arrives, without
+        writing the archive itself to disk.
+
+        Each payload file is hashed as it is written and checked against
+        CONTENTS.json, and the digest of the whole archive is
+        checked against the Zenodo checksum once the stream ends. The request
+        is tried at most attempts times if given.
+
+        Returns the common prefix of the archive member names.
+        """
+        algorithm, expected = checksum.split(':')
+        hasher = hashlib.new(algorithm)
+        logging.info('Downloading and extracting {} to {}.'.format(file_url, directory))
+        with self._get(file_url, attempts=attempts, stream=True) as response:
+            if not response.ok:
+                raise ZenodoDownloadException('HTTP status {} while downloading {}'.format(response.status_code, file_url),
+                                              response.status_code, response.headers)
+            reader = _DownloadReader(response.raw, hasher, cancel, file_url, progress, self.bandwidth_limiter)
+            with compression.open_tar(reader, archive_compression) as tf:
+                zb_folder = self._extract_verified_members(tf, directory)
+            # Read past the end of the tar data so that the digest covers the
+            # whole file
+            while reader.read(1024 * 1024):
+                pass
+
+        if hasher.hexdigest() != expected:
+            raise ZenodoBackpackMalformedException(
+                f"Checksum is incorrect for downloaded file '{file_url}'. Please download again.")
+        return zb_folder
+
+    def _apply_deltas(self, directory, base, deltas, keep=()):
+        """Extract the first of the delta archives which applies to the
+        installed backpack base into directory, and link the unchanged files
+        from base. If none applies, or applying one fails, nothing but the
+        entries named in keep is left in directory.
+
+        Returns the name of the backpack folder in directory, or None.
+        """
+        for f in deltas:
+            try:
+                zb_folder = self._apply_delta(directory, base, f)
+            except (ZenodoConnectionException, ZenodoBackpackMalformedException, requests.RequestException, OSError) as e:
+                logging.warning('Could not update using delta archive {}: {}'.format(f['key'], e))
+                zb_folder = None
+            if zb_folder is not None:
+                return zb_folder
+            self._clear_staging(directory, keep)
+        logging.info('No delta archive applies to version {}, so downloading the whole version.'.format(
+            base.data_version_string()))
+        return None
+
+    def _apply_delta(self, directory, base, f):
+        """Download a delta archive, extracting it into directory if it was
+        made from the version of base, then link the files it does not hold
+        from base.
+
+        Returns the name of the backpack folder in directory, or None if the
+        delta is for another version.
+        """
+        link = f['links']['self']
+        filename = f['key'].split('/')[-1]
+        algorithm, expected = f['checksum'].split(':')
+        hasher = hashlib.new(algorithm)
+        with self.events.phase(events.DOWNLOAD, file=filename, delta=True) as info, \
+                self._get(link, stream=True) as response:
+            if not response.ok:
+                raise ZenodoConnectionException('HTTP status {} while downloading {}'.format(response.status_code, link))
+            progress = _FileProgress(self.events, filename)
+            reader = _DownloadReader(response.raw, hasher, None, link, progress, self.bandwidth_limiter)
+            with compression.open_tar(reader, compression.archive_compression(filename)) as tf:
+                first = tf.next()
+                if first is None or not first.isfile() or first.name.split('/')[1:] != [DELTA_FILE]:
+                    raise ZenodoBackpackMalformedException('{} does not begin with {}'.format(filename, DELTA_FILE))
+                delta = json.loads(tf.extractfile(first).read().decode())
+                if str(delta.get(BASE_VERSION)).strip() != str(base.data_version_string()).strip():
+                    logging.info('Delta archive {} is from version {}, not {}'.format(
+                        filename, delta.get(BASE_VERSION), base.data_version_string()))
+                    # Closing the response abandons the rest of the archive
+                    info['bytes'] = progress.count
+                    return None
+                logging.info('Updating from version {} with the {} changed files of {}'.format(
+                    base.data_version_string(), len(delta[FILES]), filename))
+                self._extract_verified_members(tf, directory, expected=delta[FILES])
+            while reader.read(1024 * 1024):
+                pass
+            info['bytes'] = progress.count
+        if hasher.hexdigest() != expected:
+            raise ZenodoBackpackMalformedException(
+                f"Checksum is incorrect for downloaded file '{filename}'. Please download again.")
+
+        zb_folder = first.name.split('/')[0]
+        zb = ZenodoBackpack(os.path.join(directory, zb_folder))
+        delivered = set(delta[FILES])
+        base_checksums = base.checksums()
+        same_algorithm = zb.hash_algorithm() == base.hash_algorithm()
+        linked = 0
+        for key, digest in zb.checksums().items():
+            if key in delivered:
+                continue
+            if not same_algorithm or base_checksums.get(key) != digest:
+                raise ZenodoBackpackMalformedException(
+                    'Delta archive {} does not hold {}, which differs from the installed version'.format(filename, key))
+            link_or_copy(os.path.join(base.base_directory, key[1:]), os.path.join(zb.base_directory, key[1:]))
+            linked += 1
+        logging.info('Reused {} unchanged files from the installed version.'.format(linked))
+        return zb_folder
+
+    def _extract_verified_members(self, tf, directory, expected=None):
+        """Extract the members of a tarfile opened in stream mode, checking
+        each payload file against CONTENTS.json. Extraction continues from
+        the next member of tf, so members may have been read already.
+
+        If expected is given, it lists the keys of the payload files the
+        archive must hold, as in a delta archive; otherwise all those in
+        CONTENTS.json must be present. Files already in the object store,
+        if there is one, are linked from it rather than written.
+
+        CONTENTS.json is normally the first member, so each file is checked as
+        soon as it is written. Archives made with single_pass put it last
+        instead, in which case md5 digests are kept until it arrives, and
+        files are hashed again from disk if it names another algorithm.
+
+        Returns the common prefix of the member names.
+        """
+        directory = os.path.abspath(directory)
+        checksums = None
+        algorithm = None
+        names = []
+        digests = {}
+        targets = {}
+        for member in iter(tf.next, None):
+            names.append(member.name)
+            target = os.path.abspath(os.path.join(directory, member.name))
+            if not target.startswith(directory + os.sep):
+                raise ZenodoBackpackMalformedException('Archive member {} would be extracted outside {}'.format(member.name, directory))
+
+            if member.isfile() and len(member.name.split('/')) == 2 and member.name.endswith('/CONTENTS.json'):
+                if checksums is not None:
+                    raise ZenodoBackpackMalformedException('Archive contains more than one CONTENTS.json')
+                data = tf.extractfile(member).read()
+                contents = json.loads(data.decode())
+                checksums = contents.get(CHECKSUMS, contents.get(MD5SUMS))
+                if checksums is None:
+                    raise ZenodoBackpackMalformedException('CONTENTS.json does not list the checksums of payload files')
+                algorithm = contents.get(HASH_ALGORITHM, MD5)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(data)
+                for key in list(digests):
+                    if algorithm != MD5:
+                        digests[key] = _hash_file(targets[key], algorithm)
+                    self._check_streamed_member(checksums, key, digests[key])
+            elif member.isfile() and len(member.name.split('/')) == 2 and member.name.endswith('/' + MANIFEST_FILE):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(tf.extractfile(member), f)
+            elif member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                key = '/' + member.name.split('/', 1)[1]
+                if checksums is not None and key not in checksums:
+                    raise ZenodoBackpackMalformedException('Archive member {} is not listed in CONTENTS.json'.format(member.name))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if checksums is not None and self.object_store is not None \
+                        and self.object_store.contains(algorithm, checksums[key]):
+                    # The archive's own checksum covers the data skipped
+                    self.object_store.link(algorithm, checksums[key], target)
+                    digests[key] = checksums[key]
+                    continue
+                # Until CONTENTS.json arrives, guess md5, as most backpacks use
+                h = new_hasher(algorithm or MD5)
+                source = tf.extractfile(member)
+                with open(target, 'wb') as f:
+                    while True:
+                        data = source.read(1024 * 1024)
+                        if not data:
+                            break
+                        h.update(data)
+                        f.write(data)
+                os.chmod(target, member.mode)
+                os.utime(target, (member.mtime, member.mtime))
+                digests[key] = h.hexdigest()
+                if checksums is not None:
+                    self._check_streamed_member(checksums, key, digests[key])
+                else:
+                    targets[key] = target
+            else:
+                raise ZenodoBackpackMalformedException('Unsupported archive member type for {}'.format(member.name))
+
+        if checksums is None:
+            raise ZenodoBackpackMalformedException('Archive does not contain CONTENTS.json')
+        missing = set(checksums if expected is None else expected) - set(digests)
+        if missing:
+            raise ZenodoBackpackMalformedException('Files listed in CONTENTS.json are missing from the archive: {}'.format(
+                ', '.join(sorted(missing)[:10])))
+        return os.path.commonprefix(names)
+
+    def _check_streamed_member(self, checksums, key, digest):
+        if key not in checksums:
+            raise ZenodoBackpackMalformedException('Archive member {} is not listed in CONTENTS.json'.format(key))
+        if digest != checksums[key]:
+            raise ZenodoBackpackMalformedException('Extracted file checksum does not match that in JSON file: {}'.format(key))
+
+    def verify(self, zenodo_backpack, metadata=None, passed_version=None, checksums=True, max_workers=1, use_processes=False,
+               use_cache=False, full=False, sample=None):
+        """Verify that a downloaded directory is in working order.
+
+        If metadata downloaded from Zenodo is provided, it will be checked as well.
+
+        Reads <CONTENTS.json> (file) within directory containing md5 sums for files a single extracted
+        payload folder with an arbitrary name, or checksums of the hash_algorithm it records
+
+        Parameters
+        ----------
+        directory: str
+            Location of downloaded and extracted data
+        metadata: json dict
+            Downloaded metadata from Zenodo containing version information
+        passed_version: str
+            Passed specific version to verify
+        checksums: bool
+            If False, only check versions, not the checksums of payload files
+        max_workers: int
+            Number of payload files, or chunks of files with chunk checksums,
+            to hash at the same time
+        use_processes: bool
+            If True, hash in a pool of processes rather than threads
+        use_cache: bool
+            If True, keep a record of each verified file's size, modification
+            time and inode in a sidecar next to CONTENTS.json, and only hash
+            files whose record has changed since. Skipped silently if the
+            sidecar cannot be written.
+        full: bool
+            With use_cache, hash every file anyway and refresh the sidecar
+        sample: None or float
+            If given, only check that every file exists, and verify a random
+            sample of about this fraction of the payload bytes, made up of
+            the chunks of files with chunk checksums and of other whole files.
+            The sidecar of use_cache is then not updated.
+
+        Returns nothing if verification works, otherwise raises
+        ZenodoBackpackMalformedException or ZenodoBackpackVersionException.
+        When payload files fail verification, a
+        ZenodoBackpackChecksumException listing all of them is raised.
+        """
+
+
+
+        # extract identifying keys for version and zenodo_backpack_version
+        version = zenodo_backpack.data_version_string()
+        zenodo_backpack_version = zenodo_backpack.zenodo_backpack_version_string()
+        payload_folder = zenodo_backpack.payload_directory_string()
+
+        if metadata:
+            logging.info('Verifying version and checksums...')
+            metadata_ver = str(metadata['metadata']['version']).strip()
+
+            if str(version).strip() != metadata_ver:
+                raise ZenodoBackpackMalformedException(
+                    f'Version in CONTENTS.json: {version} does not match version in Zenodo metadata: {metadata_ver}')
+
+        elif passed_version:
+            logging.info('Verifying version and checksums...')
+            if str(version).strip() != str(passed_version).strip():
+                raise ZenodoBackpackMalformedException(
+                    f'Version in CONTENTS.json: {version} does not match version provided: {passed_version}')
+
+        else:
+            logging.warning('Not using version verification.')
+            logging.info('Verifying checksums...')
+
+        if zenodo_backpack_version not in SUPPORTED_ZENODO_BACKPACK_VERSIONS:
+            raise ZenodoBackpackVersionException('Incorrect ZENODO Backpack version: {} Expected one of: {}'
+                                                 .format(zenodo_backpack_version, SUPPORTED_ZENODO_BACKPACK_VERSIONS))
+
+        if not checksums:
+            logging.info('Verification success.')
+            return
+
+        # The rest of contents should only be files with checksums.
+        algorithm = zenodo_backpack.hash_algorithm()
+        # Taken in one pass, since looking up each file in a manifest means a search
+        parent_folder = os.path.split(payload_folder)[0]
+        payload_files = []
+        for payload_file, digest in zenodo_backpack.checksums().items():
+            # remove slash to enable os.path.join
+            payload_files.append((payload_file, os.path.join(parent_folder, payload_file[1:]), digest))
+
+        cache = None
+        verified = {}
+        if use_cache:
+            cache = self._load_verification_cache(zenodo_backpack, algorithm)
+            if not full:
+                for payload_file, filepath, expected in payload_files:
+                    cached = cache['files'].get(payload_file)
+                    if cached is None or cached[3] != expected:
+                        continue
+                    try:
+                        signature = _stat_signature(filepath)
+                    except FileNotFoundError:
+                        continue
+                    if signature == cached[:3]:
+                        verified[payload_file] = cached
+            logging.info('{} of {} files unchanged since they were last verified.'.format(len(verified), len(payload_files)))
+
+        to_hash = [entry for entry in payload_files if entry[0] not in verified]
+        if self.object_store is not None:
+            # Objects were checked as they entered the store, and are read-only
+            to_hash = [entry for entry in to_hash if not self.object_store.holds(entry[1], algorithm, entry[2])]
+            logging.info('{} files are linked to the object store.'.format(len(payload_files) - len(verified) - len(to_hash)))
+
+        # Files with chunk checksums are hashed chunk by chunk, so that the
+        # chunks of one large file can be hashed by several workers at once
+        chunk_size, chunk_checksums = zenodo_backpack.chunk_checksums()
+        tasks = []
+        chunked_files = {}
+        for payload_file, filepath, expected in to_hash:
+            chunks = chunk_checksums.get(payload_file)
+            if chunks:
+                chunked_files[payload_file] = expected
+                tasks.extend((payload_file, filepath, i * chunk_size, chunk_size, chunk)
+                             for i, chunk in enumerate(chunks))
+            else:
+                tasks.append((payload_file, filepath, None, None, expected))
+        missing = []
+        if sample is not None:
+            tasks, missing = self._sample_verify_tasks(tasks, sample)
+            logging.info('Verifying a sample of {} of {} files and chunks.'.format(
+                len(tasks), sum(len(chunk_checksums.get(f, [None])) for f, _, _ in to_hash)))
+
+        with self.events.phase(events.VERIFY, path=zenodo_backpack.base_directory, files=len(to_hash),
+                               cached=len(verified)) as info:
+            parts = [(filepath, offset, length) for _, filepath, offset, length, _ in tasks]
+            if max_workers > 1 and len(parts) > 1:
+                executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+                with executor_class(max_workers=max_workers) as executor:
+                    results = list(executor.map(_hash_verify_part, parts, [algorithm] * len(parts),
+                                                chunksize=16 if use_processes else 1))
+            else:
+                results = [_hash_verify_part(part, algorithm) for part in parts]
+            info['bytes'] = sum(_hashed_bytes(offset, length, signature)
+                                for (_, _, offset, length, _), (_, signature) in zip(tasks, results))
+
+        mismatched = []
+        regions = {}
+        missing_files = set(missing)
+        chunk_results = {}
+        racy_before = time.time_ns() - VERIFICATION_CACHE_RACY_NS
+        for (payload_file, _, offset, length, expected), (digest, signature) in zip(tasks, results):
+            if digest is None:
+                if payload_file not in missing_files:
+                    missing_files.add(payload_file)
+                    missing.append(payload_file)
+            elif offset is not None:
+                chunk_results.setdefault(payload_file, []).append((offset, length, digest == expected, signature))
+            elif digest != expected:
+                mismatched.append(payload_file)
+            elif signature is not None and signature[1] < racy_before:
+                verified[payload_file] = signature + [digest]
+
+        for payload_file, chunks in chunk_results.items():
+            if payload_file in missing_files:
+                continue
+            bad = [(offset, length) for offset, length, ok, _ in chunks if not ok]
+            signatures = set(tuple(signature) if signature is not None else None for _, _, _, signature in chunks)
+            signature = next(iter(signatures))
+            end = len(chunk_checksums[payload_file]) * chunk_size
+            if sample is None and signature is not None and signature[0] > end:
+                # Data after the last chunk is not covered by any checksum
+                bad.append((end, signature[0] - end))
+            if bad:
+                mismatched.append(payload_file)
+                regions[payload_file] = bad
+            elif sample is None and len(signatures) == 1 and signature is not None and signature[1] < racy_before:
+                verified[payload_file] = list(signature) + [chunked_files[payload_file]]
+
+        # A sample does not show that unsampled files are unchanged
+        if cache is not None and sample is None:
+            cache['files'] = verified
+            self._save_verification_cache(zenodo_backpack, cache)
+        if mismatched or missing:
+            raise ZenodoBackpackChecksumException(mismatched, missing, regions)
+
+        logging.info('Verification success.')
+
+    def _sample_verify_tasks(self, tasks, fraction):
+        """Choose verification tasks, each a whole file or a chunk of one,
+        covering about fraction of the bytes of all tasks. Tasks are drawn at
+        random in proportion to their size, but none which would go over the
+        fraction is taken, so large files without chunk checksums are
+        sampled less than their size alone would have them, and not at all
+        if larger than the fraction of the whole. If no task fits, the
+        smallest is taken as long as it is a chunk or a file of at most
+        QUICK_VERIFY_MAX_FILE_SIZE bytes. The existence of every file is
+        checked.
+
+        Returns the chosen tasks and the list of missing files.
+        """
+        sizes = {}
+        missing = []
+        weighted = []
+        for task in tasks:
+            payload_file, filepath, offset, length, _ = task
+            if payload_file not in sizes:
+                try:
+                    sizes[payload_file] = os.stat(filepath).st_size
+                except FileNotFoundError:
+                    sizes[payload_file] = None
+                    missing.append(payload_file)
+            if sizes[payload_file] is None:
+                continue
+            size = sizes[payload_file] if offset is None else min(length, max(0, sizes[payload_file] - offset))
+            # Sorting by log(u) / weight takes a weighted sample without
+            # replacement (Efraimidis and Spirakis)
+            weighted.append((math.log(1.0 - random.random()) / max(size, 1), size, task))
+        weighted.sort(key=lambda w: w[0], reverse=True)
+
+        total_budget = fraction * sum(size for _, size, _ in weighted)
+        budget = total_budget
+        chosen = []
+        for _, size, task in weighted:
+            if size <= budget:
+                chosen.append(task)
+                budget -= size
+        if not chosen and weighted:
+            _, size, task = min(weighted, key=lambda w: w[1])
+            if task[2] is not None or size <= QUICK_VERIFY_MAX_FILE_SIZE:
+                chosen.append(task)
+        too_large = [task[0] for _, size, task in weighted
+                     if task[2] is None and size > max(total_budget, QUICK_VERIFY_MAX_FILE_SIZE)]
+        if too_large:
+            logging.warning('{} files without chunk checksums are too large to be sampled, so only their existence '
+                            'is checked, such as {}. Recreate the backpack with chunk_size so that they can be.'.format(
+                                len(too_large), too_large[0]))
+        return chosen, missing
+
+    def _load_verification_cache(self, zenodo_backpack, algorithm=MD5):
+        """Read the verification cache of a backpack, returning an empty one
+        if it is missing, unreadable or was made for a different CONTENTS.json."""
+        contents_signature = _stat_signature(os.path.join(zenodo_backpack.base_directory, 'CONTENTS.json'))
+        try:
+            with open(os.path.join(zenodo_backpack.base_directory, VERIFICATION_CACHE_FILE)) as f:
+                cache = json.load(f)
+            if cache['contents'] == contents_signature and cache['algorithm'] == algorithm:
+                return cache
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return {'contents': contents_signature, 'algorithm': algorithm, 'files': {}}
+
+    def _save_verification_cache(self, zenodo_backpack, cache):
+        path = os.path.join(zenodo_backpack.base_directory, VERIFICATION_CACHE_FILE)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.debug('Could not write verification cache {}: {}'.format(path, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _resolve_metadata(self, doi, version):
+        """Find the metadata of a DOI and version, from the metadata cache
+        when there is one and its entry can be used.
+        Arguments:
+            doi (str): DOI of the Zenodo series
+            version: (None or str): If None, return the newest version. If specified, target that specific version.
+        Returns:
+            js (json object): json metadata file retrieved from Zenodo API.
+            js['files'] (list): list of files associated with the record
+        """
+        if self.metadata_cache is None:
+            with self.events.phase(events.RESOLVE_DOI, doi=doi):
+                recordID = self._retrieve_record_ID(doi)
+            with self.events.phase(events.FETCH_METADATA, doi=doi, version=version):
+                return self._retrieve_record_metadata(recordID, version)
+
+        entry = self.metadata_cache.get(doi, version)
+        if entry is not None and (self.offline or self.metadata_cache.is_fresh(entry)):
+            logging.debug('Using cached metadata for DOI {} version {}'.format(doi, version))
+            with self.events.phase(events.FETCH_METADATA, doi=doi, version=version) as info:
+                info['cached'] = True
+            return entry['metadata'], entry['metadata']['files']
+        if self.offline:
+            raise ZenodoConnectionException(
+                'Running offline, but no metadata for DOI {} version {} is cached.'.format(doi, version))
+
+        try:
+            with self.events.phase(events.RESOLVE_DOI, doi=doi):
+                recordID = self._retrieve_record_ID(doi)
+            if version is None:
+                url = self.records_url + recordID
+            else:
+                url = self.records_url + recordID + '/versions'
+            etag = entry['etag'] if entry is not None and entry['record_id'] == recordID else None
+            with self.events.phase(events.FETCH_METADATA, doi=doi, version=version) as info:
+                js, etag = self._get_record_json(url, etag)
+                info['cached'] = js is None
+        except ZenodoConnectionException as e:
+            if entry is None:
+                raise
+            logging.warning('Using cached metadata for DOI {} as Zenodo could not be reached: {}'.format(doi, e))
+            return entry['metadata'], entry['metadata']['files']
+
+        if js is None:
+            logging.debug('Cached metadata for DOI {} version {} is still current'.format(doi, version))
+            metadata = entry['metadata']
+        elif version is None:
+            metadata = js
+        else:
+            metadata = self._select_version(js, recordID, version)
+        self.metadata_cache.put(doi, version, recordID, etag, metadata)
+        return metadata, metadata['files']
+
+    def _get_record_json(self, url, etag=None):
+        """Fetch json from the Zenodo API, conditional on etag if given.
+        Returns:
+            (js, etag): the json, or None if it is unchanged since etag, and
+            the ETag of the response
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        try:
+            r = self._get(url, timeout=15., headers=headers)
+        except Exception as e:
+            raise ZenodoConnectionException('Error during metadata retrieval: {}'.format(e))
+        if r.status_code == 304:
+            return None, etag
+        if not r.ok:
+            raise ZenodoConnectionException('Error during metadata retrieval: HTTP status {} for {}'.format(r.status_code, url))
+        try:
+            return json.loads(r.text), r.headers.get('ETag')
+        except ValueError as e:
+            raise ZenodoConnectionException('Error during metadata retrieval: {}'.format(e))
+
+    def _retrieve_record_ID(self, doi):
+        """Parses provided DOI retrieve associated Zenodo URL which also contains record ID
+        Arguments:
+            DOI (str): published DOI associated with file uploaded to Zenodo
+            version: If None, return the newest version. If specified, target that specific version.
+        Returns:
+            recordID (str): last part of Zenodo url associated with DOI
+        """
+
+        if not doi.startswith('http'):
+            doi = self.doi_resolver_url + doi
+        try:
+            logging.debug(f"Retrieving URL {doi}")
+            r = self._get(doi, timeout=15.)
+        except Exception as e:
+            raise ZenodoConnectionException('Connection error: {}'.format(e))
+        if not r.ok:
+            raise ZenodoConnectionException('DOI could not be resolved. Check your DOI is correct.')
+
+        recordID = r.url.split('/')[-1].strip()
+        return recordID
+
+    def _retrieve_record_json(self, recordID):
+        """Parses provided recordID to access Zenodo API records and download metadata json
+        Arguments:
+            recordID (str): Zenodo record number
+        Returns:
+            json response from Zenodo API
+        """
+        try:
+            r = self._get(self.records_url + recordID, timeout=15.)
+            return json.loads(r.text)
+        except Exception as e:
+            raise ZenodoConnectionException('Error during metadata retrieval: {}'.format(e))
+
+    def _retrieve_versions_record_json(self, recordID, version):
+        """Parses provided recordID to access Zenodo API records and download metadata json
+        Arguments:
+            recordID (str): Zenodo record number
+            version: (str): Target that specific version.
+        Returns:
+            json response from Zenodo API
+        """
+        try:
+            r = self._get(self.records_url + recordID + '/versions', timeout=15.)
+        except Exception as e:
+            raise ZenodoConnectionException('Error during metadata retrieval: {}'.format(e))
+
+        return self._select_version(json.loads(r.text), recordID, version)
+
+    def _select_version(self, js, recordID, version):
+        """Picks out the record of a given version from the response of the
+        Zenodo API versions endpoint
+        Arguments:
+            js (dict): json response from Zenodo API
+            recordID (str): Zenodo record number
+            version: (str): Target that specific version.
+        Returns:
+            json record of that version
+        """
+        versions = js['hits']['hits']
+        for v in versions:
+            if 'version' not in v['metadata']:
+                if 'doi' in v['metadata']:
+                    bad_doi = v['metadata']['doi']
+                else:
+                    bad_doi = '???'
+                logging.warning(f'Version not found in Zenodo record {bad_doi}. Is the version specified in the record\'s metadata? The authors can update this. But here, skipping this instance.')
+                continue
+            if v['metadata']['version'] == version:
+                return v
+        raise ZenodoBackpackVersionException(f'Version {version} not found in Zenodo record {recordID}')
+
+    def _retrieve_record_metadata(self, recordID, version):
+        """Parses provided recordID to access Zenodo API records and download metadata json
+        Arguments:
+            recordID (str): Zenodo record number
+            version: (None or str): If None, return the newest version. If specified, target that specific version.
+        Returns:
+            js (json object): json metadata file retrieved from Zenodo API.
+            js['files'] (list): list of files associated with recordID in question
+        """
+        if version is None:
+            js = self._retrieve_record_json(recordID)
+        else:
+            js = self._retrieve_versions_record_json(recordID, version)
+        return js, js['files']
+
+    def _check_hash(self, filename, checksum, metadata=True):
+        """Compares MD5 sum of file to checksum
+        Arguments:
+            filename (str): Path of file to md5sum
+            checkmsum: (str): md5 checksum
+
+            returns True if checksum is correct
+        """
+        if metadata:
+            algorithm, value = checksum.split(':')
+        else:
+            algorithm = 'md5'
+            value = checksum
+
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        digest = _hash_file(filename, algorithm)
+
+        return value == digest
+
+    def _download_file(self, file_url, out_file, progress_bar=False, progress=None, cancel=None, size=None, segments=1, checksum=None,
+                       attempts=None):
+        """Download a file to disk
+        Streams a file from URL to disk.
+        Can optionally use tqdm for a visual download bar
+
+        Data is written to <out_file>.part, next to a <out_file>.part.json
+        sidecar recording the URL, expected size and checksum along with
+        progress so far. If a matching .part file is found, the download
+        continues from where it stopped using Range requests. The .part file is
+        renamed to out_file once complete.
+
+        Arguments:
+            file_url (str): URL of file to download
+            out_file (str): Target file path
+            progress_bar (bool): Display graphical progresss bar
+            progress: Object whose update(n) method is called as each n bytes
+                arrive, such as a tqdm progress bar
+            cancel (threading.Event): When set, the download stops, keeping
+                the .part file, and DownloadCancelledException is raised
+            size (int): Expected size of the file in bytes, if known
+            segments (int): If more than 1 and size is at least
+                segment_threshold, download this many byte ranges at once. Falls
+                back to a single stream if the server does not honour Range.
+            checksum (str): Expected checksum in Zenodo's '<algorithm>:<value>'
+                form, recorded so that a .part file is only resumed for the
+                same file. Its algorithm is used to hash the data as it arrives.
+            attempts (int): Most times to try each request, if not as many as
+                the retry policy allows
+
+        Raises ZenodoDownloadException if the server answers with an error
+        status or the download ends early.
+
+        Returns the hex digest of the downloaded file, or None for segmented
+        downloads, whose ranges arrive out of order so cannot be hashed as they
+        stream in.
+        """
+        part_file = out_file + '.part'
+        state = self._load_partial_download(part_file, file_url, size, checksum)
+        if state is None:
+            state = {'url': file_url, 'size': size, 'checksum': checksum, 'segments': None}
+
+        own_bar = None
+        if progress is None and progress_bar:
+            own_bar = TqdmProgress(total=int(size) if size is not None else None)
+            self.events.add(own_bar)
+            progress = _FileProgress(self.events, os.path.basename(out_file))
+        try:
+            response = None
+            if state['segments'] is not None or \
+                    (segments > 1 and size is not None and int(size) >= self.segment_threshold):
+                response = self._download_file_segmented(file_url, part_file, state, segments, progress, cancel, attempts)
+                if response is None:
+                    os.replace(part_file, out_file)
+                    os.remove(part_file + '.json')
+                    return None
+                logging.debug('Server does not support Range requests, downloading {} as a single stream'.format(file_url))
+                state['segments'] = None
+
+            resume_from = 0
+            if response is None:
+                if os.path.exists(part_file):
+                    resume_from = os.path.getsize(part_file)
+                if resume_from > 0:
+                    logging.info('Resuming download of {} from byte {}'.format(file_url, resume_from))
+                    response = self._get(file_url, attempts=attempts, stream=True,
+                                         headers={'Range': 'bytes={}-'.format(resume_from)})
+                    if response.status_code == 416:
+                        response.close()
+                        if size is not None and resume_from == int(size):
+                            os.replace(part_file, out_file)
+                            os.remove(part_file + '.json')
+                            return None
+                        # The partial download is longer than the file, so
+                        # resuming it would fail the same way every time
+                        logging.info('Cannot resume download of {} from byte {}, so starting again'.format(
+                            file_url, resume_from))
+                        self._discard_partial_download(part_file)
+                        resume_from = 0
+                        response = self._get(file_url, attempts=attempts, stream=True)
+                    elif response.status_code != 206:
+                        resume_from = 0
+                else:
+                    response = self._get(file_url, attempts=attempts, stream=True)
+            self._save_partial_download(part_file, state)
+
+            hasher = hashlib.new(checksum.split(':')[0] if checksum else 'md5')
+            if resume_from > 0:
+                # Catch up on the data downloaded by an earlier attempt
+                with open(part_file, 'rb') as f:
+                    while True:
+                        data = f.read(1024 * 1024)
+                        if not data:
+                            break
+                        hasher.update(data)
+
+            with response:
+                if not response.ok:
+                    raise ZenodoDownloadException('HTTP status {} while downloading {}'.format(response.status_code, file_url),
+                                                  response.status_code, response.headers)
+                logging.info('Downloading {} to {}.'.format(file_url, out_file))
+                if own_bar is not None and own_bar.bar.total is None:
+                    own_bar.bar.total = resume_from + int(response.headers.get('content-length', 0))
+                if progress is not None:
+                    progress.update(resume_from)
+                with open(part_file, 'ab' if resume_from > 0 else 'wb') as f:
+                    shutil.copyfileobj(_DownloadReader(response.raw, hasher, cancel, file_url, progress, self.bandwidth_limiter), f)
+
+            if size is not None and os.path.getsize(part_file) != int(size):
+                raise ZenodoDownloadException('Download of {} ended after {} of {} bytes'.format(
+                    file_url, os.path.getsize(part_file), size))
+            os.replace(part_file, out_file)
+            os.remove(part_file + '.json')
+            return hasher.hexdigest()
+        finally:
+            if own_bar is not None:
+                self.events.remove(own_bar)
+                own_bar.close()
+
+    def _load_partial_download(self, part_file, file_url, size, checksum):
+        """Return the saved state of an earlier download into part_file if it
+        was for the same URL, size and checksum. Otherwise remove any stale
+        partial download and return None."""
+        state_file = part_file + '.json'
+        state = None
+        if os.path.exists(part_file) and os.path.exists(state_file):
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+            except ValueError:
+                state = None
+            if state is not None and (state.get('url'), state.get('size'), state.get('checksum')) != (file_url, size, checksum):
+                logging.info('Discarding partial download {} of a different file'.format(part_file))
+                state = None
+        if state is None:
+            self._discard_partial_download(part_file)
+        return state
+
+    def _discard_partial_download(self, part_file):
+        for path in (part_file, part_file + '.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _save_partial_download(self, part_file, state):
+        tmp = part_file + '.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, part_file + '.json')
+
+    def _download_file_segmented(self, file_url, part_file, state, segments, progress=None, cancel=None, attempts=None):
+        """Download a file as several byte ranges over separate connections,
+        writing each into its place in a preallocated part_file.
+
+        If state already lists segments, only their remaining bytes are
+        downloaded. Otherwise the first range is requested before anything is
+        written, and if the server ignores the Range header its response is
+        returned so that the caller can use it as a single stream. Returns None
+        once part_file is complete.
+        """
+        size = int(state['size'])
+        first = None
+        if state['segments'] is None:
+            segment_size = -(-size // segments)
+            ranges = [[start, min(start + segment_size, size) - 1, start] for start in range(0, size, segment_size)]
+
+            first = self._get(file_url, attempts=attempts, stream=True, headers={'Range': 'bytes={}-{}'.format(ranges[0][0], ranges[0][1])})
+            if first.status_code != 206:
+                return first
+
+            with open(part_file, 'wb') as f:
+                f.truncate(size)
+            state['segments'] = ranges
+            self._save_partial_download(part_file, state)
+            logging.info('Downloading {} to {} in {} segments.'.format(file_url, part_file, len(ranges)))
+        else:
+            logging.info('Resuming segmented download of {} to {}.'.format(file_url, part_file))
+            if progress is not None:
+                progress.update(sum(offset - start for start, _, offset in state['segments']))
+
+        ranges = state['segments']
+        # Stop the other segments once one fails
+        failed = threading.Event()
+        state_lock = threading.Lock()
+        save_every = 8 * 1024 * 1024
+
+        def download_segment(index):
+            start, end, offset = ranges[index]
+            if offset > end:
+                return
+            if index == 0 and first is not None:
+                response = first
+            else:
+                response = self._get(file_url, attempts=attempts, stream=True,
+                                     headers={'Range': 'bytes={}-{}'.format(offset, end)})
+            with response:
+                if response.status_code != 206:
+                    raise ZenodoDownloadException(
+                        'Unexpected HTTP status {} for byte range {}-{} of {}'.format(response.status_code, offset, end, file_url),
+                        response.status_code, response.headers)
+                unsaved = 0
+                with _PositionalWriter(part_file) as writer:
+                    for data in response.iter_content(64 * 1024):
+                        if failed.is_set() or (cancel is not None and cancel.is_set()):
+                            raise DownloadCancelledException(file_url)
+                        if offset + len(data) > end + 1:
+                            raise ZenodoConnectionException('Server sent more data than requested for {}'.format(file_url))
+                        if self.bandwidth_limiter is not None:
+                            self.bandwidth_limiter.consume(len(data))
+                        writer.write(data, offset)
+                        offset += len(data)
+                        ranges[index][2] = offset
+                        if progress is not None:
+                            progress.update(len(data))
+                        unsaved += len(data)
+                        if unsaved >= save_every:
+                            with state_lock:
+                                self._save_partial_download(part_file, state)
+                            unsaved = 0
+            if offset != end + 1:
+                raise ZenodoDownloadException(
+                    'Byte range {}-{} of {} ended early after {} bytes'.format(start, end, file_url, offset - start))
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(download_segment, i) for i in range(len(ranges))]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    failed.set()
+                    raise
+        finally:
+            with state_lock:
+                self._save_partial_download(part_file, state)
+        return None
+
+    def _extract_all(self, archive, extract_path):
+        for filename in archive:
+            shutil.unpack_archive(filename, extract_path)
+
+    def _make_sure_path_exists(self, path):
+        """Create directory if it does not exist."""
+        if not path:
+            return
+
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except Exception as e:
+                    logging.error('Specified path does not exist: ' + path + '\n')
+                    raise e
+
+
+class _DownloadReader:
+    """File-like wrapper which hashes data as it is read, and stops reading
+    once a cancel event is set."""
+
+    def __init__(self, raw, hasher, cancel, description, progress=None, limiter=None):
+        self.raw = raw
+        self.hasher = hasher
+        self.cancel = cancel
+        self.description = description
+        self.progress = progress
+        self.limiter = limiter
+
+    def read(self, *args):
+        if self.cancel is not None and self.cancel.is_set():
+            raise DownloadCancelledException(self.description)
+        data = self.raw.read(*args)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        self.hasher.update(data)
+        if self.progress is not None:
+            self.progress.update(len(data))
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _BandwidthLimiter:
+    """Token bucket shared between threads, which sleeps in consume() for
+    as long as needed to keep the total rate below bytes_per_second."""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        # Allow bursts of up to a second's worth of data
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going into debt makes later callers wait their turn too
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _FileProgress:
+    """Emits progress events for a single file, keeping count so that its
+    progress can be taken back off again if the download is retried."""
+
+    def __init__(self, events, filename):
+        self.events = events
+        self.filename = filename
+        self.count = 0
+
+    def update(self, n):
+        self.count += n
+        self.events.emit('progress', events.DOWNLOAD, file=self.filename, bytes=n)
+
+    def rewind(self):
+        self.events.emit('progress', events.DOWNLOAD, file=self.filename, bytes=-self.count)
+        self.count = 0
+
+
+class _PositionalWriter:
+    """Writes data at given offsets of an existing file, using os.pwrite where
+    it is available so that several threads can share the file."""
+
+    def __init__(self, path):
+        if hasattr(os, 'pwrite'):
+            self.fd = os.open(path, os.O_WRONLY)
+            self.f = None
+        else:
+            self.fd = None
+            self.f = open(path, 'r+b')
+
+    def write(self, data, offset):
+        if self.fd is not None:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            self.f.seek(offset)
+            self.f.write(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        else:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,124 @@
+'''Events reporting the progress and timing of each phase of work.
+
+A ZenodoBackpackDownloader passes events to each of its callbacks, given
+when it is created or added later. Each event is a dict with at least:
+
+    event: 'start', 'end' or 'error' for a phase, or 'progress' as data
+        arrives
+    phase: one of PHASES
+    time: seconds since the epoch
+
+'end' events also give the seconds the phase took, and, where known, the
+bytes processed. Other keys identify what the phase worked on, such as the
+doi or file. 'progress' events give the bytes since the last one, which
+are negative when a failed attempt is being discarded.
+
+Callbacks are called one at a time, so need not be thread safe. Included
+are Metrics, which totals time and bytes by phase, JsonLinesWriter, which
+writes each event as a line of JSON, and TqdmProgress, a progress bar.
+'''
+
+import contextlib
+import json
+import threading
+import time
+
+from tqdm import tqdm
+
+RESOLVE_DOI = 'resolve_doi'
+FETCH_METADATA = 'fetch_metadata'
+DOWNLOAD = 'download'
+HASH = 'hash'
+EXTRACT = 'extract'
+VERIFY = 'verify'
+PHASES = (RESOLVE_DOI, FETCH_METADATA, DOWNLOAD, HASH, EXTRACT, VERIFY)
+
+
+class EventDispatcher:
+    '''Passes events to a list of callbacks.'''
+
+    def __init__(self, callbacks=None):
+        self.callbacks = list(callbacks) if callbacks else []
+        self._lock = threading.Lock()
+
+    def add(self, callback):
+        with self._lock:
+            self.callbacks.append(callback)
+
+    def remove(self, callback):
+        with self._lock:
+            self.callbacks.remove(callback)
+
+    def emit(self, event, phase, **fields):
+        if not self.callbacks:
+            return
+        record = {'event': event, 'phase': phase, 'time': time.time()}
+        record.update(fields)
+        with self._lock:
+            for callback in self.callbacks:
+                callback(record)
+
+    @contextlib.contextmanager
+    def phase(self, phase, **fields):
+        '''Emit start and end (or error) events around a phase of work. Yields
+        a dict whose entries, such as bytes, are added to the end event.'''
+        self.emit('start', phase, **fields)
+        start = time.perf_counter()
+        result = {}
+        try:
+            yield result
+        except BaseException as e:
+            self.emit('error', phase, seconds=time.perf_counter() - start, error=str(e), **fields)
+            raise
+        fields.update(result)
+        self.emit('end', phase, seconds=time.perf_counter() - start, **fields)
+
+
+class Metrics:
+    '''Callback totalling the count, time and bytes of completed phases.'''
+
+    def __init__(self):
+        self.phases = {}
+
+    def __call__(self, event):
+        if event['event'] != 'end':
+            return
+        totals = self.phases.setdefault(event['phase'], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        totals['count'] += 1
+        totals['seconds'] += event['seconds']
+        totals['bytes'] += event.get('bytes') or 0
+
+    def summary(self):
+        '''Return the totals by phase, with throughput in megabytes per second
+        of the time spent in each phase.'''
+        return {phase: dict(totals, megabytes_per_second=totals['bytes'] / totals['seconds'] / 1e6 if totals['seconds'] else None)
+                for phase, totals in self.phases.items()}
+
+
+class JsonLinesWriter:
+    '''Callback writing each event to a file as a line of JSON. Progress
+    events are left out unless progress is True, since there are many.'''
+
+    def __init__(self, f, progress=False):
+        self.f = f
+        self.progress = progress
+
+    def __call__(self, event):
+        if event['event'] == 'progress' and not self.progress:
+            return
+        self.f.write(json.dumps(event) + '\n')
+        self.f.flush()
+
+
+class TqdmProgress:
+    '''Callback showing a tqdm progress bar of bytes downloaded.'''
+
+    def __init__(self, total=None):
+        self.bar = tqdm(total=total, unit='iB', unit_scale=True)
+
+    def __call__(self, event):
+        if event['event'] == 'progress' and event['phase'] == DOWNLOAD:
+            self.bar.update(event['bytes'])
+
+    def close(self):
+        self.bar.close()
@@ -0,0 +1,175 @@
+'''Hashing of payload files, shared by downloading and creating backpacks.'''
+
+import hashlib
+import mmap
+import os
+
+MD5 = 'md5'
+SHA256 = 'sha256'
+BLAKE2B = 'blake2b'
+BLAKE3 = 'blake3'
+XXH3 = 'xxh3_128'
+# Algorithms which payload checksums may use. blake3 and xxh3_128 need the
+# blake3 and xxhash packages, and are several times faster than md5.
+HASH_ALGORITHMS = (MD5, SHA256, BLAKE2B, BLAKE3, XXH3)
+
+# Read size when hashing files, and the size above which files are
+# memory-mapped for hashing instead
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+
+def new_hasher(algorithm):
+    '''Return a new hash object for one of HASH_ALGORITHMS, or any other
+    algorithm known to hashlib.'''
+    if algorithm == BLAKE3:
+        try:
+            import blake3
+        except ImportError:
+            raise ImportError('The blake3 package is required for blake3 checksums. Install it with "pip install blake3".')
+        return blake3.blake3()
+    elif algorithm == XXH3:
+        try:
+            import xxhash
+        except ImportError:
+            raise ImportError('The xxhash package is required for xxh3_128 checksums. Install it with "pip install xxhash".')
+        return xxhash.xxh3_128()
+    return hashlib.new(algorithm)
+
+
+def available_hash_algorithms():
+    '''Return those of HASH_ALGORITHMS whose packages are installed.'''
+    available = []
+    for algorithm in HASH_ALGORITHMS:
+        try:
+            new_hasher(algorithm)
+        except ImportError:
+            continue
+        available.append(algorithm)
+    return available
+
+
+def _hash_file(path, algorithm=MD5, chunk_size=None):
+    '''Return the hex digest of a file, reading it in large blocks, or through
+    mmap for large files. Module level so that it can run in a process pool.
+
+    If chunk_size is given, return a (digest, chunk digests) tuple instead,
+    where chunk digests lists the digest of each chunk_size piece of the
+    file, hashed in the same pass, or is None if the file is no larger than
+    one chunk.'''
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if chunk_size is not None and size > chunk_size:
+            h = _ChunkHasher(algorithm, chunk_size)
+        else:
+            h = new_hasher(algorithm)
+        if size >= HASH_MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for start in range(0, size, HASH_MMAP_THRESHOLD):
+                        h.update(view[start:start + HASH_MMAP_THRESHOLD])
+                finally:
+                    view.release()
+        else:
+            while True:
+                data = f.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+    if chunk_size is None:
+        return h.hexdigest()
+    return h.hexdigest(), h.chunk_hexdigests() if isinstance(h, _ChunkHasher) else None
+
+
+def _hash_range(path, offset, length, algorithm=MD5):
+    '''Return the hex digest of length bytes of a file from offset, or of
+    as many as there are.'''
+    h = new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, HASH_BLOCK_SIZE))
+            if not data:
+                break
+            h.update(data)
+            length -= len(data)
+    return h.hexdigest()
+
+
+def _stat_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def _hash_payload_file(path, algorithm=MD5):
+    '''Like _hash_file, but returns a (digest, signature) tuple where signature
+    is the (size, mtime_ns, inode) of the file. The digest is None for missing
+    files, and the signature None if the file changed while being hashed.'''
+    try:
+        before = _stat_signature(path)
+        digest = _hash_file(path, algorithm)
+        after = _stat_signature(path)
+    except FileNotFoundError:
+        return None, None
+    return digest, (before if before == after else None)
+
+
+def _hash_payload_range(path, offset, length, algorithm=MD5):
+    '''Like _hash_payload_file, but for length bytes from offset.'''
+    try:
+        before = _stat_signature(path)
+        digest = _hash_range(path, offset, length, algorithm)
+        after = _stat_signature(path)
+    except FileNotFoundError:
+        return None, None
+    return digest, (before if before == after else None)
+
+
+class _ChunkHasher:
+    """Hashes data both as a whole and in pieces of chunk_size bytes, in the
+    same way as a hash object does."""
+
+    def __init__(self, algorithm, chunk_size):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.whole = new_hasher(algorithm)
+        self.chunk = new_hasher(algorithm)
+        self.chunk_filled = 0
+        self.chunks = []
+
+    def update(self, data):
+        self.whole.update(data)
+        view = memoryview(data)
+        while len(view):
+            n = min(len(view), self.chunk_size - self.chunk_filled)
+            self.chunk.update(view[:n])
+            self.chunk_filled += n
+            view = view[n:]
+            if self.chunk_filled == self.chunk_size:
+                self.chunks.append(self.chunk.hexdigest())
+                self.chunk = new_hasher(self.algorithm)
+                self.chunk_filled = 0
+
+    def hexdigest(self):
+        return self.whole.hexdigest()
+
+    def chunk_hexdigests(self):
+        if self.chunk_filled:
+            return self.chunks + [self.chunk.hexdigest()]
+        return list(self.chunks)
+
+
+class _HashingReader:
+    """File-like wrapper which hashes data as it is read."""
+
+    def __init__(self, raw, hasher):
+        self.raw = raw
+        self.hasher = hasher
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.hasher.update(data)
+        return data
@@ -0,0 +1,126 @@
+'''Indexed archives, whose payload files can be read one at a time.
+
+An indexed archive is made by ZenodoBackpackCreator.create(index=True). It
+is an ordinary .zb.tar.gz, but its deflate stream has a full flush point
+before the first regular file member after each INDEX_BLOCK_SIZE bytes of
+tar data. Decompression can start at any of these points without the data
+before it, so each block of members can be read on its own.
+
+The index is a JSON file uploaded to the same record as the archive, named
+as the archive with INDEX_MARKER in place of '.zb.tar.gz'. It holds the
+archive's file name, under ARCHIVE, and under MEMBERS an entry for each
+regular file member by its name in the archive:
+
+    [start, end, skip, size]
+
+where start and end are the offsets in the compressed archive of the block
+holding the member, and the member's data is the size bytes after the
+first skip bytes that the block decompresses to. A payload file can then
+be read with a single HTTP Range request; see RemoteZenodoBackpack.
+
+Full downloads skip index files.
+'''
+
+import tarfile
+import zlib
+
+from .compression import ARCHIVE_SUFFIXES, GZIP
+
+INDEX_MARKER = '.zbindex.json'
+# Bytes of tar data after which the next regular file starts a new block.
+# Larger blocks compress slightly better, smaller ones make reading a small
+# file fetch less.
+INDEX_BLOCK_SIZE = 1024 ** 2
+ARCHIVE = 'archive'
+MEMBERS = 'members'
+
+
+def is_index_file(filename):
+    '''Return True if filename is named as an archive index.'''
+    return filename.endswith(INDEX_MARKER)
+
+
+def index_name(archive):
+    '''Return the name of the index to go with an archive, with INDEX_MARKER in
+    place of its '.zb.tar.gz' or '.tar.gz'.'''
+    suffix = ARCHIVE_SUFFIXES[GZIP]
+    if not archive.endswith(suffix):
+        raise ValueError('Only gzip archives can be indexed, and {} is not named as one'.format(archive))
+    stem = archive[:-len(suffix)]
+    if stem.endswith('.zb'):
+        stem = stem[:-len('.zb')]
+    return stem + INDEX_MARKER
+
+
+def copy_member(chunks, entry, out, hasher=None):
+    '''Decompress a member from the compressed bytes of its block, writing its
+    data to out.
+
+    Parameters
+    ----------
+    chunks: iterable of bytes
+        The archive from the start of the member's block, which may run on
+        past its end
+    entry: list
+        The member's entry in the index
+    out: file-like
+        Written the member's data
+    hasher: None or hash object
+        Updated with the member's data, if given
+
+    Returns the number of bytes written, which is less than the member's
+    size if chunks ended early.
+    '''
+    _, _, skip, size = entry
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    position = 0
+    written = 0
+    for chunk in chunks:
+        # Decompressing no further than the end of the member
+        data = decompressor.decompress(chunk, skip + size - position)
+        if position + len(data) > skip:
+            data = data[max(0, skip - position):]
+            out.write(data)
+            if hasher is not None:
+                hasher.update(data)
+            written += len(data)
+            position = skip + written
+        else:
+            position += len(data)
+        if position >= skip + size:
+            break
+    return written
+
+
+class IndexingTarFile(tarfile.TarFile):
+    '''TarFile writing to an IndexedGzipWriter in mode 'w', which makes a full
+    flush point before regular file members as needed, and records where
+    each of them can be read from in members_index.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.members_index = {}
+        self._pending = []
+        self._block_start = (self.fileobj.full_flush(), self.offset)
+
+    def addfile(self, tarinfo, fileobj=None, **kwargs):
+        if not tarinfo.isreg():
+            return super().addfile(tarinfo, fileobj, **kwargs)
+        if self.offset - self._block_start[1] >= INDEX_BLOCK_SIZE:
+            self._end_block()
+        header_size = len(tarinfo.tobuf(self.format, self.encoding, self.errors))
+        compressed_start, start = self._block_start
+        self._pending.append((tarinfo.name, compressed_start, self.offset + header_size - start, tarinfo.size))
+        return super().addfile(tarinfo, fileobj, **kwargs)
+
+    def _end_block(self):
+        compressed_end = self.fileobj.full_flush()
+        for name, compressed_start, skip, size in self._pending:
+            self.members_index[name] = [compressed_start, compressed_end, skip, size]
+        self._pending = []
+        self._block_start = (compressed_end, self.offset)
+
+    def close(self):
+        if not self.closed:
+            self._end_block()
+        super().close()
@@ -0,0 +1,163 @@
+'''Advisory lock held while a backpack is downloaded into a directory.
+
+The lock is a file created with O_EXCL, which is atomic on local filesystems
+and on NFS, so that it works between processes on different hosts sharing a
+directory. While held, a heartbeat thread touches the lock file. A lock whose
+holder has died is judged stale, either because its process no longer exists
+on this host or because the heartbeat has stopped, and is then broken.
+'''
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Seconds between touches of a held lock file
+LOCK_HEARTBEAT_INTERVAL = 30
+# A lock file not touched for this many seconds is stale. Generous, since
+# clocks of hosts sharing a filesystem may differ.
+LOCK_STALE_AFTER = 300
+# Seconds between attempts to take a lock held by another process
+LOCK_POLL_INTERVAL = 1
+
+
+class DownloadLockTimeoutException(Exception):
+    pass
+
+
+class DownloadLock:
+    '''Lock on path, taken by acquire() or as a context manager.
+
+    After acquiring, the waited attribute is True if another process held the
+    lock first, in which case it may have finished the work already.
+    '''
+
+    def __init__(self, path, timeout=None, stale_after=LOCK_STALE_AFTER,
+                 heartbeat_interval=LOCK_HEARTBEAT_INTERVAL, poll_interval=LOCK_POLL_INTERVAL):
+        '''
+        Parameters
+        ----------
+        path: str
+            Lock file to create
+        timeout: None or float
+            Seconds to wait for the lock before raising
+            DownloadLockTimeoutException. If None, wait indefinitely.
+        stale_after: float
+            Seconds after its last heartbeat that a lock is considered stale
+        heartbeat_interval: float
+            Seconds between heartbeats while the lock is held
+        poll_interval: float
+            Seconds between attempts to take the lock
+        '''
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+        self.waited = False
+        self._token = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        info = {'host': socket.gethostname(), 'pid': os.getpid(), 'token': token, 'created': time.time()}
+        start = time.monotonic()
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(info, f)
+                break
+
+            holder = self._read(self.path)
+            if self._is_stale(holder):
+                logging.warning('Breaking stale lock {} held by {}'.format(self.path, holder))
+                self._break(holder)
+                continue
+            if not self.waited:
+                logging.info('Waiting for another process to finish downloading, holding lock {}'.format(self.path))
+                self.waited = True
+            if self.timeout is not None and time.monotonic() - start >= self.timeout:
+                raise DownloadLockTimeoutException(
+                    'Timed out after {} seconds waiting for lock {} held by {}'.format(self.timeout, self.path, holder))
+            time.sleep(self.poll_interval)
+
+        self._token = token
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def release(self):
+        if self._token is None:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        holder = self._read(self.path)
+        if holder is not None and holder.get('token') == self._token:
+            os.remove(self.path)
+        else:
+            logging.warning('Lock {} was taken by another process before it was released'.format(self.path))
+        self._token = None
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                os.utime(self.path)
+            except OSError as e:
+                logging.warning('Could not refresh lock {}: {}'.format(self.path, e))
+
+    @staticmethod
+    def _read(path):
+        '''Return the contents of a lock file, {} if it is being written, or
+        None if it does not exist.'''
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            return {}
+
+    def _is_stale(self, holder):
+        if holder is None:
+            return False
+        if holder.get('host') == socket.gethostname() and os.name == 'posix':
+            try:
+                os.kill(holder['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except (OSError, KeyError, TypeError):
+                pass
+        try:
+            return time.time() - os.stat(self.path).st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False
+
+    def _break(self, holder):
+        '''Remove a stale lock file, unless another process has broken and
+        retaken it since it was judged stale.'''
+        moved = '{}.stale.{}'.format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, moved)
+        except FileNotFoundError:
+            return
+        if self._read(moved) != holder:
+            try:
+                os.link(moved, self.path)
+            except OSError:
+                pass
+        os.remove(moved)
@@ -0,0 +1,207 @@
+'''Compact binary manifest of the payload files of a backpack.
+
+CONTENTS.json maps the path of every payload file to its md5 sum, so it
+must be parsed whole even to learn the data version, and the resulting dict
+takes hundreds of MB for backpacks of millions of files. A backpack may
+also hold the same information in CONTENTS.zbm, which is memory-mapped and
+read only where needed. CONTENTS.json is kept alongside it, so older
+versions of zenodo_backpack can still read the backpack.
+
+The layout, with integers little-endian, is:
+
+    header      MAGIC, then the u32 length of the metadata, u32 digest
+                size and u64 number of files
+    metadata    CONTENTS.json without md5sums, as JSON, padded with spaces
+                to a multiple of 8 bytes
+    offsets     u64 offset of each path within paths, and of the end
+    digests     raw digest of each file, digest size bytes each
+    paths       UTF-8 paths, one after another
+
+Files are sorted by the components of their path, so that those of a
+directory are together and any can be found by binary search.
+'''
+
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+
+MANIFEST_FILE = 'CONTENTS.zbm'
+MAGIC = b'ZBM\x01'
+_HEADER = struct.Struct('<4sIIQ')
+_OFFSET = struct.Struct('<Q')
+
+
+def path_key(path):
+    '''Sort key of a path in a manifest.'''
+    return path.split('/')
+
+
+class Manifest(Mapping):
+    '''Read-only mapping of the path of each payload file to its hex digest,
+    memory-mapped from a CONTENTS.zbm file.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, metadata_size, self.digest_size, self._count = _HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC:
+                raise ValueError('{} is not a backpack manifest'.format(path))
+            self.metadata = json.loads(self._mm[_HEADER.size:_HEADER.size + metadata_size].decode())
+            self._offsets = _HEADER.size + metadata_size
+            self._digests = self._offsets + (self._count + 1) * _OFFSET.size
+            self._paths = self._digests + self._count * self.digest_size
+            if self._paths + self._offset(self._count) != len(self._mm):
+                raise ValueError('{} is truncated'.format(path))
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._mm, self._offsets + i * _OFFSET.size)[0]
+
+    def _path(self, i):
+        return self._mm[self._paths + self._offset(i):self._paths + self._offset(i + 1)].decode()
+
+    def _digest(self, i):
+        start = self._digests + i * self.digest_size
+        return self._mm[start:start + self.digest_size].hex()
+
+    def _find(self, path):
+        key = path_key(path)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if path_key(self._path(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._path(low) == path:
+            return low
+        return None
+
+    def __getitem__(self, path):
+        i = self._find(path)
+        if i is None:
+            raise KeyError(path)
+        return self._digest(i)
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._path(i)
+
+    def items(self):
+        '''Yield (path, hex digest) of each file in order, without searching
+        for each as Mapping.items would.'''
+        for i in range(self._count):
+            yield self._path(i), self._digest(i)
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ManifestWriter:
+    '''Writes a manifest one file at a time, so that the files of a large
+    tree need never all be held in memory. Files must be added in sorted
+    order, as given by path_key. The tables are spooled to temporary files
+    next to path, then joined once close() is given the metadata.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.digest_size = None
+        self._last = None
+        self._end = 0
+        self._spools = []
+        for table in ('offsets', 'digests', 'paths'):
+            self._spools.append(open('{}.{}.{}.tmp'.format(path, os.getpid(), table), 'w+b'))
+
+    def add(self, path, digest):
+        '''Add a file, given its path in the backpack and hex digest.'''
+        key = path_key(path)
+        if self._last is not None and key <= self._last:
+            raise ValueError('Manifest files must be added in sorted order, once each: {}'.format(path))
+        self._last = key
+        digest = bytes.fromhex(digest)
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != self.digest_size:
+            raise ValueError('Digests of differing sizes cannot be written to a manifest')
+        encoded = path.encode()
+        offsets, digests, paths = self._spools
+        offsets.write(_OFFSET.pack(self._end))
+        digests.write(digest)
+        paths.write(encoded)
+        self._end += len(encoded)
+        self.count += 1
+
+    def close(self, metadata):
+        '''Write the manifest, replacing path atomically if it exists.'''
+        self._spools[0].write(_OFFSET.pack(self._end))
+        metadata = json.dumps(metadata).encode()
+        metadata += b' ' * (-(_HEADER.size + len(metadata)) % 8)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, len(metadata), self.digest_size or 16, self.count))
+                f.write(metadata)
+                for spool in self._spools:
+                    spool.seek(0)
+                    while True:
+                        data = spool.read(1024 * 1024)
+                        if not data:
+                            break
+                        f.write(data)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            self.discard()
+
+    def discard(self):
+        '''Remove the spooled tables, if close() has not already done so.'''
+        for spool in self._spools:
+            spool.close()
+            os.remove(spool.name)
+        self._spools = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.discard()
+
+
+def write_manifest(path, metadata, checksums):
+    '''Write a manifest to path.
+
+    Parameters
+    ----------
+    path: str
+        File to write, replaced atomically if it exists
+    metadata: dict
+        Contents of CONTENTS.json other than md5sums
+    checksums: dict
+        Hex digest of each payload file, by path as in CONTENTS.json
+    '''
+    with ManifestWriter(path) as writer:
+        for p in sorted(checksums, key=path_key):
+            writer.add(p, checksums[p])
+        writer.close(metadata)
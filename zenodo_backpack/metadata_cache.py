@@ -0,0 +1,67 @@
+'''On-disk cache of Zenodo record metadata, keyed by DOI and version.'''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+# How long metadata for the newest version of a record is used before
+# checking with Zenodo again. Metadata for a pinned version never changes,
+# so is always used.
+METADATA_CACHE_TTL = 24 * 60 * 60
+
+
+class MetadataCache:
+    '''Stores the record ID, ETag and metadata returned by Zenodo for each
+    (DOI, version) pair as a small JSON file in a directory.'''
+
+    def __init__(self, directory, ttl=METADATA_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, doi, version):
+        key = hashlib.sha256(json.dumps([doi, version]).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, doi, version):
+        '''Return the cached entry for a DOI and version, or None.'''
+        try:
+            with open(self._path(doi, version)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('doi') != doi or entry.get('version') != version:
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        '''True if an entry can be used without checking with Zenodo.'''
+        return entry['version'] is not None or time.time() - entry['fetched_at'] < self.ttl
+
+    def put(self, doi, version, record_id, etag, metadata):
+        '''Store an entry, returning it. Failure to write is logged rather
+        than raised, since the cache is only an optimisation.'''
+        entry = {
+            'doi': doi,
+            'version': version,
+            'record_id': record_id,
+            'etag': etag,
+            'fetched_at': time.time(),
+            'metadata': metadata,
+        }
+        path = self._path(doi, version)
+        tmp = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Named uniquely, since threads of one process may write the same entry
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning('Could not write metadata cache {}: {}'.format(path, e))
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+        return entry
@@ -0,0 +1,138 @@
+'''Backpacks read from their Zenodo record one payload file at a time.
+
+A RemoteZenodoBackpack is opened by ZenodoBackpackDownloader.open_remote
+from a record holding an indexed archive (see zenodo_backpack.index). Only
+the index and the contents files are fetched when it is opened. Each
+payload file is fetched with a single HTTP Range request the first time it
+is asked for, checked against its checksum, and kept under base_directory
+in the layout of an extracted backpack, so that it is not fetched again.
+Files kept from an earlier version are removed when the index changes.
+'''
+
+import os
+
+from . import events
+from .backpack import ZenodoBackpack, ZenodoBackpackMalformedException, ZenodoConnectionException, \
+    ZenodoBackpackChecksumException, PAYLOAD_DIRECTORY_KEY
+from .hashing import new_hasher
+from .index import copy_member
+from .manifest import MANIFEST_FILE
+
+# Bytes read from the response at a time when fetching a payload file
+REMOTE_READ_SIZE = 64 * 1024
+
+
+class RemoteZenodoBackpack(ZenodoBackpack):
+    '''A backpack whose payload files are fetched from an indexed archive as
+    they are needed. The payload directory holds only the files fetched so
+    far, so paths within it should be found with fetch().'''
+
+    def __init__(self, base_directory, archive_url, members, downloader):
+        '''
+        Parameters
+        ----------
+        base_directory: str
+            Where the fetched files are kept, named as the backpack folder in
+            the archive
+        archive_url: str
+            URL of the indexed archive
+        members: dict
+            Entries of the archive's index
+        downloader: ZenodoBackpackDownloader
+            Whose session, retry policy and events are used for requests
+        '''
+        self.archive_url = archive_url
+        self.members = members
+        self.downloader = downloader
+        self._member_prefix = os.path.basename(os.path.normpath(base_directory)) + '/'
+        # With a manifest, CONTENTS.json is only fetched if contents is used
+        contents_file = MANIFEST_FILE if self._member_prefix + MANIFEST_FILE in members else 'CONTENTS.json'
+        if not os.path.isfile(os.path.join(base_directory, contents_file)):
+            self._fetch_member(base_directory, contents_file)
+        super().__init__(base_directory)
+        os.makedirs(os.path.join(self.base_directory, self.metadata[PAYLOAD_DIRECTORY_KEY]), exist_ok=True)
+
+    @property
+    def contents(self):
+        '''CONTENTS.json, fetched and loaded when first used.'''
+        if self._contents is None and not os.path.isfile(os.path.join(self.base_directory, 'CONTENTS.json')):
+            self._fetch_member(self.base_directory, 'CONTENTS.json')
+        return ZenodoBackpack.contents.fget(self)
+
+    def fetch(self, path):
+        '''Return the local path of a payload file, fetching it first if it has
+        not been already.
+
+        Parameters
+        ----------
+        path: str
+            Path of the file within the payload directory
+
+        Raises FileNotFoundError if the backpack has no such file, and
+        ZenodoBackpackChecksumException if the file fetched does not match
+        its checksum.
+        '''
+        payload_directory = self.metadata[PAYLOAD_DIRECTORY_KEY]
+        relative = os.path.normpath(os.path.join(payload_directory, path))
+        if not relative.startswith(payload_directory + os.sep):
+            raise FileNotFoundError('{} is not within the payload directory'.format(path))
+        target = os.path.join(self.base_directory, relative)
+        if os.path.isfile(target):
+            # Only files which matched their checksum are moved into place
+            return target
+        key = '/' + relative.replace(os.sep, '/')
+        digest = self.checksums().get(key)
+        if digest is None or self._member_prefix + key[1:] not in self.members:
+            raise FileNotFoundError('{} is not a payload file of {}'.format(path, self.base_directory))
+        return self._fetch_member(self.base_directory, key[1:], key, digest)
+
+    def open(self, path, mode='rb', **kwargs):
+        '''Open a payload file, fetching it first if it has not been already.
+        Other arguments are passed to open().'''
+        return open(self.fetch(path), mode, **kwargs)
+
+    def _fetch_member(self, base_directory, name, key=None, digest=None):
+        '''Fetch the member of the archive at name within the backpack folder,
+        checking it against digest if given, and return its local path.'''
+        entry = self.members.get(self._member_prefix + name)
+        if entry is None:
+            raise ZenodoBackpackMalformedException('The archive index has no entry for {}'.format(name))
+        start, end, _, size = entry
+        target = os.path.join(base_directory, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = '{}.{}.zb_remote.tmp'.format(target, os.getpid())
+        hasher = new_hasher(self.hash_algorithm()) if digest is not None else None
+        try:
+            with self.downloader.events.phase(events.DOWNLOAD, file=name, remote=True) as info, \
+                    self.downloader._get(self.archive_url, stream=True,
+                                         headers={'Range': 'bytes={}-{}'.format(start, end - 1)}) as response:
+                if not response.ok:
+                    raise ZenodoConnectionException('HTTP status {} while fetching {} from {}'.format(
+                        response.status_code, name, self.archive_url))
+                chunks = response.iter_content(REMOTE_READ_SIZE)
+                if response.status_code != 206:
+                    # The server ignored the Range header, so read up to the block
+                    chunks = _skip(chunks, start)
+                with open(tmp, 'wb') as f:
+                    written = copy_member(chunks, entry, f, hasher)
+                info['bytes'] = written
+            if written != size:
+                raise ZenodoConnectionException('Fetched {} bytes of {} from {}, expected {}'.format(
+                    written, name, self.archive_url, size))
+            if hasher is not None and hasher.hexdigest() != digest:
+                raise ZenodoBackpackChecksumException([key], [])
+            os.replace(tmp, target)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return target
+
+
+def _skip(chunks, n):
+    '''Yield chunks after their first n bytes.'''
+    for chunk in chunks:
+        if n >= len(chunk):
+            n -= len(chunk)
+            continue
+        yield chunk[n:]
+        n = 0
@@ -0,0 +1,235 @@
+'''Retrying of HTTP requests which fail for reasons likely to pass.
+
+A RetryPolicy is shared by every request a ZenodoBackpackDownloader makes.
+Requests which fail to connect, time out, or are answered with a status
+showing the server is busy or throttling (429, 5xx) are retried after an
+exponential backoff with full jitter, or after the delay asked for in a
+Retry-After header. When a host throttles, further requests to it from the
+same policy wait out the delay too, rather than each being throttled in turn.
+Failures to look up a host name are not retried, as they seldom pass within
+the backoff and usually mean the host is wrong or the network is down.
+
+A file download is tried again as a whole, continuing from where the last
+attempt stopped, so its requests are made with attempts=1 and the download
+asks download_retry_delay() whether to try again, counting its own attempts.
+Only the failures is_retryable() accepts are tried again: those above, and
+downloads which ended early.
+
+get() makes requests with the requests package. Other clients, such as the
+aiohttp one of AsyncZenodoBackpackDownloader, follow the same policy by
+asking error_retry_delay() and status_retry_delay() whether to retry.
+'''
+
+import email.utils
+import logging
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+
+from .backpack import ZenodoDownloadException
+
+# Statuses worth retrying: throttling, and errors of an overloaded server
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Statuses telling clients to slow down, which pause all requests to the host
+THROTTLE_STATUSES = (429, 503)
+# Exceptions raised by requests which may succeed when tried again, along with
+# those of urllib3 raised while reading the body of a streamed response
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, urllib3.exceptions.ProtocolError,
+                    urllib3.exceptions.ReadTimeoutError)
+# Failures to look up a host name. urllib3 1.x raises the socket error itself.
+NAME_RESOLUTION_EXCEPTIONS = (socket.gaierror,) + tuple(
+    getattr(urllib3.exceptions, name) for name in ('NameResolutionError',) if hasattr(urllib3.exceptions, name))
+
+
+def is_name_resolution_error(error):
+    '''True if error was caused by failing to look up a host name.'''
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, NAME_RESOLUTION_EXCEPTIONS):
+            return True
+        seen.add(id(error))
+        # requests wraps the urllib3 error, which gives the cause as reason,
+        # and aiohttp gives it as os_error
+        causes = [getattr(error, 'reason', None), getattr(error, 'os_error', None), error.__cause__,
+                  error.__context__]
+        causes += [arg for arg in error.args if isinstance(arg, BaseException)]
+        error = next((cause for cause in causes if isinstance(cause, BaseException)), None)
+    return False
+
+
+def is_retryable(error, exceptions=RETRY_EXCEPTIONS):
+    '''True if a download which failed with error may succeed when tried
+    again: a connection error or timeout among exceptions other than a
+    failure to look up the host, or a ZenodoDownloadException for a download
+    which ended early or was answered with a status in RETRY_STATUSES.'''
+    if isinstance(error, ZenodoDownloadException):
+        return error.status is None or error.status in RETRY_STATUSES
+    return isinstance(error, exceptions) and not is_name_resolution_error(error)
+
+
+class RetryPolicy:
+    '''When and for how long to wait before retrying a request.'''
+
+    def __init__(self, attempts=5, backoff=1.0, max_backoff=60.0, max_retry_after=300.0, budget=None):
+        '''
+        Parameters
+        ----------
+        attempts: int
+            Number of times to try each request
+        backoff: float
+            Seconds to wait at most before the first retry. The most doubles
+            with each further retry, and the wait is random up to the most.
+        max_backoff: float
+            Most seconds to wait between attempts, unless asked by Retry-After
+        max_retry_after: float
+            If a server asks for a longer wait than this in Retry-After, give up
+            rather than wait
+        budget: None or int
+            Total number of retries allowed across all requests made with the
+            policy, so that a failing server is not retried indefinitely by
+            many concurrent requests. If None, there is no limit.
+        '''
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._host_resume = {}
+
+    def backoff_delay(self, attempt):
+        '''Seconds to wait after attempt (counting from 0) failed.'''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retry_after_delay(self, response):
+        '''Seconds asked to wait by the Retry-After header of response, or None.'''
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def spend(self):
+        '''Take one retry from the budget, returning False if none are left.'''
+        with self._lock:
+            if self.budget is None:
+                return True
+            if self.budget <= 0:
+                logging.warning('Retry budget is spent, so not retrying')
+                return False
+            self.budget -= 1
+            return True
+
+    def may_retry(self, attempt, attempts=None):
+        '''True if a request may be tried again after attempt (counting from
+        0) of attempts, by default self.attempts, failed, spending one retry
+        of the budget.'''
+        return attempt + 1 < (self.attempts if attempts is None else attempts) and self.spend()
+
+    def pause_host(self, url, delay):
+        '''Hold back requests to the host of url for delay seconds.'''
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._host_resume[host] = max(self._host_resume.get(host, 0), time.monotonic() + delay)
+
+    def host_delay(self, url):
+        '''Seconds until requests to the host of url are no longer held back.'''
+        host = urlsplit(url).netloc
+        with self._lock:
+            resume = self._host_resume.get(host, 0)
+        return max(0.0, resume - time.monotonic())
+
+    def wait_for_host(self, url):
+        '''Sleep until requests to the host of url are no longer held back.'''
+        delay = self.host_delay(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def error_retry_delay(self, url, attempt, error, attempts=None):
+        '''Seconds to wait before retrying a request to url whose attempt
+        (counting from 0) of attempts, by default self.attempts, raised
+        error, or None if it should not be retried. Spends one retry of the
+        budget.'''
+        if is_name_resolution_error(error):
+            logging.warning('Could not look up the host of {}, so not retrying: {}'.format(url, error))
+            return None
+        attempts = self.attempts if attempts is None else attempts
+        if not self.may_retry(attempt, attempts):
+            return None
+        delay = self.backoff_delay(attempt)
+        logging.warning('Error requesting {} (attempt {} of {}), retrying in {:.1f}s: {}'.format(
+            url, attempt + 1, attempts, delay, error))
+        return delay
+
+    def status_retry_delay(self, url, attempt, status, response, attempts=None):
+        '''Seconds to wait before retrying a request to url whose attempt
+        (counting from 0) of attempts, by default self.attempts, was answered
+        with status, or None if the response should be returned as it is.
+        Pauses the host if the server is throttling, and spends one retry of
+        the budget.
+
+        response need only have the headers of the response, so that this
+        serves other HTTP clients than requests.
+        '''
+        if status not in RETRY_STATUSES:
+            return None
+        delay = self.retry_after_delay(response)
+        if delay is None:
+            delay = self.backoff_delay(attempt)
+        elif delay > self.max_retry_after:
+            logging.warning('{} asked to retry after {:.0f}s, longer than the {:.0f}s allowed'.format(
+                url, delay, self.max_retry_after))
+            return None
+        attempts = self.attempts if attempts is None else attempts
+        if not self.may_retry(attempt, attempts):
+            return None
+        if status in THROTTLE_STATUSES:
+            self.pause_host(url, delay)
+        logging.warning('HTTP status {} for {} (attempt {} of {}), retrying in {:.1f}s'.format(
+            status, url, attempt + 1, attempts, delay))
+        return delay
+
+    def download_retry_delay(self, url, attempt, attempts, error):
+        '''Seconds to wait before trying again a download from url whose
+        attempt (counting from 0) of attempts failed with error, which
+        is_retryable() accepted, or None if it should not be tried again.'''
+        if isinstance(error, ZenodoDownloadException) and error.status is not None:
+            return self.status_retry_delay(url, attempt, error.status, error, attempts)
+        return self.error_retry_delay(url, attempt, error, attempts)
+
+    def get(self, session, url, attempts=None, **kwargs):
+        '''session.get(url, **kwargs), retried according to the policy, for
+        at most attempts tries if given rather than self.attempts.
+
+        The response of the last attempt is returned even if its status is
+        an error, and the exception of the last attempt is raised if it did
+        not complete.
+        '''
+        attempt = 0
+        while True:
+            self.wait_for_host(url)
+            try:
+                response = session.get(url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                delay = self.error_retry_delay(url, attempt, e, attempts)
+                if delay is None:
+                    raise
+            else:
+                delay = self.status_retry_delay(url, attempt, response.status_code, response, attempts)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,157 @@
+'''Content-addressed store of payload files, shared between backpacks.
+
+Each distinct payload file is kept once, as an object named by its
+checksum, under objects/<algorithm>/<first two hex digits>/<digest>.
+Backpacks hold hard links to the objects, so any number of backpacks, or
+versions of one, take the space of their distinct files only. Objects are
+made read-only when they enter the store, since changing one in place
+would change it in every backpack linking to it.
+
+The link count of an object tells whether any backpack still uses it, so
+no record of the backpacks is kept, and collect_garbage() removes the
+objects whose only link is the store's own. The store must be on the same
+filesystem as the backpacks which use it.
+
+Objects are only as distinct as their checksums, so a store shared with
+backpacks from untrusted sources should only hold those checksummed with a
+collision-resistant algorithm such as sha256 or blake3.
+'''
+
+import errno
+import logging
+import os
+import shutil
+import stat
+
+OBJECTS_DIRECTORY = 'objects'
+# Linux ioctl cloning a file's extents, as cp --reflink does
+_FICLONE = 0x40049409
+
+
+def link_or_copy(source, target):
+    '''Make target a hard link to source, or a reflink where hard links cannot
+    be made, or failing that a copy. Parent directories of target are made as
+    needed.'''
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    if _reflink(source, target):
+        return
+    # Across filesystems, or where neither is supported
+    shutil.copy2(source, target)
+
+
+def _reflink(source, target):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+    shutil.copystat(source, target)
+    return True
+
+
+class ObjectStore:
+    '''Content-addressed store of payload files in a directory.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def object_path(self, algorithm, digest):
+        return os.path.join(self.directory, OBJECTS_DIRECTORY, algorithm, digest[:2], digest)
+
+    def contains(self, algorithm, digest):
+        return os.path.isfile(self.object_path(algorithm, digest))
+
+    def holds(self, path, algorithm, digest):
+        '''True if the file at path is a link to the object with digest. Such
+        a file need not be hashed to verify it, since objects were checked
+        when they were added and are read-only.'''
+        try:
+            object_stat = os.stat(self.object_path(algorithm, digest))
+            file_stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return (object_stat.st_dev, object_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+    def link(self, algorithm, digest, target):
+        '''Place the object with digest at target, as link_or_copy does.'''
+        link_or_copy(self.object_path(algorithm, digest), target)
+
+    def add(self, path, algorithm, digest):
+        '''Add the file at path, whose checksum has been verified to be
+        digest. If the store already has the object, path is replaced by a
+        link to it, and otherwise becomes the object, made read-only.
+        '''
+        object_path = self.object_path(algorithm, digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        try:
+            os.link(path, object_path)
+        except FileExistsError:
+            if not self.holds(path, algorithm, digest):
+                tmp = '{}.{}.zb_store.tmp'.format(path, os.getpid())
+                os.link(object_path, tmp)
+                os.replace(tmp, path)
+            return
+        mode = os.stat(object_path).st_mode
+        os.chmod(object_path, stat.S_IMODE(mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def add_backpack(self, zenodo_backpack):
+        '''Add each payload file of a verified backpack, linking it to the
+        object already in the store where there is one.
+
+        Returns the number of files which were already in the store.
+        '''
+        algorithm = zenodo_backpack.hash_algorithm()
+        shared = 0
+        for key, digest in zenodo_backpack.checksums().items():
+            path = os.path.join(zenodo_backpack.base_directory, key[1:])
+            existed = self.contains(algorithm, digest)
+            try:
+                self.add(path, algorithm, digest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                logging.warning('Object store {} is not on the same filesystem as {}, so is not used'.format(
+                    self.directory, zenodo_backpack.base_directory))
+                return shared
+            shared += existed
+        logging.info('{} payload files were already in the object store.'.format(shared))
+        return shared
+
+    def collect_garbage(self, dry_run=False):
+        '''Remove objects which no backpack links to. With dry_run, only
+        count them.
+
+        Returns the number of objects removed and the bytes they took.
+        '''
+        removed = 0
+        removed_bytes = 0
+        objects = os.path.join(self.directory, OBJECTS_DIRECTORY)
+        if not os.path.isdir(objects):
+            return removed, removed_bytes
+        for algorithm in sorted(os.listdir(objects)):
+            for prefix in sorted(os.listdir(os.path.join(objects, algorithm))):
+                prefix_directory = os.path.join(objects, algorithm, prefix)
+                for entry in os.scandir(prefix_directory):
+                    info = entry.stat(follow_symlinks=False)
+                    if info.st_nlink > 1:
+                        continue
+                    removed += 1
+                    removed_bytes += info.st_size
+                    if not dry_run:
+                        os.remove(entry.path)
+                if not dry_run and not os.listdir(prefix_directory):
+                    os.rmdir(prefix_directory)
+        logging.info('{} {} unused objects taking {} bytes.'.format(
+            'Would remove' if dry_run else 'Removed', removed, removed_bytes))
+        return removed, removed_bytes